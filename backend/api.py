@@ -1,32 +1,130 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
 from typing import List, Optional, Dict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import json
 from datetime import datetime
 import asyncio
+import difflib
+import math
 import os
+import time
+from urllib.parse import urlparse
 
-from memory import MainHistory, LLMContext
-from pinecone_utils import upsert_message, query_similar_turns, set_namespace
-from llm import ask_llm, ask_llm_stream
-from chat_manager import ChatManager
-from history_manager import HistoryManager
+from memory import MainHistory, LLMContext, estimate_tokens, turns_to_dicts
+from pinecone_utils import (
+    upsert_turns, query_similar_turns_async, query_similar_summaries_async, delete_namespace, summary_namespace,
+    embed_text, embedding_cache_stats, RetrievalUnavailable, pinecone_client
+)
+from llm import ask_llm_async, ask_llm_stream_async, response_cache_stats, gemini
+from client_utils import ServiceUnavailable
+from cache_utils import LRUCache, content_key
+from storage import get_chat_manager, get_history_manager, forget_history_manager, SHARED_STORAGE
+from indexing_queue import indexing_queue
+from session_cache import SessionCache
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from summarizer import summarizer, select_summaries, render_summary, SUMMARY_TOP_K
+import metrics
+from metrics import span
+from realtime import Connection, hub, WS_MAX_IN_FLIGHT
+from similarity_graph import similarity_service, SIMILARITY_MATRIX_MAX_TURNS, SIMILARITY_CLUSTER_THRESHOLD
 
 app = FastAPI(title="LLM Context Management API")
 
+# Browser origins allowed to call the API (comma-separated); also checked on WebSocket connections, which CORS does not cover
+ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "http://localhost:3000").split(",") if origin.strip()]
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:3000"],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-# In-memory storage for active sessions
-active_sessions: Dict[str, dict] = {}
+class ChatLock:
+    """A chat's lock and the number of requests holding or waiting for it"""
+    __slots__ = ("lock", "users")
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+# One lock per chat so its turns are strictly ordered; dropped when its last user leaves
+chat_locks: Dict[str, ChatLock] = {}
+# Evicted sessions are written out on this thread, never on the event loop or under the session cache lock
+session_flusher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-flush")
+session_flushes = {}  # chat_name -> future of its evicted session's flush
+
+def flush_session(chat_name, session):
+    """Write turns an evicted session has not persisted yet; it reloads from storage on next use"""
+    unsaved = session["history"].unsaved_turns()
+    if unsaved:
+        session["history_manager"].save_turns(unsaved)
+
+def evict_session(chat_name, session):
+    """Flush an evicted session in the background"""
+    session_flushes[chat_name] = session_flusher.submit(flush_session, chat_name, session)
+
+def wait_for_flush(chat_name):
+    """Block until an evicted session's writes are done, so reloading the chat sees them"""
+    future = session_flushes.pop(chat_name, None)
+    if future is not None:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error flushing evicted session: {e}")
+
+def chat_busy(chat_name):
+    """True while a turn of the chat is in flight"""
+    entry = chat_locks.get(chat_name)
+    return entry is not None and entry.lock.locked()
+
+# In-memory storage for active sessions, bounded by SESSION_CACHE_MAX_SESSIONS and SESSION_TTL_SECONDS
+active_sessions = SessionCache(on_evict=evict_session, is_busy=chat_busy)
+
+# Newest turns kept in memory per session; older turns are read from disk on demand
+HISTORY_RESIDENT_TURNS = int(os.getenv("HISTORY_RESIDENT_TURNS", "200"))
+# Turns returned when a chat is opened; older ones are paged in via /chat/{name}/history
+OPEN_CHAT_HISTORY_TURNS = int(os.getenv("OPEN_CHAT_HISTORY_TURNS", "50"))
+# Estimated prompt tokens per request (0 disables the limit); context turns get what
+# the system instructions and the new message leave over
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+# Message requests are remembered by idempotency key so client retries do not create duplicate turns
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "1000"))
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+# Turns taken from the BM25 index per query, fused with the vector results
+LEXICAL_TOP_K = int(os.getenv("LEXICAL_TOP_K", "10"))
+# Fraction of a full match on the query's remaining terms a BM25 hit must reach to enter the context
+LEXICAL_MIN_SCORE = float(os.getenv("LEXICAL_MIN_SCORE", "0.3"))
+# Most turns retrieved per vector query; the query size no longer grows with the chat
+TOP_K_RESULTS = int(os.getenv("TOP_K_RESULTS", "10"))
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.15"))
+# Past this, the reply goes ahead with BM25 results alone instead of waiting on the vector query
+VECTOR_QUERY_TIMEOUT_SECONDS = float(os.getenv("VECTOR_QUERY_TIMEOUT_SECONDS", "3"))
+# Retrieval started from the draft while the user types; reused when the sent message
+# matches the draft closely enough and the prefetch is not too old
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_MIN_CHARS = int(os.getenv("PREFETCH_MIN_CHARS", "12"))
+PREFETCH_MATCH_RATIO = float(os.getenv("PREFETCH_MATCH_RATIO", "0.9"))
+PREFETCH_TTL_SECONDS = float(os.getenv("PREFETCH_TTL_SECONDS", "30"))
+
+# (chat, idempotency key) -> future of the first request's result
+idempotent_requests = LRUCache(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL_SECONDS)
+# Prefetches started, and how many were used by the message that followed or thrown away
+prefetch_counts = {"requests": 0, "hits": 0, "misses": 0}
+# Fire-and-forget tasks, referenced until they finish so they are not garbage collected
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 class ChatListResponse(BaseModel):
     chats: Dict[str, dict]
@@ -39,13 +137,20 @@ class ChatResponse(BaseModel):
     chat_name: str
     namespace: str
     message_count: int
-    history: List[dict]
+    history: List[dict]  # Most recent OPEN_CHAT_HISTORY_TURNS turns
+    history_cursor: Optional[int] = None  # Pass as `before` to fetch older turns
+    total_turns: int = 0
     system_instructions: Optional[str] = None
 
 class MessageRequest(BaseModel):
     chat_name: str
     message: str
     use_full_context: bool = False
+    idempotency_key: Optional[str] = None  # Retries with the same key get the original reply
+
+class PrefetchRequest(BaseModel):
+    chat_name: str
+    draft: str
 
 class MessageResponse(BaseModel):
     turn_id: int
@@ -54,21 +159,50 @@ class MessageResponse(BaseModel):
     context_turns: List[dict]
     relevant_turn_ids: List[int]
     similarity_scores: Dict[int, float]  # Map turn_id to similarity score
+    lexical_scores: Dict[int, float] = {}  # Map turn_id to BM25 score
+    retrieval: str = "hybrid"  # "hybrid", "lexical" (vector query failed or timed out) or "full"
+    summaries: List[dict] = []  # Summaries of older turns included in place of the raw turns
+    token_usage: Dict[str, object]  # Estimated prompt tokens per section
+
+@app.on_event("shutdown")
+def flush_background_work():
+    """Finish queued indexing, history and metadata writes before the process exits"""
+    session_flusher.shutdown(wait=True)
+    indexing_queue.flush(timeout=30)
+    get_chat_manager().flush()
 
 @app.get("/")
 def read_root():
     return {"message": "LLM Context Management API", "version": "1.0"}
 
+@app.get("/stats")
+def get_stats():
+    """Cache hit/miss counters, upstream client health and session metrics"""
+    return {
+        "embedding_cache": embedding_cache_stats(),
+        "llm_cache": response_cache_stats(),
+        "clients": {"gemini": gemini.stats(), "pinecone": pinecone_client.stats()},
+        "prefetch": dict(prefetch_counts),
+        "sessions": active_sessions.stats(),
+        "realtime": hub.stats(),
+        "similarity": similarity_service.stats()
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Per-stage and per-request latency histograms in the Prometheus text format"""
+    return metrics.render()
+
 @app.get("/chats", response_model=ChatListResponse)
 def list_chats():
     """List all available chats"""
-    chat_manager = ChatManager()
+    chat_manager = get_chat_manager()
     return {"chats": chat_manager.list_chats()}
 
 @app.post("/chats", response_model=ChatResponse)
 def create_or_open_chat(request: ChatCreateRequest):
     """Create a new chat or open existing one"""
-    chat_manager = ChatManager()
+    chat_manager = get_chat_manager()
     chat_name = request.chat_name.strip()
     
     if not chat_name:
@@ -88,161 +222,420 @@ def create_or_open_chat(request: ChatCreateRequest):
         if system_instructions:
             chat_manager.set_system_instructions(chat_name, system_instructions)
     
-    # Initialize session
-    history = MainHistory()
-    history_manager = HistoryManager(chat_name)
-    
-    # Load existing history
-    saved_history = history_manager.load_history()
-    if saved_history:
-        history.history = saved_history
-    
-    # Store in active sessions
-    active_sessions[chat_name] = {
-        "history": history,
-        "history_manager": history_manager,
-        "namespace": namespace,
-        "chat_manager": chat_manager,
-        "system_instructions": system_instructions,
-        "last_similarity_scores": {}  # Store similarity scores for visualization
-    }
-    
-    set_namespace(namespace)
+    # Reuse a live session so turns still queued for writing are not lost
+    session = active_sessions.get(chat_name)
+    if session is None:
+        session = open_session(chat_name, chat_manager, namespace, system_instructions)
+    history = session["history"]
     
-    chat_info = chat_manager.chats.get(chat_name, {})
+    chat_info = chat_manager.get_chat(chat_name)
+    recent_turns, history_cursor = history.page(limit=OPEN_CHAT_HISTORY_TURNS)
     
     return {
         "chat_name": chat_name,
         "namespace": namespace,
         "message_count": chat_info.get("message_count", 0),
-        "history": history.history,
-        "system_instructions": system_instructions
+        "history": turns_to_dicts(recent_turns),
+        "history_cursor": history_cursor,
+        "total_turns": len(history),
+        "system_instructions": session.get("system_instructions")
     }
 
-@app.post("/message", response_model=MessageResponse)
-def send_message(request: MessageRequest):
-    """Send a message and get response"""
-    chat_name = request.chat_name
-    user_input = request.message.strip()
-    use_full_context = request.use_full_context
+def open_session(chat_name, chat_manager, namespace, system_instructions):
+    """Create the in-memory session for a chat with only its newest turns resident"""
+    wait_for_flush(chat_name)
+    history_manager = get_history_manager(chat_name)
+    history = MainHistory(history_manager)
+    history.load_recent(HISTORY_RESIDENT_TURNS)
+    if history.last_turn():
+        indexing_queue.set_watermark(chat_name, history.last_turn().id)
     
-    if not user_input:
-        raise HTTPException(status_code=400, detail="Message cannot be empty")
-    
-    # Get or create session
-    if chat_name not in active_sessions:
-        # Initialize session
-        chat_manager = ChatManager()
+    session = {
+        "chat_name": chat_name,
+        "history": history,
+        "history_manager": history_manager,
+        "namespace": namespace,
+        "chat_manager": chat_manager,
+        "system_instructions": system_instructions,
+        "context": LLMContext(),  # Reused across requests so unchanged turns are not re-rendered
+        "lexical_index": BM25Index(),  # Filled lazily on the first query
+        "last_query": None,  # Last message retrieved for; its full scores are computed on request
+        "last_similarity_scores": None,
+        "prefetch": None  # Retrieval started from the current draft, see /prefetch
+    }
+    active_sessions.put(chat_name, session)
+    return session
+
+def load_session(chat_name):
+    """Return the active session for a chat, loading it from disk on first use or after eviction"""
+    session = active_sessions.get(chat_name)
+    if session is None:
+        chat_manager = get_chat_manager()
         if not chat_manager.chat_exists(chat_name):
             raise HTTPException(status_code=404, detail="Chat not found")
         
         namespace = chat_manager.get_namespace(chat_name)
         system_instructions = chat_manager.get_system_instructions(chat_name)
-        history = MainHistory()
-        history_manager = HistoryManager(chat_name)
-        saved_history = history_manager.load_history()
-        if saved_history:
-            history.history = saved_history
-        
-        active_sessions[chat_name] = {
-            "history": history,
-            "history_manager": history_manager,
-            "namespace": namespace,
-            "chat_manager": chat_manager,
-            "system_instructions": system_instructions
-        }
-        set_namespace(namespace)
+        session = open_session(chat_name, chat_manager, namespace, system_instructions)
+    elif SHARED_STORAGE:
+        # Another worker may have added turns to this chat since it was loaded here
+        history = session["history"]
+        if history.store.turn_count() > len(history):
+            history.load_recent(HISTORY_RESIDENT_TURNS)
+    
+    return session
+
+def search_lexical(session, query):
+    """BM25 scores for the query, indexing any turns the chat's lexical index has not seen yet"""
+    with span("lexical_search"):
+        index = session["lexical_index"]
+        index.sync(session["history"])
+        return index.search(query, LEXICAL_TOP_K, LEXICAL_MIN_SCORE)
+
+def build_context(session, use_full_context, similarity_scores, indexed_up_to=None, token_budget=None, lexical_scores=None,
+                  summaries=()):
+    """Select the turns to send to the LLM and render them as a prompt.
     
-    session = active_sessions[chat_name]
+    Turns newer than indexed_up_to are not in the vector index yet, so they are
+    included by recency instead of by similarity. Turns above the similarity
+    threshold and the BM25 hits are candidates, ranked by reciprocal rank fusion
+    and packed into token_budget; overflow turns are truncated or dropped.
+    Each of the given summaries stands in for the retrieved turns it covers;
+    only the pinned recent turns are never replaced.
+    Returns (context_turns, relevant_turn_ids, similarity_scores, history_prompt, context_usage).
+    """
     history = session["history"]
-    history_manager = session["history_manager"]
-    chat_manager = session["chat_manager"]
-    system_instructions = session.get("system_instructions")
+    context = session["context"]
     
-    set_namespace(session["namespace"])
+    if use_full_context:
+        # Use all history, keeping the newest turns when the budget runs out
+        with context.lock:
+            tokens, truncated_ids, dropped_ids = context.pack(history.all_turns(), token_budget=token_budget)
+            context_turns_list = context.turns()
+            history_prompt = context.to_prompt()
+        context_usage = {"tokens": tokens, "truncated_turn_ids": truncated_ids, "dropped_turn_ids": dropped_ids}
+        return context_turns_list, [turn.id for turn in context_turns_list], {}, history_prompt, context_usage
     
-    # Build context
-    context = LLMContext()
-    context_turns_list = []
-    relevant_turn_ids = []
-    similarity_scores = {}
+    # Always include the immediate last turn if history exists
+    always_include = set()
+    if history.last_turn():
+        always_include.add(history.last_turn().id)
     
-    if use_full_context:
-        # Use all history
-        for turn in history.history:
-            context.add(turn)
-            context_turns_list.append(turn)
-            relevant_turn_ids.append(turn["id"])
-    else:
-        # Query similar turns - get ALL similarity scores with no threshold filtering
-        relevant_turn_ids, similarity_scores = query_similar_turns(user_input, threshold=0.0, top_k=len(history.history) if len(history.history) > 0 else 10)
-        
-        # Store ALL similarity scores for visualization
-        session["last_similarity_scores"] = similarity_scores.copy()
-        
-        # Always include the immediate last turn if history exists
-        if len(history.history) > 0:
-            last_turn_id = history.history[-1]["id"]
-            if last_turn_id not in similarity_scores:
-                similarity_scores[last_turn_id] = 0.0
-        
-        # Filter by threshold for context building
-        threshold = float(os.getenv("SIMILARITY_THRESHOLD", "0.15"))
-        filtered_turn_ids = [tid for tid in similarity_scores.keys() if similarity_scores[tid] >= threshold or tid == (history.history[-1]["id"] if len(history.history) > 0 else -1)]
-        
-        # Deduplicate and sort
-        unique_turn_ids = list(dict.fromkeys(filtered_turn_ids))
-        unique_turn_ids.sort()
-        
-        for tid in unique_turn_ids:
-            # Handle both 0-based (old) and 1-based (new) turn IDs
-            if tid == 0:
-                # Old 0-based system
-                if tid < len(history.history):
-                    turn = history.history[tid]
-                    context.add(turn)
-                    context_turns_list.append(turn)
-            else:
-                # New 1-based system
-                if tid <= len(history.history):
-                    turn = history.history[tid - 1]
-                    context.add(turn)
-                    context_turns_list.append(turn)
-    
-    # Generate prompt and get response
-    history_prompt = context.to_prompt()
-    
-    # Add system instructions if present
+    # Fall back to recency for turns the indexing queue has not reached yet
+    if indexed_up_to is not None:
+        for turn in reversed(history.history):
+            if turn.id <= indexed_up_to:
+                break
+            always_include.add(turn.id)
+    
+    for tid in sorted(always_include):
+        if tid not in similarity_scores:
+            similarity_scores[tid] = 0.0
+    
+    # Filter by threshold for context building; lexical hits already passed LEXICAL_MIN_SCORE in search_lexical
+    lexical_scores = lexical_scores or {}
+    filtered_turn_ids = [tid for tid in similarity_scores.keys() if similarity_scores[tid] >= SIMILARITY_THRESHOLD or tid in always_include]
+    filtered_turn_ids += lexical_scores.keys()
+    
+    # Deduplicate and sort
+    unique_turn_ids = list(dict.fromkeys(filtered_turn_ids))
+    unique_turn_ids.sort()
+    
+    summary_prompt = ""
+    for summary in summaries:
+        rendered = render_summary(summary)
+        if token_budget is not None and estimate_tokens(summary_prompt + rendered) > token_budget:
+            continue
+        summary_prompt += rendered
+        unique_turn_ids = [
+            tid for tid in unique_turn_ids
+            if tid in always_include or not summary.covers(tid)
+        ]
+    summary_tokens = estimate_tokens(summary_prompt) if summary_prompt else 0
+    if token_budget is not None:
+        token_budget -= summary_tokens
+    
+    # Lookups are by id, so old 0-based and new 1-based turn IDs both resolve
+    candidate_turns = history.get_turns(unique_turn_ids)
+    with context.lock:
+        tokens, truncated_ids, dropped_ids = context.pack(
+            candidate_turns, reciprocal_rank_fusion(similarity_scores, lexical_scores), token_budget, pinned_ids=always_include
+        )
+        context_turns_list = context.turns()
+        history_prompt = summary_prompt + context.to_prompt()
+    context_usage = {"tokens": tokens + summary_tokens, "truncated_turn_ids": truncated_ids, "dropped_turn_ids": dropped_ids}
+    
+    relevant_turn_ids = list(dict.fromkeys([*similarity_scores.keys(), *lexical_scores.keys()]))
+    return context_turns_list, relevant_turn_ids, similarity_scores, history_prompt, context_usage
+
+def build_prompt(system_instructions, history_prompt, user_input):
+    """Assemble the final prompt from system instructions, context and the new message"""
     if system_instructions:
-        full_prompt = f"System Instructions: {system_instructions}\n\n{history_prompt}User: {user_input}\nAssistant: "
-    else:
-        full_prompt = history_prompt + f"User: {user_input}\nAssistant: "
+        return f"System Instructions: {system_instructions}\n\n{history_prompt}User: {user_input}\nAssistant: "
+    return history_prompt + f"User: {user_input}\nAssistant: "
+
+def context_token_budget(system_instructions, user_input):
+    """Tokens left for context turns once the rest of the prompt is accounted for"""
+    if CONTEXT_TOKEN_BUDGET <= 0:
+        return None
+    return max(CONTEXT_TOKEN_BUDGET - estimate_tokens(build_prompt(system_instructions, "", user_input)), 0)
+
+def token_usage(system_instructions, user_input, context_usage):
+    """Estimated prompt tokens per section"""
+    system_tokens = estimate_tokens(f"System Instructions: {system_instructions}\n\n") if system_instructions else 0
+    message_tokens = estimate_tokens(f"User: {user_input}\nAssistant: ")
+    return {
+        "system": system_tokens,
+        "context": context_usage["tokens"],
+        "message": message_tokens,
+        "total": system_tokens + context_usage["tokens"] + message_tokens,
+        "budget": CONTEXT_TOKEN_BUDGET if CONTEXT_TOKEN_BUDGET > 0 else None,
+        "truncated_turn_ids": context_usage["truncated_turn_ids"],
+        "dropped_turn_ids": context_usage["dropped_turn_ids"]
+    }
+
+def service_error(error):
+    """503 for an upstream call that failed or was refused by its circuit breaker"""
+    headers = {"Retry-After": str(math.ceil(error.retry_after))} if error.retry_after else None
+    return HTTPException(status_code=503, detail=f"Upstream service unavailable ({error.service})", headers=headers)
+
+@asynccontextmanager
+async def chat_lock(chat_name):
+    """Hold the lock that orders all turns of one chat; different chats never wait on each other.
+    
+    Users are counted from before the acquire until the release, so the lock
+    is only forgotten once nobody holds or awaits it.
+    """
+    entry = chat_locks.get(chat_name)
+    if entry is None:
+        entry = chat_locks[chat_name] = ChatLock()
+    entry.users += 1
+    try:
+        async with entry.lock:
+            yield
+    finally:
+        entry.users -= 1
+        if entry.users == 0:
+            del chat_locks[chat_name]
+
+def claim_request(chat_name, idempotency_key):
+    """Return (future, owner) for a message request.
+    
+    The first request with a key owns it and must settle the future; retries
+    with the same key get owner=False and wait on the same future instead of
+    creating another turn. Requests without a key always own their work.
+    """
+    if not idempotency_key:
+        return None, True
+    key = content_key(chat_name, idempotency_key)
+    future = idempotent_requests.get(key)
+    if future is not None:
+        return future, False
+    future = asyncio.get_running_loop().create_future()
+    idempotent_requests.put(key, future)
+    return future, True
+
+def release_request(chat_name, idempotency_key, future, error):
+    """Fail an owned request so waiting retries see the error and later retries run again"""
+    if future is None or future.done():
+        return
+    idempotent_requests.pop(content_key(chat_name, idempotency_key))
+    if not isinstance(error, Exception):
+        # Cancelled, or its client went away: waiting retries fail rather than being cancelled too
+        error = HTTPException(status_code=503, detail="Original request was interrupted")
+    future.set_exception(error)
+    future.exception()  # Retrieved here so an unawaited failure is not logged
+
+def retrieval_top_k(turn_count, max_turns=TOP_K_RESULTS):
+    """Vectors to request for up to max_turns turns; each turn has a user and an llm vector"""
+    return 2 * max(1, min(max_turns, turn_count))
+
+async def retrieve_summaries(session, user_input):
+    """Summaries of older turns relevant to the message, none while the chat has no summaries"""
+    summaries = await asyncio.to_thread(summarizer.summaries, session["chat_name"], session["namespace"])
+    if not summaries:
+        return []
+    try:
+        # Runs after the turn query, so the query embedding is already cached
+        scores = await asyncio.wait_for(
+            query_similar_summaries_async(user_input, SIMILARITY_THRESHOLD, 4 * SUMMARY_TOP_K, namespace=session["namespace"]),
+            VECTOR_QUERY_TIMEOUT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        return []
+    return select_summaries(summaries, scores)
+
+async def retrieve_similar(session, text):
+    """Vector similarity scores and matching summaries for a message.
+
+    Raises RetrievalUnavailable or asyncio.TimeoutError if the turn query fails or is slow.
+    """
+    _, similarity_scores = await asyncio.wait_for(
+        query_similar_turns_async(
+            text, threshold=SIMILARITY_THRESHOLD, top_k=retrieval_top_k(len(session["history"])),
+            namespace=session["namespace"], raise_errors=True
+        ),
+        VECTOR_QUERY_TIMEOUT_SECONDS
+    )
+    return similarity_scores, await retrieve_summaries(session, text)
+
+def normalize_draft(text):
+    return " ".join(text.lower().split())
+
+def drafts_match(draft, message):
+    """Whether retrieval for the draft can stand in for retrieval for the message"""
+    if draft == message:
+        return True
+    matcher = difflib.SequenceMatcher(None, draft, message, autojunk=False)
+    return (
+        matcher.real_quick_ratio() >= PREFETCH_MATCH_RATIO
+        and matcher.quick_ratio() >= PREFETCH_MATCH_RATIO
+        and matcher.ratio() >= PREFETCH_MATCH_RATIO
+    )
+
+def discard_prefetch(prefetch):
+    prefetch["task"].cancel()
+    prefetch_counts["misses"] += 1
+
+def take_prefetch(session, user_input):
+    """Claim the session's prefetch if it was made for this message; each prefetch is used at most once"""
+    prefetch = session.get("prefetch")
+    if prefetch is None:
+        return None
+    session["prefetch"] = None
+    expired = time.monotonic() - prefetch["started"] > PREFETCH_TTL_SECONDS
+    if expired or not drafts_match(prefetch["draft"], normalize_draft(user_input)):
+        discard_prefetch(prefetch)
+        return None
+    prefetch_counts["hits"] += 1
+    return prefetch
+
+async def prepare_turn(session, user_input, use_full_context):
+    """Retrieve similar turns and build the prompt; runs under the chat lock"""
+    chat_name = session["chat_name"]
+    system_instructions = session.get("system_instructions")
     
-    reply = ask_llm(full_prompt)
+    similarity_scores = {}
+    lexical_scores = {}
+    summaries = []
+    retrieval = "full"
+    prefetch = None
+    if not use_full_context:
+        # Query the best turns above the threshold while the BM25 index is searched in parallel,
+        # unless the same query already started from the draft
+        session["last_query"] = user_input
+        session["last_similarity_scores"] = None
+        prefetch = take_prefetch(session, user_input)
+        if prefetch is not None:
+            vector_query = prefetch["task"]
+        else:
+            vector_query = asyncio.ensure_future(retrieve_similar(session, user_input))
+        lexical_scores = await asyncio.to_thread(search_lexical, session, user_input)
+        try:
+            similarity_scores, summaries = await vector_query
+            retrieval = "hybrid"
+        except (RetrievalUnavailable, asyncio.TimeoutError):
+            # Degrade to lexical retrieval rather than making the user wait
+            retrieval = "lexical"
+    elif session.get("prefetch") is not None:
+        discard_prefetch(session["prefetch"])
+        session["prefetch"] = None
     
-    # Save turn
-    current_turn_id = history.add_turn(user_input, reply)
-    chat_manager.update_message_count(chat_name)
+    # Build context and generate prompt
+    indexed_up_to = indexing_queue.watermark(chat_name)
+    if prefetch is not None and (indexed_up_to is None or prefetch["indexed_up_to"] < indexed_up_to):
+        # Turns indexed after the prefetched query ran are included by recency instead
+        indexed_up_to = prefetch["indexed_up_to"]
+    token_budget = context_token_budget(system_instructions, user_input)
+    with span("context_build"):
+        context_turns_list, relevant_turn_ids, similarity_scores, history_prompt, context_usage = await asyncio.to_thread(
+            build_context, session, use_full_context, similarity_scores, indexed_up_to, token_budget, lexical_scores, summaries
+        )
+    return {
+        "prompt": build_prompt(system_instructions, history_prompt, user_input),
+        "context_turns": turns_to_dicts(context_turns_list),
+        "relevant_turn_ids": relevant_turn_ids,
+        "similarity_scores": similarity_scores,
+        "lexical_scores": lexical_scores,
+        "retrieval": retrieval,
+        "summaries": [summary.to_dict() for summary in summaries],
+        "token_usage": token_usage(system_instructions, user_input, context_usage)
+    }
+
+async def finish_turn(session, user_input, reply, prepared):
+    """Record a completed turn and queue it for indexing; runs under the chat lock"""
+    chat_name = session["chat_name"]
+    history = session["history"]
+    if SHARED_STORAGE:
+        # Chat locks are per process, so the id comes from the shared database instead of the local history
+        current_turn_id = await asyncio.to_thread(history.add_stored_turn, user_input, reply, HISTORY_RESIDENT_TURNS)
+    else:
+        current_turn_id = history.add_turn(user_input, reply)
+    turn = history.get_turns([current_turn_id])[0]
+    await asyncio.to_thread(session["chat_manager"].update_message_count, chat_name)
     
-    # Upsert to Pinecone
-    upsert_message(f"{current_turn_id}_u", user_input, current_turn_id, "user")
-    upsert_message(f"{current_turn_id}_l", reply, current_turn_id, "llm")
+    # Upsert to Pinecone and save history in the background
+    await indexing_queue.submit_async(chat_name, session["namespace"], turn, session["history_manager"])
+    summarizer.submit(chat_name, session["namespace"], session["history_manager"])
+    # Bound memory: older turns are read back from storage on demand once they are indexed
+    history.trim(HISTORY_RESIDENT_TURNS, keep_after=indexing_queue.watermark(chat_name))
     
-    # Save history
-    history_manager.save_history(history.history)
+    # History delta for WebSocket clients watching this chat
+    if hub.has_subscribers(chat_name):
+        hub.publish(chat_name, {"type": "turn", "chat_name": chat_name, "turn": turn.to_dict()})
+        if session.get("last_query") == user_input:
+            run_in_background(push_similarities(session))
     
     return {
         "turn_id": current_turn_id,
         "user_message": user_input,
         "assistant_message": reply,
-        "context_turns": context_turns_list,
-        "relevant_turn_ids": list(similarity_scores.keys()) if not use_full_context else relevant_turn_ids,
-        "similarity_scores": similarity_scores if not use_full_context else {}
+        "context_turns": prepared["context_turns"],
+        "relevant_turn_ids": prepared["relevant_turn_ids"],
+        "similarity_scores": prepared["similarity_scores"],
+        "lexical_scores": prepared["lexical_scores"],
+        "retrieval": prepared["retrieval"],
+        "summaries": prepared["summaries"],
+        "token_usage": prepared["token_usage"]
     }
 
-@app.post("/message/stream")
-async def send_message_stream(request: MessageRequest):
-    """Send a message and get streaming response"""
+def stream_metadata(result):
+    """The metadata event of a streamed reply"""
+    return {
+        "type": "metadata",
+        "context_turns": [{"id": t["id"], "user": t["user"]["text"], "assistant": t["llm"]["text"]} for t in result["context_turns"]],
+        "relevant_turn_ids": result["relevant_turn_ids"],
+        "similarity_scores": result["similarity_scores"],
+        "lexical_scores": result["lexical_scores"],
+        "retrieval": result["retrieval"],
+        "summaries": result["summaries"],
+        "token_usage": result["token_usage"]
+    }
+
+async def replay_events(future):
+    """Answer a retried stream request with the original request's result"""
+    try:
+        result = await asyncio.shield(future)
+    except HTTPException as e:
+        yield {"type": "error", "detail": e.detail}
+        return
+    except Exception:
+        yield {"type": "error", "detail": "Original request failed"}
+        return
+    yield stream_metadata(result)
+    yield {"type": "chunk", "text": result["assistant_message"]}
+    yield {"type": "done", "turn_id": result["turn_id"]}
+
+async def sse(events):
+    """Server-sent event framing for stream events"""
+    async for event in events:
+        yield f"data: {json.dumps(event)}\n\n"
+
+@app.post("/message", response_model=MessageResponse)
+async def send_message(request: MessageRequest, response: Response):
+    """Send a message and get response"""
+    start = time.perf_counter()
+    metrics.start_request()
     chat_name = request.chat_name
     user_input = request.message.strip()
     use_full_context = request.use_full_context
@@ -250,165 +643,468 @@ async def send_message_stream(request: MessageRequest):
     if not user_input:
         raise HTTPException(status_code=400, detail="Message cannot be empty")
     
-    # Get or create session
-    if chat_name not in active_sessions:
-        chat_manager = ChatManager()
-        if not chat_manager.chat_exists(chat_name):
-            raise HTTPException(status_code=404, detail="Chat not found")
-        
-        namespace = chat_manager.get_namespace(chat_name)
-        system_instructions = chat_manager.get_system_instructions(chat_name)
-        history = MainHistory()
-        history_manager = HistoryManager(chat_name)
-        saved_history = history_manager.load_history()
-        if saved_history:
-            history.history = saved_history
-        
-        active_sessions[chat_name] = {
-            "history": history,
-            "history_manager": history_manager,
-            "namespace": namespace,
-            "chat_manager": chat_manager,
-            "system_instructions": system_instructions
-        }
-        set_namespace(namespace)
+    future, owner = claim_request(chat_name, request.idempotency_key)
+    if not owner:
+        return await asyncio.shield(future)
     
-    session = active_sessions[chat_name]
-    history = session["history"]
-    history_manager = session["history_manager"]
-    chat_manager = session["chat_manager"]
-    system_instructions = session.get("system_instructions")
+    try:
+        # Turns of one chat are handled strictly in order
+        async with chat_lock(chat_name):
+            with span("session_load"):
+                session = await asyncio.to_thread(load_session, chat_name)
+            prepared = await prepare_turn(session, user_input, use_full_context)
+            try:
+                reply = await ask_llm_async(prepared["prompt"])
+            except ServiceUnavailable as e:
+                # No turn is recorded, so the client can simply retry
+                raise service_error(e) from e
+            result = await finish_turn(session, user_input, reply, prepared)
+    except BaseException as e:
+        release_request(chat_name, request.idempotency_key, future, e)
+        raise
     
-    set_namespace(session["namespace"])
+    if future is not None:
+        future.set_result(result)
+    timings = metrics.finish_request("/message", start)
+    if timings is not None:
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return result
+
+async def open_turn_stream(request, endpoint):
+    """Check the request, then return the events of the streamed reply.
     
-    # Build context
-    context = LLMContext()
-    context_turns_list = []
-    relevant_turn_ids = []
-    similarity_scores = {}
+    Raises HTTPException before anything is streamed, so an empty message or
+    unknown chat is reported as such rather than as a broken stream. The
+    request is only claimed once the stream is consumed, so a stream that
+    never starts leaves no idempotency entry for retries to wait on.
+    """
+    start = time.perf_counter()
+    timings = metrics.start_request()
+    chat_name = request.chat_name
+    user_input = request.message.strip()
+    use_full_context = request.use_full_context
     
-    if use_full_context:
-        for turn in history.history:
-            context.add(turn)
-            context_turns_list.append(turn)
-            relevant_turn_ids.append(turn["id"])
-    else:
-        # Query similar turns - get ALL similarity scores with no threshold filtering
-        relevant_turn_ids, similarity_scores = query_similar_turns(user_input, threshold=0.0, top_k=len(history.history) if len(history.history) > 0 else 10)
-        
-        # Store ALL similarity scores for visualization
-        session["last_similarity_scores"] = similarity_scores.copy()
-        
-        # Always include the immediate last turn if history exists
-        if len(history.history) > 0:
-            last_turn_id = history.history[-1]["id"]
-            if last_turn_id not in similarity_scores:
-                similarity_scores[last_turn_id] = 0.0
-        
-        # Filter by threshold for context building
-        threshold = float(os.getenv("SIMILARITY_THRESHOLD", "0.15"))
-        filtered_turn_ids = [tid for tid in similarity_scores.keys() if similarity_scores[tid] >= threshold or tid == (history.history[-1]["id"] if len(history.history) > 0 else -1)]
-        
-        # Deduplicate and sort
-        unique_turn_ids = list(dict.fromkeys(filtered_turn_ids))
-        unique_turn_ids.sort()
-        
-        for tid in unique_turn_ids:
-            if tid <= len(history.history):
-                turn = history.history[tid - 1]
-                context.add(turn)
-                context_turns_list.append(turn)
-    
-    # Generate prompt
-    history_prompt = context.to_prompt()
-    if system_instructions:
-        full_prompt = f"System Instructions: {system_instructions}\n\n{history_prompt}User: {user_input}\nAssistant: "
-    else:
-        full_prompt = history_prompt + f"User: {user_input}\nAssistant: "
+    if not user_input:
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+    if not await asyncio.to_thread(get_chat_manager().chat_exists, chat_name):
+        raise HTTPException(status_code=404, detail="Chat not found")
     
     # Stream response
-    async def generate():
-        full_response = ""
-        
-        # Send metadata first
-        metadata = {
-            "type": "metadata",
-            "context_turns": [{"id": t["id"], "user": t["user"]["text"], "assistant": t["llm"]["text"]} for t in context_turns_list],
-            "relevant_turn_ids": list(similarity_scores.keys()) if not use_full_context else relevant_turn_ids,
-            "similarity_scores": similarity_scores if not use_full_context else {}
-        }
-        yield f"data: {json.dumps(metadata)}\n\n"
-        
-        # Stream LLM response
-        for chunk in ask_llm_stream(full_prompt):
-            full_response += chunk
-            yield f"data: {json.dumps({'type': 'chunk', 'text': chunk})}\n\n"
-            await asyncio.sleep(0)  # Allow other tasks to run
+    async def events():
+        # The body runs in whichever task consumes the stream; keep adding to this request's timings
+        metrics.request_timings.set(timings)
+        future, owner = claim_request(chat_name, request.idempotency_key)
+        if not owner:
+            async for event in replay_events(future):
+                yield event
+            return
         
-        # Save turn after streaming completes
-        current_turn_id = history.add_turn(user_input, full_response)
-        chat_manager.update_message_count(chat_name)
-        
-        # Upsert to Pinecone
-        upsert_message(f"{current_turn_id}_u", user_input, current_turn_id, "user")
-        upsert_message(f"{current_turn_id}_l", full_response, current_turn_id, "llm")
-        
-        # Save history
-        history_manager.save_history(history.history)
+        error = None
+        try:
+            # Turns of one chat are handled strictly in order; the session is loaded
+            # under the same hold, so no other request changes it in between
+            async with chat_lock(chat_name):
+                try:
+                    with span("session_load"):
+                        session = await asyncio.to_thread(load_session, chat_name)
+                except HTTPException as e:
+                    # The chat was deleted after the request was checked
+                    release_request(chat_name, request.idempotency_key, future, e)
+                    yield {"type": "error", "detail": e.detail}
+                    return
+                prepared = await prepare_turn(session, user_input, use_full_context)
+                
+                # Send metadata first
+                yield stream_metadata(prepared)
+                
+                # Stream LLM response
+                full_response = ""
+                try:
+                    async for chunk in ask_llm_stream_async(prepared["prompt"]):
+                        full_response += chunk
+                        yield {"type": "chunk", "text": chunk}
+                except ServiceUnavailable as e:
+                    # No turn is recorded, so the client can simply retry
+                    error = service_error(e)
+                    release_request(chat_name, request.idempotency_key, future, error)
+                    yield {"type": "error", "detail": error.detail}
+                    return
+                
+                # Save turn after streaming completes
+                result = await finish_turn(session, user_input, full_response, prepared)
+            if future is not None:
+                future.set_result(result)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # However the stream ends, including cancellation or a client that went
+            # away mid-stream, the claim is settled; a no-op once it has a result
+            release_request(chat_name, request.idempotency_key, future, error)
         
         # Send completion
-        yield f"data: {json.dumps({'type': 'done', 'turn_id': current_turn_id})}\n\n"
+        done = {"type": "done", "turn_id": result["turn_id"]}
+        stream_timings = metrics.finish_request(endpoint, start)
+        if stream_timings is not None:
+            done["timings"] = stream_timings
+        yield done
+    
+    return events()
+
+@app.post("/message/stream")
+async def send_message_stream(request: MessageRequest):
+    """Send a message and get streaming response"""
+    events = await open_turn_stream(request, "/message/stream")
+    return StreamingResponse(sse(events), media_type="text/event-stream")
+
+@app.post("/prefetch")
+async def prefetch_retrieval(request: PrefetchRequest):
+    """Start retrieval for a draft so sending it does not wait on the embedding and vector query"""
+    draft = normalize_draft(request.draft)
+    if not PREFETCH_ENABLED or len(draft) < PREFETCH_MIN_CHARS:
+        return {"status": "skipped"}
+    # Only chats that are already open; a prefetch never loads a session from disk
+    session = active_sessions.get(request.chat_name)
+    if session is None:
+        return {"status": "skipped"}
+    prefetch = session.get("prefetch")
+    if prefetch is not None:
+        if prefetch["draft"] == draft and time.monotonic() - prefetch["started"] <= PREFETCH_TTL_SECONDS:
+            return {"status": "running" if not prefetch["task"].done() else "ready"}
+        discard_prefetch(prefetch)
     
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    indexed_up_to = indexing_queue.watermark(request.chat_name)
+    task = asyncio.ensure_future(retrieve_similar(session, draft))
+    # A prefetch nobody uses may fail unobserved
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    session["prefetch"] = {
+        "draft": draft,
+        "task": task,
+        "started": time.monotonic(),
+        "indexed_up_to": indexed_up_to if indexed_up_to is not None else 0
+    }
+    prefetch_counts["requests"] += 1
+    return {"status": "started"}
 
 @app.get("/chat/{chat_name}/history")
-def get_chat_history(chat_name: str):
-    """Get full conversation history for a chat"""
-    if chat_name in active_sessions:
-        history = active_sessions[chat_name]["history"]
-        return {"history": history.history}
+def get_chat_history(chat_name: str, before: Optional[int] = None, limit: Optional[int] = None):
+    """Get conversation history for a chat.
+    
+    Without `limit` the full history is returned. With `limit`, returns that many
+    turns preceding turn id `before` (or the newest turns) plus a `next_cursor`
+    to pass as `before` for the next older page.
+    """
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    
+    session = active_sessions.get(chat_name)
+    if session is not None:
+        history = session["history"]
+        if limit is None:
+            return {"history": turns_to_dicts(history.all_turns()), "next_cursor": None, "total_turns": len(history)}
+        turns, next_cursor = history.page(before, limit)
+        return {"history": turns_to_dicts(turns), "next_cursor": next_cursor, "total_turns": len(history)}
     
     # Load from file
-    history_manager = HistoryManager(chat_name)
-    saved_history = history_manager.load_history()
-    return {"history": saved_history}
+    history_manager = get_history_manager(chat_name)
+    if limit is None:
+        saved_history = history_manager.load_history()
+        return {"history": turns_to_dicts(saved_history), "next_cursor": None, "total_turns": len(saved_history)}
+    turns, next_cursor = history_manager.load_page(before, limit)
+    return {"history": turns_to_dicts(turns), "next_cursor": next_cursor, "total_turns": history_manager.turn_count()}
 
 @app.get("/chat/{chat_name}/last_similarities")
-def get_last_similarities(chat_name: str):
+async def get_last_similarities(chat_name: str):
     """Get similarity scores from the last query for visualization"""
-    if chat_name not in active_sessions:
+    session = active_sessions.get(chat_name)
+    if session is None:
         raise HTTPException(status_code=404, detail="Chat session not found. Send a message first.")
+    return {"similarity_scores": await last_similarities(session)}
+
+async def last_similarities(session):
+    """Scores of every turn against the chat's last query"""
+    # Scoring every turn is only needed for visualization, so it is done on request against the local
+    # similarity graph and kept until the next message; the query embedding is cached from retrieval
+    query = session.get("last_query")
+    if query is None:
+        return {}
+    if session.get("last_similarity_scores") is None:
+        vector = await asyncio.to_thread(embed_text, query, "query")
+        if vector is None:
+            return {}
+        similarity_scores = await asyncio.to_thread(
+            similarity_service.read, session["namespace"], session["history_manager"],
+            lambda graph: graph.query_scores(vector)
+        ) or {}
+        if session.get("last_query") is query:
+            session["last_similarity_scores"] = similarity_scores
+        return similarity_scores
+    return session["last_similarity_scores"]
+
+async def push_similarities(session):
+    """Send the latest full similarity scores to the chat's WebSocket watchers"""
+    chat_name = session["chat_name"]
+    hub.publish(chat_name, {"type": "similarities", "chat_name": chat_name, "similarity_scores": await last_similarities(session)})
+
+def read_similarity_graph(chat_name, reader):
+    """Run reader(graph) on a chat's similarity graph; None if the chat has no turns yet"""
+    chat_manager = get_chat_manager()
+    if not chat_manager.chat_exists(chat_name):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    session = active_sessions.get(chat_name)
+    history_manager = session["history_manager"] if session is not None else get_history_manager(chat_name)
+    return similarity_service.read(chat_manager.get_namespace(chat_name), history_manager, reader)
+
+def turn_similarity(chat_name, turn_id, k=None):
+    """Scores of every turn against one turn, plus its nearest turns"""
+    if k is not None and k <= 0:
+        raise HTTPException(status_code=400, detail="k must be positive")
     
-    similarity_scores = active_sessions[chat_name].get("last_similarity_scores", {})
+    def reader(graph):
+        if turn_id not in graph.rows:
+            return None
+        return {
+            "turn_id": turn_id,
+            "similarity_scores": graph.row(turn_id),
+            "neighbors": [{"turn_id": tid, "score": score} for tid, score in graph.neighbors(turn_id, k)]
+        }
     
-    return {"similarity_scores": similarity_scores}
+    result = read_similarity_graph(chat_name, reader)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Turn not found")
+    return result
+
+@app.get("/chat/{chat_name}/similarity/{turn_id}")
+def get_turn_similarity(chat_name: str, turn_id: int, k: Optional[int] = None):
+    """Similarity of one turn to every other turn, from the local similarity graph"""
+    return turn_similarity(chat_name, turn_id, k)
+
+@app.get("/chat/{chat_name}/similarity_matrix")
+def get_similarity_matrix(chat_name: str, limit: int = SIMILARITY_MATRIX_MAX_TURNS):
+    """Turn-by-turn similarity matrix of the newest `limit` turns"""
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    limit = min(limit, SIMILARITY_MATRIX_MAX_TURNS)
+    result = read_similarity_graph(chat_name, lambda graph: graph.matrix(limit))
+    turn_ids, matrix = result if result is not None else ([], [])
+    return {"turn_ids": turn_ids, "matrix": matrix}
+
+@app.get("/chat/{chat_name}/similarity_clusters")
+def get_similarity_clusters(chat_name: str, threshold: float = SIMILARITY_CLUSTER_THRESHOLD):
+    """Groups of turns linked by neighbor scores of at least `threshold`"""
+    return {"clusters": read_similarity_graph(chat_name, lambda graph: graph.clusters(threshold)) or []}
+
+@app.get("/chat/{chat_name}/index_status")
+def get_index_status(chat_name: str):
+    """Report how far background indexing has progressed for a chat"""
+    status = indexing_queue.status(chat_name)
+    session = active_sessions.get(chat_name)
+    if session is not None:
+        status["turn_count"] = len(session["history"])
+    return status
+
+@app.post("/chat/{chat_name}/reindex")
+def reindex_chat(chat_name: str):
+    """Re-embed and upsert every turn of a chat in batched calls"""
+    chat_manager = get_chat_manager()
+    if not chat_manager.chat_exists(chat_name):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    session = active_sessions.get(chat_name)
+    if session is not None:
+        history_list = session["history"].all_turns()
+    else:
+        wait_for_flush(chat_name)
+        history_list = get_history_manager(chat_name).load_history()
+    
+    namespace = chat_manager.get_namespace(chat_name)
+    if not upsert_turns(history_list, namespace=namespace):
+        raise HTTPException(status_code=502, detail="Failed to index chat history")
+    # Rebuilt from the re-embedded turns on the next read
+    similarity_service.forget(namespace)
+    if history_list:
+        indexing_queue.set_watermark(chat_name, history_list[-1].id)
+    
+    return {"message": f"Reindexed {len(history_list)} turns", "turn_count": len(history_list)}
 
 @app.delete("/chat/{chat_name}")
-def delete_chat(chat_name: str):
+async def delete_chat(chat_name: str):
     """Delete a chat"""
-    from pinecone_utils import delete_namespace
-    
-    chat_manager = ChatManager()
+    # Wait for an in-flight turn of this chat instead of deleting under it
+    async with chat_lock(chat_name):
+        return await asyncio.to_thread(remove_chat, chat_name)
+
+def remove_chat(chat_name):
+    """Delete a chat's history, metadata, session and vectors"""
+    chat_manager = get_chat_manager()
     
     if not chat_manager.chat_exists(chat_name):
         raise HTTPException(status_code=404, detail="Chat not found")
+    namespace = chat_manager.get_chat(chat_name)["namespace"]
+    
+    # Drop queued indexing and summarization work before removing the files it would read or write
+    wait_for_flush(chat_name)
+    indexing_queue.forget(chat_name)
+    summarizer.forget(chat_name, namespace)
+    similarity_service.forget(namespace)
     
     # Delete history file
-    history_manager = HistoryManager(chat_name)
+    history_manager = get_history_manager(chat_name)
     history_manager.delete_history()
+    forget_history_manager(chat_name)
     
     # Delete from chat manager
     chat_manager.delete_chat(chat_name)
     
     # Remove from active sessions
-    if chat_name in active_sessions:
-        del active_sessions[chat_name]
+    active_sessions.pop(chat_name)
     
-    # Delete Pinecone namespace
-    delete_namespace(chat_name)
+    # Delete the chat's vector namespace (not the raw chat name)
+    delete_namespace(namespace)
+    delete_namespace(summary_namespace(namespace))
     
     return {"message": f"Chat '{chat_name}' deleted successfully"}
 
+def socket_error(request_id, status, detail):
+    return {"id": request_id, "type": "error", "status": status, "detail": detail}
+
+async def stream_to_socket(connection, request_id, request):
+    """Stream a reply as frames tagged with the request id"""
+    try:
+        events = await open_turn_stream(request, "/ws")
+    except HTTPException as e:
+        await connection.send(socket_error(request_id, e.status_code, e.detail))
+        return
+    except Exception as e:
+        print(f"Error starting reply: {e}")
+        await connection.send(socket_error(request_id, 500, "Reply failed"))
+        return
+    try:
+        async for event in events:
+            # Waits while the client is behind, which in turn stops the LLM stream from being read
+            await connection.send({"id": request_id, **event})
+    except HTTPException as e:
+        await connection.send(socket_error(request_id, e.status_code, e.detail))
+    except Exception as e:
+        print(f"Error streaming reply: {e}")
+        await connection.send(socket_error(request_id, 500, "Reply failed"))
+    finally:
+        await events.aclose()
+
+async def answer_socket_request(connection, request_id, op, payload):
+    """Answer a request frame with one result frame"""
+    try:
+        if op == "prefetch":
+            data = await prefetch_retrieval(PrefetchRequest(**payload))
+        elif op == "history":
+            data = await asyncio.to_thread(
+                get_chat_history, payload["chat_name"], payload.get("before"), payload.get("limit")
+            )
+        elif op == "similarities":
+            data = await get_last_similarities(payload["chat_name"])
+        elif op == "turn_similarity":
+            data = await asyncio.to_thread(
+                turn_similarity, payload["chat_name"], int(payload["turn_id"]),
+                int(payload["k"]) if payload.get("k") is not None else None
+            )
+        await connection.send({"id": request_id, "type": "result", "data": data})
+    except HTTPException as e:
+        await connection.send(socket_error(request_id, e.status_code, e.detail))
+    except (KeyError, TypeError, ValueError, ValidationError) as e:
+        await connection.send(socket_error(request_id, 400, f"Invalid {op} request: {e}"))
+    except ServiceUnavailable as e:
+        error = service_error(e)
+        await connection.send(socket_error(request_id, error.status_code, error.detail))
+    except Exception as e:
+        # Every request gets an answer, or the client would wait on it until the socket closes
+        print(f"Error answering {op} request: {e}")
+        await connection.send(socket_error(request_id, 500, f"{op} request failed"))
+
+async def handle_socket_frame(connection, frame):
+    op = frame.get("op")
+    request_id = frame.get("id")
+    payload = {key: value for key, value in frame.items() if key not in ("op", "id")}
+    
+    if op in ("subscribe", "unsubscribe"):
+        chat_name = payload.get("chat_name")
+        if not isinstance(chat_name, str):
+            await connection.send(socket_error(request_id, 400, f"Invalid {op} request: chat_name is required"))
+        elif op == "subscribe":
+            hub.subscribe(connection, chat_name)
+        else:
+            hub.unsubscribe(connection, chat_name)
+        return
+    if op == "cancel":
+        connection.cancel(request_id)
+        return
+    if op not in ("send", "prefetch", "history", "similarities", "turn_similarity"):
+        await connection.send(socket_error(request_id, 400, f"Unknown op: {op}"))
+        return
+    if request_id is None or request_id in connection.tasks:
+        await connection.send(socket_error(request_id, 400, "Each request needs an id not already in flight"))
+        return
+    if len(connection.tasks) >= WS_MAX_IN_FLIGHT:
+        await connection.send(socket_error(request_id, 429, f"At most {WS_MAX_IN_FLIGHT} requests in flight per connection"))
+        return
+    
+    if op == "send":
+        try:
+            request = MessageRequest(**payload)
+        except ValidationError as e:
+            await connection.send(socket_error(request_id, 400, f"Invalid send request: {e}"))
+            return
+        connection.start(request_id, stream_to_socket(connection, request_id, request))
+    else:
+        connection.start(request_id, answer_socket_request(connection, request_id, op, payload))
+
+def socket_origin_allowed(websocket: WebSocket):
+    """Whether a socket's Origin is an allowed origin or the host the page was served from.
+    
+    Behind the frontend's /api rewrite the original host arrives as X-Forwarded-Host.
+    """
+    origin = websocket.headers.get("origin")
+    if origin is None or origin in ALLOWED_ORIGINS:
+        return True
+    host = websocket.headers.get("x-forwarded-host") or websocket.headers.get("host")
+    return urlparse(origin).netloc == host
+
+@app.websocket("/ws")
+async def chat_socket(websocket: WebSocket):
+    """One connection per client, multiplexing replies, requests and pushes for any number of chats.
+    
+    Client frames are JSON objects with an `op`:
+    - `send` (the fields of POST /message/stream), `prefetch`, `history`,
+      `similarities` and `turn_similarity` carry an `id` that every frame of the answer repeats;
+      `cancel` stops the request with that `id`
+    - `subscribe` / `unsubscribe` a `chat_name`: watched chats get `turn` frames
+      for every new turn and `similarities` frames with the latest full scores
+    """
+    await websocket.accept()
+    if not socket_origin_allowed(websocket):
+        # Closed after the handshake so the browser sees 1008 and stops reconnecting
+        await websocket.close(code=1008, reason="Origin not allowed")
+        return
+    
+    connection = Connection(websocket)
+    hub.connect(connection)
+    writer = asyncio.create_task(connection.run_writer())
+    try:
+        while True:
+            try:
+                frame = json.loads(await websocket.receive_text())
+            except ValueError:
+                frame = None
+            if not isinstance(frame, dict):
+                await connection.send(socket_error(None, 400, "Frames must be JSON objects"))
+                continue
+            await handle_socket_frame(connection, frame)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        connection.cancel_all()
+        hub.drop(connection)
+        writer.cancel()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
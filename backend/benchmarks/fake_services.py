@@ -0,0 +1,142 @@
+"""Local stand-ins for Gemini, Pinecone inference and the Pinecone index with configurable latency.
+
+install() must be called before anything imports api, llm or pinecone_utils:
+it sets a dummy Gemini key and the local vector backend so no client talks
+to the network, then swaps the clients for the fakes below.
+"""
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import time
+import types
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EMBED_DIMENSION = 256
+
+
+class Latency:
+    """Fixed delay plus uniform jitter, in milliseconds"""
+
+    def __init__(self, ms, jitter_ms=0.0):
+        self.ms = ms
+        self.jitter_ms = jitter_ms
+
+    def seconds(self):
+        return max(self.ms + random.uniform(-self.jitter_ms, self.jitter_ms), 0.0) / 1000
+
+    def sleep(self):
+        time.sleep(self.seconds())
+
+    async def sleep_async(self):
+        await asyncio.sleep(self.seconds())
+
+
+def fake_vector(text, dimension=EMBED_DIMENSION):
+    """Deterministic bag-of-words embedding, so similar texts get similar vectors"""
+    vector = np.zeros(dimension, dtype=np.float32)
+    for word in text.lower().split():
+        vector[int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little") % dimension] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+class FakeLLM:
+    """genai.Client look-alike: replies after time_to_first_token, then one chunk per chunk_interval"""
+
+    def __init__(self, time_to_first_token, chunk_interval, chunks=10):
+        self.time_to_first_token = time_to_first_token
+        self.chunk_interval = chunk_interval
+        self.chunks = chunks
+        self.models = types.SimpleNamespace(
+            generate_content=self.generate_content,
+            generate_content_stream=self.generate_content_stream
+        )
+        self.aio = types.SimpleNamespace(models=types.SimpleNamespace(
+            generate_content=self.generate_content_async,
+            generate_content_stream=self.generate_content_stream_async
+        ))
+
+    def reply_chunks(self, contents):
+        words = contents.split()[-self.chunks:]
+        return [f"{word} " for word in words] or ["ok"]
+
+    def generate_content(self, model, contents, config=None):
+        self.time_to_first_token.sleep()
+        chunks = self.reply_chunks(contents)
+        for _ in chunks[1:]:
+            self.chunk_interval.sleep()
+        return types.SimpleNamespace(text="".join(chunks))
+
+    def generate_content_stream(self, model, contents, config=None):
+        self.time_to_first_token.sleep()
+        for i, chunk in enumerate(self.reply_chunks(contents)):
+            if i:
+                self.chunk_interval.sleep()
+            yield types.SimpleNamespace(text=chunk)
+
+    async def generate_content_async(self, model, contents, config=None):
+        await self.time_to_first_token.sleep_async()
+        chunks = self.reply_chunks(contents)
+        for _ in chunks[1:]:
+            await self.chunk_interval.sleep_async()
+        return types.SimpleNamespace(text="".join(chunks))
+
+    async def generate_content_stream_async(self, model, contents, config=None):
+        async def stream():
+            await self.time_to_first_token.sleep_async()
+            for i, chunk in enumerate(self.reply_chunks(contents)):
+                if i:
+                    await self.chunk_interval.sleep_async()
+                yield types.SimpleNamespace(text=chunk)
+        return stream()
+
+
+class FakeEmbedder:
+    """Stand-in for pc.inference: one latency per embed call regardless of batch size"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def embed(self, model, inputs, parameters=None):
+        self.calls += 1
+        self.latency.sleep()
+        return types.SimpleNamespace(data=[types.SimpleNamespace(values=fake_vector(text)) for text in inputs])
+
+
+def install(llm_ttft_ms=200, llm_chunk_ms=20, llm_chunks=10, embed_ms=30, vector_ms=10, jitter=0.2, data_dir=None):
+    """Point the service modules at the fakes; returns the fake LLM and embedder"""
+    if data_dir is not None:
+        os.makedirs(data_dir, exist_ok=True)
+        os.chdir(data_dir)
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    os.environ["VECTOR_BACKEND"] = "local"
+    os.environ.setdefault("LOCAL_INDEX_DIR", "vector_data")
+
+    import llm
+    import pinecone_utils
+    from vector_store import LocalVectorStore
+
+    class LatencyVectorStore(LocalVectorStore):
+        """The local NumPy store with a network round trip added to every call"""
+
+        def upsert(self, vectors, namespace):
+            vector_latency.sleep()
+            super().upsert(vectors, namespace)
+
+        def query(self, vector, top_k, namespace, include_metadata=True, min_score=None):
+            vector_latency.sleep()
+            return super().query(vector, top_k, namespace, include_metadata, min_score)
+
+    vector_latency = Latency(vector_ms, vector_ms * jitter)
+    fake_llm = FakeLLM(Latency(llm_ttft_ms, llm_ttft_ms * jitter), Latency(llm_chunk_ms, llm_chunk_ms * jitter), llm_chunks)
+    embedder = FakeEmbedder(Latency(embed_ms, embed_ms * jitter))
+    llm.client = fake_llm
+    pinecone_utils.pc = types.SimpleNamespace(inference=embedder)
+    pinecone_utils.store = LatencyVectorStore(os.environ["LOCAL_INDEX_DIR"])
+    return fake_llm, embedder
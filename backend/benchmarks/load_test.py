@@ -0,0 +1,342 @@
+"""Load test of the API against local stand-ins for Gemini and Pinecone.
+
+Starts the app under uvicorn on a free local port with the fakes from
+fake_services installed, then drives /chats, /message and /message/stream
+concurrently: every chat runs its turns in order while the chats run in
+parallel. Reports p50/p95/p99 latency per endpoint, time to first byte and
+first token for streams, throughput, and per-stage timings inside the
+server, and checks that no chat's vectors ended up in another chat's namespace.
+
+Run from the backend directory:
+    python benchmarks/load_test.py --chats 20 --turns 10 --stream-ratio 0.5
+    python benchmarks/load_test.py --json out.json --baseline baseline.json --tolerance 0.2
+
+With --baseline the exit status is 1 when any p95 grew by more than --tolerance.
+"""
+import argparse
+import asyncio
+import functools
+import inspect
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import fake_services
+
+WORDS = (
+    "deploy cache index query latency budget schema migration token vector shard replica queue "
+    "timeout retry circuit stream session history summary embedding cluster region backup"
+).split()
+
+
+class Recorder:
+    """Durations per name; appends are atomic under the GIL, so threads can share it"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def summary(self):
+        return {name: describe(values) for name, values in sorted(self.samples.items())}
+
+
+def describe(values):
+    data = np.asarray(values) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": float(data.mean()),
+        "p50_ms": float(np.percentile(data, 50)),
+        "p95_ms": float(np.percentile(data, 95)),
+        "p99_ms": float(np.percentile(data, 99)),
+        "max_ms": float(data.max())
+    }
+
+
+def timed(fn, name, recorder):
+    """Wrap a function, coroutine function or async generator function so each call is recorded"""
+    if inspect.isasyncgenfunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                async for item in fn(*args, **kwargs):
+                    yield item
+            finally:
+                recorder.add(name, time.perf_counter() - start)
+    elif inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                recorder.add(name, time.perf_counter() - start)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                recorder.add(name, time.perf_counter() - start)
+    return wrapper
+
+
+def instrument(api, recorder):
+    """Time the stages of a turn by wrapping the module-level functions api calls by name"""
+    for stage, attr in (
+        ("load_session", "load_session"),
+        ("lexical_search", "search_lexical"),
+        ("vector_query", "query_similar_turns_async"),
+        ("summary_query", "retrieve_summaries"),
+        ("build_context", "build_context"),
+        ("llm", "ask_llm_async"),
+        ("llm_stream", "ask_llm_stream_async"),
+        ("finish_turn", "finish_turn"),
+    ):
+        setattr(api, attr, timed(getattr(api, attr), stage, recorder))
+    queue = api.indexing_queue
+    queue._process = timed(queue._process, "persist_and_index", recorder)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(app, port):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="uvicorn", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("server failed to start")
+        time.sleep(0.01)
+    return server, thread
+
+
+def make_message(rng, chat_index, turn):
+    words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 16)))
+    return f"chat{chat_index} turn {turn}: {words}?"
+
+
+async def send_message(client, recorder, chat_name, message, stream):
+    body = {"chat_name": chat_name, "message": message}
+    start = time.perf_counter()
+    if not stream:
+        response = await client.post("/message", json=body)
+        recorder.add("POST /message", time.perf_counter() - start)
+        return response.status_code == 200
+    ok = False
+    first_byte = first_token = None
+    async with client.stream("POST", "/message/stream", json=body) as response:
+        async for line in response.aiter_lines():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            if line.startswith("data: "):
+                event = json.loads(line[6:])
+                if event["type"] == "chunk" and first_token is None:
+                    first_token = time.perf_counter() - start
+                elif event["type"] == "done":
+                    ok = True
+    recorder.add("POST /message/stream", time.perf_counter() - start)
+    if first_byte is not None:
+        recorder.add("stream time to first byte", first_byte)
+    if first_token is not None:
+        recorder.add("stream time to first token", first_token)
+    return ok and response.status_code == 200
+
+
+async def run_load(base_url, args, recorder):
+    import httpx
+
+    rng = random.Random(args.seed)
+    chat_names = [f"bench-{i}" for i in range(args.chats)]
+    completed = {name: 0 for name in chat_names}
+    errors = 0
+    limits = httpx.Limits(max_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        gate = asyncio.Semaphore(args.concurrency)
+
+        async def timed_request(name, method, path, **kwargs):
+            start = time.perf_counter()
+            response = await client.request(method, path, **kwargs)
+            recorder.add(name, time.perf_counter() - start)
+            return response
+
+        async def create(chat_name):
+            async with gate:
+                response = await timed_request("POST /chats", "POST", "/chats", json={"chat_name": chat_name})
+                return response.status_code == 200
+
+        async def converse(index, chat_name):
+            nonlocal errors
+            chat_rng = random.Random(rng.random())
+            for turn in range(args.turns):
+                stream = chat_rng.random() < args.stream_ratio
+                async with gate:
+                    try:
+                        ok = await send_message(client, recorder, chat_name, make_message(chat_rng, index, turn), stream)
+                    except Exception as e:
+                        print(f"request failed: {e!r}", file=sys.stderr)
+                        ok = False
+                if ok:
+                    completed[chat_name] += 1
+                else:
+                    errors += 1
+
+        async def list_chats(stop):
+            while not stop.is_set():
+                await timed_request("GET /chats", "GET", "/chats")
+                try:
+                    await asyncio.wait_for(stop.wait(), args.list_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+        start = time.perf_counter()
+        created = await asyncio.gather(*(create(name) for name in chat_names))
+        errors += created.count(False)
+        stop = asyncio.Event()
+        lister = asyncio.create_task(list_chats(stop))
+        await asyncio.gather(*(converse(i, name) for i, name in enumerate(chat_names)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await lister
+    return chat_names, completed, errors, elapsed
+
+
+def check_namespaces(api, chat_names, completed):
+    """Every chat's namespace holds exactly the vectors of its own turns, embedded from its own text"""
+    import pinecone_utils
+    from fake_services import fake_vector
+
+    api.indexing_queue.flush(timeout=60)
+    chat_manager = api.get_chat_manager()
+    problems = []
+    for name in chat_names:
+        namespace = pinecone_utils.store._namespace(chat_manager.get_namespace(name))
+        turns = api.get_history_manager(name).load_history()
+        if len(turns) != completed[name]:
+            problems.append(f"{name}: {len(turns)} turns stored, {completed[name]} completed")
+        expected = {f"{turn.id}_{suffix}": text for turn in turns
+                    for suffix, text in (("u", turn.user_text), ("l", turn.llm_text)) if text}
+        stored = set(namespace.ids) if namespace is not None else set()
+        if stored != set(expected):
+            problems.append(f"{name}: {len(stored ^ set(expected))} vector ids differ from its turns")
+            continue
+        for vec_id, text in expected.items():
+            if float(np.dot(namespace.vectors[namespace.rows[vec_id]], fake_vector(text))) < 0.999:
+                problems.append(f"{name}: vector {vec_id} was not embedded from this chat's text")
+                break
+    return problems
+
+
+def print_table(title, stats):
+    print(f"\n{title}")
+    print(f"  {'':30} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, s in stats.items():
+        print(f"  {name:30} {s['count']:7d} {s['mean_ms']:8.1f}ms {s['p50_ms']:8.1f}ms "
+              f"{s['p95_ms']:8.1f}ms {s['p99_ms']:8.1f}ms {s['max_ms']:8.1f}ms")
+
+
+def regressions(report, baseline, tolerance, min_delta_ms=1.0):
+    """p95s that grew by more than tolerance (and by at least min_delta_ms, so sub-millisecond noise is ignored)"""
+    found = []
+    for section in ("requests", "stages"):
+        for name, s in report[section].items():
+            old = baseline.get(section, {}).get(name)
+            if old and s["p95_ms"] > old["p95_ms"] * (1 + tolerance) and s["p95_ms"] - old["p95_ms"] >= min_delta_ms:
+                found.append(f"{name}: p95 {old['p95_ms']:.1f}ms -> {s['p95_ms']:.1f}ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=10, help="turns per chat")
+    parser.add_argument("--concurrency", type=int, default=None, help="requests in flight (default: one per chat)")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="share of turns sent to /message/stream")
+    parser.add_argument("--list-interval", type=float, default=0.5, help="seconds between GET /chats calls")
+    parser.add_argument("--llm-ttft-ms", type=float, default=200)
+    parser.add_argument("--llm-chunk-ms", type=float, default=20)
+    parser.add_argument("--llm-chunks", type=int, default=10)
+    parser.add_argument("--embed-ms", type=float, default=30)
+    parser.add_argument("--vector-ms", type=float, default=10)
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency jitter as a fraction of each latency")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="report from an earlier run to compare p95s against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    args.concurrency = args.concurrency or args.chats
+    # install() switches to the scratch directory, so resolve output paths first
+    for attr in ("json", "baseline"):
+        if getattr(args, attr):
+            setattr(args, attr, os.path.abspath(getattr(args, attr)))
+
+    data_dir = tempfile.mkdtemp(prefix="llm-context-bench-")
+    fake_services.install(args.llm_ttft_ms, args.llm_chunk_ms, args.llm_chunks, args.embed_ms,
+                          args.vector_ms, args.jitter, data_dir=data_dir)
+    import api
+
+    recorder = Recorder()
+    stage_recorder = Recorder()
+    instrument(api, stage_recorder)
+    port = free_port()
+    server, thread = start_server(api.app, port)
+    try:
+        chat_names, completed, errors, elapsed = asyncio.run(run_load(f"http://127.0.0.1:{port}", args, recorder))
+        problems = check_namespaces(api, chat_names, completed)
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+    turns = sum(completed.values())
+    report = {
+        "config": vars(args),
+        "turns": turns,
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "throughput_turns_per_s": turns / elapsed if elapsed else 0.0,
+        "requests": recorder.summary(),
+        "stages": stage_recorder.summary(),
+        "namespace_problems": problems
+    }
+
+    print(f"{args.chats} chats x {args.turns} turns, {args.concurrency} in flight, data in {data_dir}")
+    print(f"{turns} turns in {elapsed:.2f}s: {report['throughput_turns_per_s']:.1f} turns/s, {errors} errors")
+    print_table("Requests (client side)", report["requests"])
+    print_table("Stages (server side; persist_and_index runs in the background)", report["stages"])
+    print("\nNamespace isolation: " + ("ok" if not problems else f"{len(problems)} problems"))
+    for problem in problems[:20]:
+        print(f"  {problem}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = bool(errors or problems)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        print("\nRegressions: " + (f"{len(found)} p95s above tolerance" if found else "none"))
+        for line in found:
+            print(f"  {line}")
+        failed = failed or bool(found)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Resident memory of N turns stored as nested dicts versus memory.Turn objects.
+
+Run from the backend directory:
+    python benchmarks/turn_memory.py [turn_count]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory import Turn
+
+
+def make_texts(count):
+    # Texts are built up front so both layouts share the same string objects
+    return [(f"user message {i} " * 4, f"assistant reply {i} " * 12) for i in range(count)]
+
+
+def dict_turns(texts):
+    return [
+        {
+            "id": i + 1,
+            "user": {"role": "user", "text": user_text},
+            "llm": {"role": "llm", "text": llm_text}
+        }
+        for i, (user_text, llm_text) in enumerate(texts)
+    ]
+
+
+def slotted_turns(texts):
+    return [Turn(i + 1, user_text, llm_text) for i, (user_text, llm_text) in enumerate(texts)]
+
+
+def measure(build, texts):
+    """Bytes allocated by build(texts) that are still live afterwards"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    turns = build(texts)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del turns
+    return after - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    texts = make_texts(count)
+    text_bytes = sum(sys.getsizeof(u) + sys.getsizeof(l) for u, l in texts)
+
+    dict_bytes = measure(dict_turns, texts)
+    turn_bytes = measure(slotted_turns, texts)
+
+    print(f"{count} turns (message text itself: {text_bytes / 2**20:.1f} MiB, shared by both layouts)")
+    print(f"  nested dicts: {dict_bytes / 2**20:8.1f} MiB  ({dict_bytes / count:6.1f} B/turn)")
+    print(f"  Turn objects: {turn_bytes / 2**20:8.1f} MiB  ({turn_bytes / count:6.1f} B/turn)")
+    print(f"  saved:        {(dict_bytes - turn_bytes) / 2**20:8.1f} MiB  ({1 - turn_bytes / dict_bytes:.0%})")
+
+
+if __name__ == "__main__":
+    main()
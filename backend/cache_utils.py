@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Writes between two passes that delete expired rows and rows over max_entries
+DISK_CACHE_PRUNE_EVERY = 100
+
+
+def content_key(*parts):
+    """Stable hash of the given strings, used as a cache key"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-memory cache bounded by entry count and entry age"""
+
+    def __init__(self, max_entries, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value, or None on a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        """Remove an entry, returning its value or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return entry[1] if entry else None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class DiskCache:
+    """SQLite-backed key/value store for JSON-serializable values, used as a second cache tier.
+
+    Bounded like LRUCache: rows older than ttl_seconds are deleted, and beyond
+    max_entries the oldest written rows go first. Both are enforced on open and
+    every DISK_CACHE_PRUNE_EVERY writes, so the table can briefly exceed the bound.
+    """
+
+    def __init__(self, path, table, ttl_seconds=None, max_entries=None):
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_by_age ON {table} (created_at)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+        with self.lock:
+            self._prune()
+
+    def _prune(self):
+        """Delete expired rows, then the oldest rows beyond max_entries; called with the lock held"""
+        try:
+            removed = 0
+            if self.ttl_seconds:
+                removed += self.conn.execute(
+                    f"DELETE FROM {self.table} WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+                ).rowcount
+            if self.max_entries:
+                removed += self.conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                ).rowcount
+            self.conn.commit()
+            self.evictions += removed
+        except Exception as e:
+            print(f"Error pruning disk cache: {e}")
+
+    def get(self, key):
+        """Return the stored value, or None if missing or expired"""
+        try:
+            with self.lock:
+                row = self.conn.execute(
+                    f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row and (not self.ttl_seconds or time.time() - row[1] < self.ttl_seconds):
+                    self.hits += 1
+                    return json.loads(row[0])
+                self.misses += 1
+        except Exception as e:
+            print(f"Error reading disk cache: {e}")
+        return None
+
+    def put(self, key, value):
+        try:
+            with self.lock:
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time())
+                )
+                self.conn.commit()
+                self.writes += 1
+                if self.writes % DISK_CACHE_PRUNE_EVERY == 0:
+                    self._prune()
+        except Exception as e:
+            print(f"Error writing disk cache: {e}")
+
+    def delete(self, key):
+        try:
+            with self.lock:
+                self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.conn.commit()
+        except Exception as e:
+            print(f"Error writing disk cache: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "max_entries": self.max_entries}
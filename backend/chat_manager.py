@@ -1,14 +1,26 @@
+import atexit
 import json
 import os
+import threading
 from datetime import datetime
+from dotenv import load_dotenv
+from metrics import span
+
+load_dotenv()
 
 CHATS_FILE = "chat_data/chats.json"
+# Metadata-only changes (message counts, access times) are batched and written at most this often
+CHATS_FLUSH_SECONDS = float(os.getenv("CHATS_FLUSH_SECONDS", "2"))
 
 class ChatManager:
     def __init__(self):
         # Ensure chat data directory exists
         os.makedirs("chat_data", exist_ok=True)
+        self.lock = threading.RLock()
         self.chats = self.load_chats()
+        self.dirty = False
+        self.flush_timer = None
+        atexit.register(self.flush)
     
     def load_chats(self):
         """Load chat metadata from file"""
@@ -22,16 +34,44 @@ class ChatManager:
         return {}
     
     def save_chats(self):
-        """Save chat metadata to file"""
-        try:
-            with open(CHATS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.chats, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            print(f"Error saving chats: {e}")
+        """Atomically write chat metadata to file"""
+        with self.lock, span("chats_write"):
+            try:
+                tmp_file = CHATS_FILE + ".tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.chats, f, indent=2, ensure_ascii=False)
+                os.replace(tmp_file, CHATS_FILE)
+                self.dirty = False
+            except Exception as e:
+                print(f"Error saving chats: {e}")
+    
+    def mark_dirty(self):
+        """Schedule a batched save for metadata changes"""
+        with self.lock:
+            self.dirty = True
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(CHATS_FLUSH_SECONDS, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+    
+    def flush(self):
+        """Write pending metadata changes now"""
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if self.dirty:
+                self.save_chats()
     
     def list_chats(self):
         """Return list of chat names with metadata"""
-        return self.chats
+        with self.lock:
+            return {name: dict(info) for name, info in self.chats.items()}
+    
+    def get_chat(self, chat_name):
+        """Return a copy of one chat's metadata, or an empty dict"""
+        with self.lock:
+            return dict(self.chats.get(chat_name, {}))
     
     def chat_exists(self, chat_name):
         """Check if a chat exists"""
@@ -40,48 +80,54 @@ class ChatManager:
     def create_chat(self, chat_name):
         """Create a new chat session"""
         namespace = self.sanitize_namespace(chat_name)
-        self.chats[chat_name] = {
-            "namespace": namespace,
-            "created_at": datetime.now().isoformat(),
-            "last_accessed": datetime.now().isoformat(),
-            "message_count": 0,
-            "system_instructions": None
-        }
-        self.save_chats()
+        with self.lock:
+            self.chats[chat_name] = {
+                "namespace": namespace,
+                "created_at": datetime.now().isoformat(),
+                "last_accessed": datetime.now().isoformat(),
+                "message_count": 0,
+                "system_instructions": None
+            }
+            self.save_chats()
         return namespace
     
     def set_system_instructions(self, chat_name, instructions):
         """Set system instructions for a chat"""
-        if chat_name in self.chats:
-            self.chats[chat_name]["system_instructions"] = instructions
-            self.save_chats()
+        with self.lock:
+            if chat_name in self.chats:
+                self.chats[chat_name]["system_instructions"] = instructions
+                self.save_chats()
     
     def get_system_instructions(self, chat_name):
         """Get system instructions for a chat"""
-        if chat_name in self.chats:
-            return self.chats[chat_name].get("system_instructions")
+        with self.lock:
+            if chat_name in self.chats:
+                return self.chats[chat_name].get("system_instructions")
         return None
     
     def get_namespace(self, chat_name):
         """Get namespace for a chat"""
-        if chat_name in self.chats:
-            self.chats[chat_name]["last_accessed"] = datetime.now().isoformat()
-            self.save_chats()
-            return self.chats[chat_name]["namespace"]
+        with self.lock:
+            if chat_name in self.chats:
+                self.chats[chat_name]["last_accessed"] = datetime.now().isoformat()
+                self.mark_dirty()
+                return self.chats[chat_name]["namespace"]
         return None
     
     def update_message_count(self, chat_name):
         """Increment message count for a chat"""
-        if chat_name in self.chats:
-            self.chats[chat_name]["message_count"] += 1
-            self.save_chats()
+        with self.lock:
+            if chat_name in self.chats:
+                self.chats[chat_name]["message_count"] += 1
+                self.mark_dirty()
     
     def delete_chat(self, chat_name):
         """Delete a chat session"""
-        if chat_name in self.chats:
-            del self.chats[chat_name]
-            self.save_chats()
-            return True
+        with self.lock:
+            if chat_name in self.chats:
+                del self.chats[chat_name]
+                self.save_chats()
+                return True
         return False
     
     @staticmethod
@@ -91,3 +137,14 @@ class ChatManager:
         namespace = "".join(c if c.isalnum() else "_" for c in chat_name)
         namespace = namespace.lower().strip("_")
         return namespace[:63]  # Pinecone namespace max length
+
+_shared_manager = None
+_shared_lock = threading.Lock()
+
+def get_chat_manager():
+    """Return the process-wide ChatManager, loading chats.json once"""
+    global _shared_manager
+    with _shared_lock:
+        if _shared_manager is None:
+            _shared_manager = ChatManager()
+        return _shared_manager
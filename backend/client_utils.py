@@ -0,0 +1,287 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Attempts per call, with full-jitter exponential backoff between them
+CLIENT_RETRY_ATTEMPTS = int(os.getenv("CLIENT_RETRY_ATTEMPTS", "3"))
+CLIENT_RETRY_BASE_SECONDS = float(os.getenv("CLIENT_RETRY_BASE_SECONDS", "0.25"))
+CLIENT_RETRY_MAX_SECONDS = float(os.getenv("CLIENT_RETRY_MAX_SECONDS", "4"))
+# Consecutive retryable failures that open a service's circuit, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# Rate limiting, timeouts and server-side errors; anything else is the caller's fault and is not retried
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+_END = object()
+
+
+class ServiceUnavailable(Exception):
+    """A remote call failed, ran out of time, or was refused because the service's circuit is open"""
+
+    def __init__(self, service, message, retry_after=None):
+        super().__init__(f"{service}: {message}")
+        self.service = service
+        self.retry_after = retry_after
+
+
+def error_status(error):
+    """HTTP status carried by a Gemini or Pinecone error, if any"""
+    for attr in ("code", "status", "status_code"):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_retryable(error):
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # Transport errors of the HTTP libraries underneath (httpx, urllib3) are named after what failed
+    name = type(error).__name__
+    return "Timeout" in name or "Connect" in name or "Protocol" in name
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(CLIENT_RETRY_MAX_SECONDS, CLIENT_RETRY_BASE_SECONDS * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """Stops calls to a failing service for reset_seconds, then lets a single trial call through"""
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.opens = 0
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def retry_after(self):
+        """Seconds until the circuit lets a call through, or None if it is closed"""
+        with self.lock:
+            if self.opened_at is None:
+                return None
+            return max(self.reset_seconds - (time.monotonic() - self.opened_at), 0.0)
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self.trial_running:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial_running:
+                    self.opens += 1
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+
+    def release_trial(self):
+        """A trial call ended without telling us anything about the service"""
+        with self.lock:
+            self.trial_running = False
+
+
+class ServiceClient:
+    """Per-call deadline, bounded concurrency, retries and a circuit breaker for one remote service.
+
+    Blocking calls run on a pool of max_concurrency threads, so a call that
+    overruns its deadline is abandoned without being able to pile up more
+    requests behind it. Coroutine calls share an asyncio semaphore of the
+    same size.
+    """
+
+    def __init__(self, name, max_concurrency, timeout_seconds, attempts=CLIENT_RETRY_ATTEMPTS, breaker=None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.timeout_seconds = timeout_seconds
+        self.attempts = max(attempts, 1)
+        self.breaker = breaker or CircuitBreaker()
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"{name}-client")
+        self.async_slots = asyncio.Semaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def _count(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _admit(self):
+        if not self.breaker.allow():
+            self._count("rejected")
+            raise ServiceUnavailable(self.name, "circuit open", self.breaker.retry_after())
+
+    def _failed(self, error, attempt, deadline):
+        """Record a failed attempt; returns the backoff delay, or raises when the call should give up"""
+        if isinstance(error, ServiceUnavailable):
+            raise error
+        if not is_retryable(error):
+            self.breaker.release_trial()
+            self._count("failures")
+            raise ServiceUnavailable(self.name, str(error) or type(error).__name__) from error
+        self.breaker.record_failure()
+        delay = backoff_delay(attempt)
+        if attempt + 1 >= self.attempts or time.monotonic() + delay >= deadline:
+            self._count("failures")
+            raise ServiceUnavailable(self.name, str(error) or type(error).__name__, self.breaker.retry_after()) from error
+        self._count("retries")
+        return delay
+
+    def call(self, fn, *args, **kwargs):
+        """Run a blocking call, retrying retryable errors until it succeeds or the deadline passes"""
+        self._count("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        for attempt in range(self.attempts):
+            self._admit()
+            remaining = deadline - time.monotonic()
+            if not self.slots.acquire(timeout=max(remaining, 0)):
+                self.breaker.release_trial()
+                self._count("failures")
+                raise ServiceUnavailable(self.name, f"no free connection within {self.timeout_seconds}s")
+            # The slot is held until the call really returns, even if we stop waiting for it
+            future = self.executor.submit(fn, *args, **kwargs)
+            future.add_done_callback(lambda _: self.slots.release())
+            try:
+                result = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FutureTimeout:
+                error = TimeoutError(f"no response within {self.timeout_seconds}s")
+            except Exception as e:
+                error = e
+            else:
+                self.breaker.record_success()
+                return result
+            time.sleep(self._failed(error, attempt, deadline))
+
+    async def _acquire_async(self, deadline):
+        try:
+            async with asyncio.timeout(max(deadline - time.monotonic(), 0)):
+                await self.async_slots.acquire()
+        except TimeoutError:
+            self.breaker.release_trial()
+            self._count("failures")
+            raise ServiceUnavailable(self.name, f"no free connection within {self.timeout_seconds}s") from None
+
+    async def call_async(self, fn, *args, **kwargs):
+        """Await fn(*args, **kwargs) with the same deadline, retry and circuit rules as call()"""
+        self._count("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        for attempt in range(self.attempts):
+            self._admit()
+            await self._acquire_async(deadline)
+            try:
+                async with asyncio.timeout(max(deadline - time.monotonic(), 0)):
+                    result = await fn(*args, **kwargs)
+            except TimeoutError:
+                error = TimeoutError(f"no response within {self.timeout_seconds}s")
+            except Exception as e:
+                error = e
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                self.async_slots.release()
+            await asyncio.sleep(self._failed(error, attempt, deadline))
+
+    def stream(self, open_stream, *args, **kwargs):
+        """Blocking counterpart of stream_async; only opening the stream and its first chunk go through call()"""
+        def start():
+            chunks = iter(open_stream(*args, **kwargs))
+            return chunks, next(chunks, _END)
+
+        chunks, first = self.call(start)
+        if first is _END:
+            return
+        yield first
+        try:
+            yield from chunks
+        except Exception as e:
+            self._count("failures")
+            raise ServiceUnavailable(self.name, f"stream interrupted: {str(e) or type(e).__name__}") from e
+
+    async def stream_async(self, open_stream, *args, **kwargs):
+        """Yield the chunks of `await open_stream(...)`.
+
+        Opening the stream and waiting for its first chunk are retried like
+        call_async(); once a chunk has been yielded nothing is retried, and
+        each further chunk must arrive within timeout_seconds. A concurrency
+        slot is held for the whole stream.
+        """
+        self._count("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        await self._acquire_async(deadline)
+        try:
+            for attempt in range(self.attempts):
+                self._admit()
+                try:
+                    async with asyncio.timeout(max(deadline - time.monotonic(), 0)):
+                        chunks = (await open_stream(*args, **kwargs)).__aiter__()
+                        first = await anext(chunks, _END)
+                except TimeoutError:
+                    error = TimeoutError(f"no response within {self.timeout_seconds}s")
+                except Exception as e:
+                    error = e
+                else:
+                    break
+                await asyncio.sleep(self._failed(error, attempt, deadline))
+            if first is _END:
+                self.breaker.record_success()
+                return
+            yield first
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks, _END), self.timeout_seconds)
+                except Exception as e:
+                    if is_retryable(e):
+                        self.breaker.record_failure()
+                    self._count("failures")
+                    raise ServiceUnavailable(self.name, f"stream interrupted: {str(e) or type(e).__name__}") from e
+                if chunk is _END:
+                    self.breaker.record_success()
+                    return
+                yield chunk
+        finally:
+            self.async_slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "circuit": self.breaker.state,
+                "circuit_opens": self.breaker.opens
+            }
@@ -1,45 +1,310 @@
+import asyncio
 import json
 import os
+import threading
+import time
+from array import array
+from dotenv import load_dotenv
+
+from memory import Turn
+from metrics import span
+
+load_dotenv()
 
 HISTORY_DIR = "chat_histories"
+# "always" fsyncs every append, "interval" at most every HISTORY_FSYNC_SECONDS, "never" leaves it to the OS
+HISTORY_FSYNC = os.getenv("HISTORY_FSYNC", "interval").lower()
+HISTORY_FSYNC_SECONDS = float(os.getenv("HISTORY_FSYNC_SECONDS", "1"))
+# Rewrite the journal once superseded or damaged records exceed this share of it
+HISTORY_COMPACT_RATIO = float(os.getenv("HISTORY_COMPACT_RATIO", "0.5"))
+# Each offset index entry is three int64s: turn id, byte offset, record length
+INDEX_ENTRY_FIELDS = 3
 
 class HistoryManager:
+    """Persists a chat's turns as an append-only JSONL journal, one record per turn.
+    
+    A sidecar offset index (history_<chat>.idx) maps every turn id to the byte
+    range of its newest record, so single turns and pages can be read without
+    parsing the rest of the journal.
+    """
+
     def __init__(self, chat_name):
         self.chat_name = chat_name
         # Ensure history directory exists
         os.makedirs(HISTORY_DIR, exist_ok=True)
-        self.history_file = os.path.join(HISTORY_DIR, f"history_{self.sanitize_filename(chat_name)}.json")
-    
+        base_name = f"history_{self.sanitize_filename(chat_name)}"
+        self.history_file = os.path.join(HISTORY_DIR, f"{base_name}.jsonl")
+        self.index_file = os.path.join(HISTORY_DIR, f"{base_name}.idx")
+        self.legacy_file = os.path.join(HISTORY_DIR, f"{base_name}.json")
+        self.lock = threading.RLock()
+        # Offset index, filled in on first use
+        self.loaded = False
+        self.ids = []          # turn ids in journal order
+        self.ordinals = {}     # turn id -> position in self.ids
+        self.positions = {}    # turn id -> (offset, length) of its newest record
+        self.record_count = 0
+        self.journal_size = 0
+        self.last_fsync = time.monotonic()
+        self.migrate_legacy()
+
     @staticmethod
     def sanitize_filename(name):
         """Convert chat name to valid filename"""
         return "".join(c if c.isalnum() else "_" for c in name).lower()
-    
+
+    @staticmethod
+    def encode_turn(turn):
+        return (json.dumps(turn.to_dict(), ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+    def migrate_legacy(self):
+        """Convert a pre-journal history_<chat>.json file into the JSONL journal"""
+        if not os.path.exists(self.legacy_file) or os.path.exists(self.history_file):
+            return
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                history_list = [Turn.from_dict(turn) for turn in json.load(f)]
+            self.compact(history_list)
+            os.remove(self.legacy_file)
+        except Exception as e:
+            print(f"Error migrating history: {e}")
+
+    def _sync(self, files, force=False):
+        if HISTORY_FSYNC == "never":
+            return
+        now = time.monotonic()
+        if force or HISTORY_FSYNC == "always" or now - self.last_fsync >= HISTORY_FSYNC_SECONDS:
+            for f in files:
+                f.flush()
+                os.fsync(f.fileno())
+            self.last_fsync = now
+
+    def _reset_index(self):
+        self.ids = []
+        self.ordinals = {}
+        self.positions = {}
+        self.record_count = 0
+        self.journal_size = 0
+
+    def _index_record(self, turn_id, offset, length):
+        if turn_id not in self.ordinals:
+            self.ordinals[turn_id] = len(self.ids)
+            self.ids.append(turn_id)
+        self.positions[turn_id] = (offset, length)
+        self.record_count += 1
+        self.journal_size = offset + length
+
+    def _ensure_index(self):
+        if self.loaded:
+            return
+        self._reset_index()
+        if not os.path.exists(self.history_file):
+            self.loaded = True
+            return
+        if not self._read_index_file():
+            self._rebuild_index()
+        self.loaded = True
+
+    def _read_index_file(self):
+        """Load the sidecar index; False if it is missing or does not cover the journal"""
+        if not os.path.exists(self.index_file):
+            return False
+        entries = array("q")
+        with open(self.index_file, 'rb') as f:
+            data = f.read()
+        usable = len(data) - len(data) % (INDEX_ENTRY_FIELDS * entries.itemsize)
+        entries.frombytes(data[:usable])
+        for i in range(0, len(entries), INDEX_ENTRY_FIELDS):
+            self._index_record(entries[i], entries[i + 1], entries[i + 2])
+        if self.journal_size != os.path.getsize(self.history_file):
+            self._reset_index()
+            return False
+        return True
+
+    def _rebuild_index(self):
+        """Rebuild the offset index by scanning the journal, compacting it if damaged"""
+        offset = 0
+        damaged = False
+        turns = {}
+        with open(self.history_file, 'rb') as f:
+            for line in f:
+                length = len(line)
+                try:
+                    turn = json.loads(line) if line.strip() else None
+                except ValueError:
+                    # A torn record from a crash mid-append
+                    turn = None
+                    damaged = True
+                if turn is not None:
+                    self._index_record(turn["id"], offset, length)
+                    turns[turn["id"]] = Turn.from_dict(turn)
+                offset += length
+        if damaged or offset != self.journal_size:
+            self.compact(list(turns.values()))
+            return
+        self._write_index_file()
+
+    def _write_index_file(self):
+        entries = array("q")
+        for turn_id in self.ids:
+            offset, length = self.positions[turn_id]
+            entries.extend((turn_id, offset, length))
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(entries.tobytes())
+        os.replace(tmp_file, self.index_file)
+
+    def append_turns(self, turns):
+        """Append one journal record per turn; a later record for the same id supersedes earlier ones"""
+        if not turns:
+            return
+        with self.lock:
+            self._ensure_index()
+            records = [self.encode_turn(turn) for turn in turns]
+            entries = array("q")
+            offset = self.journal_size
+            for turn, record in zip(turns, records):
+                entries.extend((turn.id, offset, len(record)))
+                offset += len(record)
+            with open(self.history_file, 'ab') as journal, open(self.index_file, 'ab') as index:
+                journal.write(b"".join(records))
+                index.write(entries.tobytes())
+                self._sync((journal, index))
+            for i in range(0, len(entries), INDEX_ENTRY_FIELDS):
+                self._index_record(entries[i], entries[i + 1], entries[i + 2])
+
+    def save_turns(self, turns):
+        """Append the given turns unless the journal already has them"""
+        try:
+            with self.lock, span("history_write"):
+                self._ensure_index()
+                self.append_turns([turn for turn in turns if turn.id not in self.positions])
+        except Exception as e:
+            print(f"Error saving history: {e}")
+
     def save_history(self, history_list):
-        """Save conversation history to file"""
+        """Persist history, appending only the turns the journal does not have yet"""
         try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(history_list, f, indent=2, ensure_ascii=False)
+            with self.lock, span("history_write"):
+                self._ensure_index()
+                count = len(self.ids)
+                in_sync = (
+                    len(history_list) >= count
+                    and (count == 0 or history_list[count - 1].id == self.ids[-1])
+                )
+                if not in_sync:
+                    # History was rewritten in memory; replace the journal
+                    self.compact(history_list)
+                    return
+                self.append_turns(history_list[count:])
+                if self.record_count - len(self.ids) > HISTORY_COMPACT_RATIO * max(self.record_count, 1):
+                    self.compact(history_list)
         except Exception as e:
             print(f"Error saving history: {e}")
-    
+
+    async def save_history_async(self, history_list):
+        """Save a snapshot of history from a worker thread so the event loop never blocks"""
+        await asyncio.to_thread(self.save_history, list(history_list))
+
+    def compact(self, history_list):
+        """Atomically rewrite the journal and its index with exactly one record per turn"""
+        with self.lock:
+            records = [self.encode_turn(turn) for turn in history_list]
+            tmp_file = self.history_file + ".tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(b"".join(records))
+                self._sync((f,), force=True)
+            os.replace(tmp_file, self.history_file)
+            self._reset_index()
+            offset = 0
+            for turn, record in zip(history_list, records):
+                self._index_record(turn.id, offset, len(record))
+                offset += len(record)
+            self._write_index_file()
+            self.loaded = True
+
+    def turn_count(self):
+        """Number of turns in the journal"""
+        with self.lock:
+            self._ensure_index()
+            return len(self.ids)
+
+    def turn_ids(self, start=0, end=None):
+        """Turn ids in conversation order, optionally sliced by position"""
+        with self.lock:
+            self._ensure_index()
+            return self.ids[start:end]
+
+    def position(self, turn_id):
+        """Position of a turn in conversation order, or None if unknown"""
+        with self.lock:
+            self._ensure_index()
+            return self.ordinals.get(turn_id)
+
+    def get_turns(self, turn_ids):
+        """Read specific turns by id using the offset index; unknown ids are skipped"""
+        with self.lock:
+            self._ensure_index()
+            positions = [self.positions[tid] for tid in turn_ids if tid in self.positions]
+            if not positions:
+                return []
+            turns = []
+            with open(self.history_file, 'rb') as f:
+                for offset, length in positions:
+                    f.seek(offset)
+                    turns.append(Turn.from_dict(json.loads(f.read(length))))
+            return turns
+
+    def get_turn(self, turn_id):
+        """Read a single turn by id, or None if it does not exist"""
+        turns = self.get_turns([turn_id])
+        return turns[0] if turns else None
+
+    def load_page(self, before=None, limit=50):
+        """Return (turns, next_cursor) for up to `limit` turns preceding turn id `before`.
+        
+        Turns come back in conversation order. next_cursor is the id to pass as
+        `before` for the next older page, or None when the start was reached.
+        """
+        with self.lock:
+            self._ensure_index()
+            end = len(self.ids) if before is None else self.ordinals.get(before, len(self.ids))
+            start = max(0, end - limit)
+            turns = self.get_turns(self.ids[start:end])
+            return turns, (self.ids[start] if start > 0 else None)
+
     def load_history(self):
-        """Load conversation history from file"""
-        if os.path.exists(self.history_file):
+        """Load conversation history by streaming the journal"""
+        with self.lock:
             try:
+                self._ensure_index()
+                if not self.ids:
+                    return []
+                turns = {}
                 with open(self.history_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                    for line in f:
+                        if line.strip():
+                            turn = Turn.from_dict(json.loads(line))
+                            # Re-inserting keeps first-seen order while the newest record wins
+                            turns[turn.id] = turn
+                history_list = list(turns.values())
+                if self.record_count - len(history_list) > HISTORY_COMPACT_RATIO * max(self.record_count, 1):
+                    self.compact(history_list)
+                return history_list
             except Exception as e:
                 print(f"Error loading history: {e}")
                 return []
-        return []
-    
+
     def delete_history(self):
         """Delete history file"""
         try:
-            if os.path.exists(self.history_file):
-                os.remove(self.history_file)
-                return True
+            with self.lock:
+                deleted = False
+                for path in (self.history_file, self.index_file, self.legacy_file):
+                    if os.path.exists(path):
+                        os.remove(path)
+                        deleted = True
+                self.loaded = False
+                return deleted
         except Exception as e:
             print(f"Error deleting history: {e}")
         return False
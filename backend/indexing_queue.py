@@ -0,0 +1,204 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+
+from pinecone_utils import upsert_turns
+from similarity_graph import similarity_service
+
+load_dotenv()
+
+# Completed turns waiting to be indexed; submit() blocks once this many are queued.
+# Turns parked after a failed batch do not count, so an outage cannot block new messages
+INDEX_QUEUE_MAX_PENDING = int(os.getenv("INDEX_QUEUE_MAX_PENDING", "1000"))
+INDEX_RETRY_ATTEMPTS = int(os.getenv("INDEX_RETRY_ATTEMPTS", "5"))
+INDEX_RETRY_BASE_SECONDS = float(os.getenv("INDEX_RETRY_BASE_SECONDS", "0.5"))
+# Delay before a failed batch is tried again; doubles per consecutive failure up to the max
+INDEX_PARK_SECONDS = float(os.getenv("INDEX_PARK_SECONDS", "10"))
+INDEX_PARK_MAX_SECONDS = float(os.getenv("INDEX_PARK_MAX_SECONDS", "300"))
+
+
+class IndexingQueue:
+    """Background worker that embeds, upserts and persists completed turns off the request path.
+
+    Work is coalesced per chat: every turn queued for a chat while its previous
+    batch was in flight is indexed with one batched upsert and one history append.
+    A batch that still fails after its retries is parked and tried again after
+    a growing delay, together with any turns queued for the chat meanwhile.
+    """
+
+    def __init__(self, max_pending=INDEX_QUEUE_MAX_PENDING):
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.pending = {}        # chat_name -> job waiting to be processed
+        self.ready = deque()     # chat names with a job ready to run, oldest first
+        self.in_progress = set()
+        self.parked = {}         # chat_name -> (monotonic time of the next attempt, consecutive failures)
+        self.pending_turns = 0   # queued turns counted against max_pending (parked turns are not)
+        self.watermarks = {}     # chat_name -> highest turn id known to be indexed
+        self.thread = threading.Thread(target=self._run, name="indexing-queue", daemon=True)
+        self.thread.start()
+
+    def submit(self, chat_name, namespace, turn, history_manager):
+        """Queue a completed turn; blocks while the queue is full"""
+        with self.cond:
+            while self.pending_turns >= self.max_pending:
+                self.cond.wait()
+            job = self.pending.get(chat_name)
+            if job is None:
+                job = {"turns": [], "counted": 0}
+                self.pending[chat_name] = job
+            job["namespace"] = namespace
+            job["history_manager"] = history_manager
+            job["turns"].append(turn)
+            job["counted"] += 1
+            self.pending_turns += 1
+            # A parked chat waits for its retry time; new turns ride along with the retry
+            if chat_name not in self.ready and chat_name not in self.in_progress and chat_name not in self.parked:
+                self.ready.append(chat_name)
+            self.cond.notify_all()
+
+    async def submit_async(self, chat_name, namespace, turn, history_manager):
+        """submit() from a worker thread so backpressure never blocks the event loop"""
+        await asyncio.to_thread(self.submit, chat_name, namespace, turn, history_manager)
+
+    def watermark(self, chat_name):
+        """Highest turn id of the chat that is known to be in the vector index"""
+        with self.cond:
+            return self.watermarks.get(chat_name, 0)
+
+    def set_watermark(self, chat_name, turn_id):
+        """Record turns up to turn_id as indexed (e.g. history loaded from disk)"""
+        with self.cond:
+            if turn_id > self.watermarks.get(chat_name, 0):
+                self.watermarks[chat_name] = turn_id
+
+    def status(self, chat_name):
+        """Indexing progress for one chat"""
+        with self.cond:
+            job = self.pending.get(chat_name)
+            return {
+                "indexed_up_to": self.watermarks.get(chat_name, 0),
+                "pending_turns": len(job["turns"]) if job else 0,
+                "in_progress": chat_name in self.in_progress,
+                "retrying": chat_name in self.parked
+            }
+
+    def flush(self, chat_name=None, timeout=None):
+        """Wait until queued work (for one chat, or all chats) has been processed.
+
+        Parked batches are retried right away instead of at their retry time. Returns
+        False if work is still left at the timeout; the chats it belongs to are
+        printed so they can be reindexed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            for name in [chat_name] if chat_name is not None else list(self.parked):
+                if name in self.parked:
+                    self.parked[name] = (0.0, self.parked[name][1])
+            self.cond.notify_all()
+            while self._busy(chat_name):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    unindexed = sorted(name for name in self.pending if chat_name in (None, name))
+                    print(f"Indexing still pending for {unindexed}; POST /chat/{{name}}/reindex once the index is reachable")
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def forget(self, chat_name):
+        """Drop queued work and the watermark for a deleted chat"""
+        with self.cond:
+            while chat_name in self.in_progress:
+                self.cond.wait()
+            job = self.pending.pop(chat_name, None)
+            if job:
+                self.pending_turns -= job["counted"]
+            if chat_name in self.ready:
+                self.ready.remove(chat_name)
+            self.parked.pop(chat_name, None)
+            self.watermarks.pop(chat_name, None)
+            self.cond.notify_all()
+
+    def _busy(self, chat_name):
+        if chat_name is None:
+            return bool(self.ready or self.in_progress or self.parked)
+        return chat_name in self.ready or chat_name in self.in_progress or chat_name in self.parked
+
+    def _release_parked(self):
+        """Move parked chats whose retry time has come to the ready queue; returns seconds until the next one"""
+        now = time.monotonic()
+        next_retry = None
+        for chat_name, (retry_at, _) in list(self.parked.items()):
+            if retry_at <= now:
+                if chat_name not in self.ready:
+                    self.ready.append(chat_name)
+            elif next_retry is None or retry_at - now < next_retry:
+                next_retry = retry_at - now
+        return next_retry
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    next_retry = self._release_parked()
+                    if self.ready:
+                        break
+                    self.cond.wait(next_retry)
+                chat_name = self.ready.popleft()
+                job = self.pending.pop(chat_name)
+                self.in_progress.add(chat_name)
+
+            indexed = self._process(job)
+
+            with self.cond:
+                self.in_progress.discard(chat_name)
+                # Parked turns stop counting against the bound; turns queued meanwhile still count
+                self.pending_turns -= job["counted"]
+                job["counted"] = 0
+                failures = self.parked.pop(chat_name, (0.0, 0))[1]
+                if indexed:
+                    last_turn_id = max(turn.id for turn in job["turns"])
+                    if last_turn_id > self.watermarks.get(chat_name, 0):
+                        self.watermarks[chat_name] = last_turn_id
+                    if chat_name in self.pending and chat_name not in self.ready:
+                        self.ready.append(chat_name)
+                else:
+                    # Keep the failed turns in front of any newer ones and try them all again later
+                    newer = self.pending.get(chat_name)
+                    if newer:
+                        job["turns"].extend(newer["turns"])
+                        job["counted"] = newer["counted"]
+                        for key in ("namespace", "history_manager"):
+                            job[key] = newer[key]
+                    self.pending[chat_name] = job
+                    if chat_name in self.ready:
+                        self.ready.remove(chat_name)
+                    delay = min(INDEX_PARK_SECONDS * (2 ** min(failures, 16)), INDEX_PARK_MAX_SECONDS)
+                    self.parked[chat_name] = (time.monotonic() + delay, failures + 1)
+                    print(f"Parking {len(job['turns'])} turns of '{chat_name}' for {delay:g}s")
+                self.cond.notify_all()
+
+    def _process(self, job):
+        """Append the job's turns to the chat history, then index them with retries and add them to the similarity graph"""
+        job["history_manager"].save_turns(job["turns"])
+
+        for attempt in range(INDEX_RETRY_ATTEMPTS):
+            if upsert_turns(job["turns"], namespace=job["namespace"]):
+                try:
+                    similarity_service.add_turns(job["namespace"], job["turns"])
+                except Exception as e:
+                    print(f"Error updating similarity graph: {e}")
+                return True
+            # Exponential backoff with full jitter
+            delay = INDEX_RETRY_BASE_SECONDS * (2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+        print(f"Giving up indexing {len(job['turns'])} turns after {INDEX_RETRY_ATTEMPTS} attempts")
+        return False
+
+
+indexing_queue = IndexingQueue()
@@ -0,0 +1,146 @@
+import math
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Constant k in reciprocal rank fusion; larger values flatten the advantage of top ranks
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Query terms found in more than this fraction of a chat's turns are ignored as too common to rank by
+BM25_MAX_DOC_FREQ = float(os.getenv("BM25_MAX_DOC_FREQ", "0.5"))
+# Newest turns per chat kept in the lexical index; older ones are dropped to bound memory
+LEXICAL_MAX_TURNS = int(os.getenv("LEXICAL_MAX_TURNS", "1000"))
+# Turns read from history at a time while the index is built
+SYNC_BATCH_TURNS = 200
+
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be because been before being but by can could did do does
+doing for from had has have having he her here hers him his how i if in into is it its itself just me more
+most my no nor not now of off on once only or other our ours out over own same she should so some such than
+that the their theirs them then there these they this those through to too under until up very was we were
+what when where which while who whom why will with would you your yours
+""".split())
+
+# Identifiers, error codes, paths and file names stay whole tokens ("ERR_CONN_RESET", "src/app.py")
+TOKEN_PATTERN = re.compile(r"[\w][\w.\-/:]*[\w]|[\w]")
+SUBTOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    """Lower-cased terms of a text without stopwords; compound tokens are also indexed by their parts"""
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        parts = SUBTOKEN_PATTERN.findall(token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part not in STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    """Incremental in-memory BM25 index over the newest max_turns turns of one chat"""
+
+    def __init__(self, max_turns=LEXICAL_MAX_TURNS):
+        self.max_turns = max_turns
+        self.postings = {}    # term -> {turn_id: term frequency}
+        self.doc_lengths = {}  # turn_id -> number of terms, oldest indexed first
+        self.doc_terms = {}    # turn_id -> distinct terms, so a turn is removed without scanning every term
+        self.total_length = 0
+        self.last_id = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, turn):
+        """Index a turn's user and llm text; re-adding a turn id replaces it"""
+        terms = Counter(tokenize(turn.user_text + "\n" + (turn.llm_text or "")))
+        with self.lock:
+            if turn.id in self.doc_lengths:
+                self._remove(turn.id)
+            for term, count in terms.items():
+                self.postings.setdefault(term, {})[turn.id] = count
+            length = sum(terms.values())
+            self.doc_lengths[turn.id] = length
+            self.doc_terms[turn.id] = tuple(terms)
+            self.total_length += length
+            if self.last_id is None or turn.id > self.last_id:
+                self.last_id = turn.id
+            while len(self.doc_lengths) > self.max_turns:
+                self._remove(next(iter(self.doc_lengths)))
+
+    def _remove(self, turn_id):
+        for term in self.doc_terms.pop(turn_id):
+            docs = self.postings[term]
+            del docs[turn_id]
+            if not docs:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(turn_id)
+
+    def sync(self, history):
+        """Index the turns of a MainHistory that are newer than the last indexed one, at most max_turns of them"""
+        last = history.last_turn()
+        if not len(history) or last is None:
+            return
+        start = last.id - self.max_turns + 1
+        if self.last_id is not None:
+            start = max(start, self.last_id + 1)
+        # Read in batches so building the index never loads the whole history at once
+        for batch_start in range(max(start, 1), last.id + 1, SYNC_BATCH_TURNS):
+            batch_end = min(batch_start + SYNC_BATCH_TURNS, last.id + 1)
+            for turn in history.get_turns(list(range(batch_start, batch_end))):
+                self.add(turn)
+
+    def search(self, query, top_k=10, min_score=0.0):
+        """Return {turn_id: bm25 score} for the top_k best matching turns.
+
+        Terms in more than BM25_MAX_DOC_FREQ of the turns are skipped. A turn is
+        returned only if its score is at least min_score of the score a turn
+        matching every remaining query term would reach, so a hit on one minor
+        term of a longer query does not count.
+        """
+        terms = set(tokenize(query))
+        with self.lock:
+            doc_count = len(self.doc_lengths)
+            if not doc_count or not terms:
+                return {}
+            avg_length = self.total_length / doc_count
+            scores = Counter()
+            best_possible = 0.0
+            for term in terms:
+                docs = self.postings.get(term)
+                if not docs or len(docs) > BM25_MAX_DOC_FREQ * doc_count:
+                    continue
+                idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+                best_possible += idf * (BM25_K1 + 1)
+                for turn_id, freq in docs.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[turn_id] / avg_length)
+                    scores[turn_id] += idf * freq * (BM25_K1 + 1) / (freq + norm)
+            cutoff = min_score * best_possible
+            return {turn_id: score for turn_id, score in scores.most_common(top_k) if score >= cutoff}
+
+    def memory_bytes(self):
+        """Approximate memory held by the postings and per-turn tables"""
+        with self.lock:
+            total = sys.getsizeof(self.postings) + sys.getsizeof(self.doc_lengths) + sys.getsizeof(self.doc_terms)
+            total += sum(sys.getsizeof(term) + sys.getsizeof(docs) for term, docs in self.postings.items())
+            total += sum(sys.getsizeof(terms) for terms in self.doc_terms.values())
+            return total
+
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K):
+    """Fuse several {id: score} rankings into {id: sum of 1 / (k + rank)}"""
+    fused = {}
+    for ranking in rankings:
+        ordered = sorted(ranking.items(), key=lambda item: item[1], reverse=True)
+        for rank, (item_id, _) in enumerate(ordered, start=1):
+            fused[item_id] = fused.get(item_id, 0.0) + 1.0 / (k + rank)
+    return fused
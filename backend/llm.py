@@ -1,40 +1,226 @@
 from google import genai
 from google.genai import types
+import asyncio
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from cache_utils import LRUCache, DiskCache, content_key
+from client_utils import ServiceClient, ServiceUnavailable
+from metrics import span, record
 
 load_dotenv()
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 LLM_MODEL = os.getenv("LLM_MODEL", "models/gemini-flash-latest")
+# Deadline per call including retries (for streams: until the first chunk, then between chunks)
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+# One client, so every call shares its connection pool; each HTTP request is also capped at the deadline
+client = genai.Client(
+    api_key=os.getenv("GEMINI_API_KEY"),
+    http_options=types.HttpOptions(timeout=int(LLM_TIMEOUT_SECONDS * 1000))
+)
+gemini = ServiceClient("gemini", LLM_MAX_CONCURRENCY, LLM_TIMEOUT_SECONDS)
+# Length cap given to the model for each background summary
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "150"))
+
+# Response cache for byte-identical prompts: opt-in, in-memory LRU plus an optional
+# SQLite tier (disabled when LLM_CACHE_PATH is empty)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true"
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "")
+LLM_DISK_CACHE_MAX_ENTRIES = int(os.getenv("LLM_DISK_CACHE_MAX_ENTRIES", "10000"))
+# Cached replies are replayed to streaming callers in chunks of this many characters
+LLM_CACHE_REPLAY_CHUNK_CHARS = int(os.getenv("LLM_CACHE_REPLAY_CHUNK_CHARS", "64"))
+
+GENERATION_CONFIG = types.GenerateContentConfig(
+    thinking_config=types.ThinkingConfig(thinking_budget=0)
+)
+# Part of every cache key, so changing the model or generation settings never serves stale replies
+GENERATION_KEY = content_key(LLM_MODEL, GENERATION_CONFIG.model_dump_json(exclude_none=True))
+
+response_cache = LRUCache(LLM_CACHE_SIZE, LLM_CACHE_TTL_SECONDS) if LLM_CACHE_ENABLED else None
+response_disk_cache = (
+    DiskCache(LLM_CACHE_PATH, "llm_responses", LLM_CACHE_TTL_SECONDS, LLM_DISK_CACHE_MAX_ENTRIES)
+    if LLM_CACHE_ENABLED and LLM_CACHE_PATH else None
+)
+# Hit/miss counts per calling function
+response_cache_counts = {}
+response_cache_counts_lock = threading.Lock()
+
+def response_cache_key(prompt):
+    return content_key(GENERATION_KEY, prompt)
+
+def _count(endpoint, hit):
+    with response_cache_counts_lock:
+        counts = response_cache_counts.setdefault(endpoint, {"hits": 0, "misses": 0})
+        counts["hits" if hit else "misses"] += 1
+
+def cached_response(prompt, endpoint):
+    """Return the cached reply for a prompt, or None; always None while the cache is disabled"""
+    if response_cache is None:
+        return None
+    key = response_cache_key(prompt)
+    reply = response_cache.get(key)
+    if reply is None and response_disk_cache is not None:
+        reply = response_disk_cache.get(key)
+        if reply is not None:
+            response_cache.put(key, reply)
+    _count(endpoint, reply is not None)
+    return reply
+
+async def cached_response_async(prompt, endpoint):
+    """cached_response, with the disk tier read off the event loop"""
+    if response_disk_cache is None:
+        return cached_response(prompt, endpoint)
+    return await asyncio.to_thread(cached_response, prompt, endpoint)
+
+def cache_response(prompt, reply):
+    """Store a successful reply"""
+    if response_cache is None or not reply:
+        return
+    key = response_cache_key(prompt)
+    response_cache.put(key, reply)
+    if response_disk_cache is not None:
+        response_disk_cache.put(key, reply)
+
+async def cache_response_async(prompt, reply):
+    """cache_response, with the disk tier written off the event loop"""
+    if response_disk_cache is None:
+        cache_response(prompt, reply)
+    else:
+        await asyncio.to_thread(cache_response, prompt, reply)
+
+def replay_chunks(reply):
+    """Split a cached reply into stream chunks"""
+    size = max(LLM_CACHE_REPLAY_CHUNK_CHARS, 1)
+    return [reply[i:i + size] for i in range(0, len(reply), size)]
+
+def response_cache_stats():
+    """Hit/miss counters for the response cache tiers and per calling function"""
+    if response_cache is None:
+        return {"enabled": False}
+    with response_cache_counts_lock:
+        endpoints = {
+            endpoint: dict(counts, hit_rate=counts["hits"] / (counts["hits"] + counts["misses"]))
+            for endpoint, counts in response_cache_counts.items()
+        }
+    stats = {"enabled": True, "memory": response_cache.stats(), "endpoints": endpoints}
+    if response_disk_cache is not None:
+        stats["disk"] = response_disk_cache.stats()
+    return stats
 
 def ask_llm(prompt):
+    """Reply to a prompt; raises ServiceUnavailable if Gemini fails or is short-circuited"""
+    cached = cached_response(prompt, "ask_llm")
+    if cached is not None:
+        return cached
     try:
-        response = client.models.generate_content(
-            model=LLM_MODEL,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                thinking_config=types.ThinkingConfig(thinking_budget=0)
+        with span("llm"):
+            response = gemini.call(
+                client.models.generate_content,
+                model=LLM_MODEL,
+                contents=prompt,
+                config=GENERATION_CONFIG
             )
-        )
-        return response.text
-    except Exception as e:
+    except ServiceUnavailable as e:
         print(f"Error calling LLM: {e}")
-        return "Sorry, I encountered an error processing your request."
+        raise
+    cache_response(prompt, response.text)
+    return response.text
 
 def ask_llm_stream(prompt):
     """Stream LLM response"""
+    cached = cached_response(prompt, "ask_llm_stream")
+    if cached is not None:
+        yield from replay_chunks(cached)
+        return
     try:
-        response = client.models.generate_content_stream(
-            model=LLM_MODEL,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                thinking_config=types.ThinkingConfig(thinking_budget=0)
+        chunks = []
+        with span("llm"):
+            start = time.perf_counter()
+            for chunk in gemini.stream(
+                client.models.generate_content_stream,
+                model=LLM_MODEL,
+                contents=prompt,
+                config=GENERATION_CONFIG
+            ):
+                if chunk.text:
+                    if not chunks:
+                        record("llm_first_token", time.perf_counter() - start)
+                    chunks.append(chunk.text)
+                    yield chunk.text
+    except ServiceUnavailable as e:
+        print(f"Error calling LLM: {e}")
+        raise
+    # Only a reply that streamed to the end is cached
+    cache_response(prompt, "".join(chunks))
+
+async def ask_llm_async(prompt):
+    """Non-blocking ask_llm using the async genai client"""
+    cached = await cached_response_async(prompt, "ask_llm_async")
+    if cached is not None:
+        return cached
+    try:
+        with span("llm"):
+            response = await gemini.call_async(
+                client.aio.models.generate_content,
+                model=LLM_MODEL,
+                contents=prompt,
+                config=GENERATION_CONFIG
             )
-        )
-        for chunk in response:
-            if chunk.text:
-                yield chunk.text
-    except Exception as e:
+    except ServiceUnavailable as e:
+        print(f"Error calling LLM: {e}")
+        raise
+    await cache_response_async(prompt, response.text)
+    return response.text
+
+async def ask_llm_stream_async(prompt):
+    """Stream LLM response without blocking the event loop"""
+    cached = await cached_response_async(prompt, "ask_llm_stream_async")
+    if cached is not None:
+        for chunk in replay_chunks(cached):
+            yield chunk
+        return
+    try:
+        chunks = []
+        with span("llm"):
+            start = time.perf_counter()
+            async for chunk in gemini.stream_async(
+                client.aio.models.generate_content_stream,
+                model=LLM_MODEL,
+                contents=prompt,
+                config=GENERATION_CONFIG
+            ):
+                if chunk.text:
+                    if not chunks:
+                        record("llm_first_token", time.perf_counter() - start)
+                    chunks.append(chunk.text)
+                    yield chunk.text
+    except ServiceUnavailable as e:
         print(f"Error calling LLM: {e}")
-        yield "Sorry, I encountered an error processing your request."
+        raise
+    # Only a reply that streamed to the end is cached
+    await cache_response_async(prompt, "".join(chunks))
+
+def summarize(text, max_words=SUMMARY_MAX_WORDS):
+    """Condense part of a conversation into a short summary; None if the LLM call fails"""
+    prompt = (
+        f"Summarize the following part of a conversation in at most {max_words} words. "
+        "Keep names, identifiers, numbers, decisions and open questions.\n\n"
+        f"{text}"
+    )
+    try:
+        with span("llm_summary"):
+            response = gemini.call(
+                client.models.generate_content,
+                model=LLM_MODEL,
+                contents=prompt,
+                config=GENERATION_CONFIG
+            )
+        return response.text or None
+    except ServiceUnavailable as e:
+        print(f"Error summarizing: {e}")
+        return None
@@ -1,6 +1,7 @@
 from memory import MainHistory, LLMContext
-from pinecone_utils import upsert_message, query_similar_turns, set_namespace
+from pinecone_utils import upsert_turn, query_similar_turns, set_namespace
 from llm import ask_llm
+from client_utils import ServiceUnavailable
 from chat_manager import ChatManager
 from history_manager import HistoryManager
 import os
@@ -102,14 +103,17 @@ def main():
             history_prompt = context.to_prompt()
             full_prompt = history_prompt + f"User: {user_input}\nAssistant: "
             
-            reply = ask_llm(full_prompt)
+            try:
+                reply = ask_llm(full_prompt)
+            except ServiceUnavailable:
+                print("LLM: Sorry, I encountered an error processing your request.")
+                continue
             print("LLM:", reply)
 
             current_turn_id = history.add_turn(user_input, reply)
             chat_manager.update_message_count(chat_name)
 
-            upsert_message(f"{current_turn_id}_u", user_input, current_turn_id, "user")
-            upsert_message(f"{current_turn_id}_l", reply, current_turn_id, "llm")
+            upsert_turn(current_turn_id, user_input, reply)
 
             if DEBUG_MODE:
                 print("\n---prompt sent---")
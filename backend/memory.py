@@ -1,46 +1,340 @@
+import operator
+import sys
+import threading
+
+from metrics import span
+
+USER_ROLE = sys.intern("user")
+LLM_ROLE = sys.intern("llm")
+
+class Turn:
+    """One user message and the LLM reply to it.
+    
+    Slotted so resident turns cost one small object instead of three dicts;
+    roles are shared constants. to_dict/from_dict convert to the JSON shape
+    used on disk and in the API.
+    """
+    __slots__ = ("id", "user_text", "llm_text", "truncated")
+
+    def __init__(self, turn_id, user_text, llm_text, truncated=False):
+        self.id = turn_id
+        self.user_text = user_text
+        self.llm_text = llm_text
+        self.truncated = truncated
+
+    @classmethod
+    def from_dict(cls, data):
+        llm = data.get("llm")
+        return cls(data["id"], data["user"]["text"], llm["text"] if llm else None)
+
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "user": {"role": USER_ROLE, "text": self.user_text},
+            "llm": {"role": LLM_ROLE, "text": self.llm_text}
+        }
+        if self.truncated:
+            data["truncated"] = True
+        return data
+
+    def __eq__(self, other):
+        if not isinstance(other, Turn):
+            return NotImplemented
+        return (self.id, self.user_text, self.llm_text) == (other.id, other.user_text, other.llm_text)
+
+    def __repr__(self):
+        return f"Turn(id={self.id!r})"
+
+def turns_to_dicts(turns):
+    """Serialize turns for an API response"""
+    return [turn.to_dict() for turn in turns]
+
 class MainHistory: 
-    def __init__(self):
-        self.history = []  
+    """Conversation turns, with only the most recent ones resident in memory.
+    
+    Older turns stay in the history store and are read on demand through its
+    offset index, so opening a long chat does not load all of it.
+    """
+    def __init__(self, store=None):
+        self.history = []  # resident turns: a contiguous run ending at the newest turn
+        self.store = store
+        self.offset = 0  # number of older turns that are not resident
+
+    def load_recent(self, resident_turns):
+        """Make the newest resident_turns turns from the store resident"""
+        self.history, _ = self.store.load_page(limit=resident_turns)
+        self.offset = self.store.turn_count() - len(self.history)
+
+    def __len__(self):
+        return self.offset + len(self.history)
 
     def add_turn(self, user_text, llm_text):
-        turn_id = len(self.history) + 1  # Start from 1 instead of 0
-        turn = {
-            "id": turn_id,
-            "user": {"role": "user", "text": user_text},
-            "llm": {"role": "llm", "text": llm_text}
-        }
-        self.history.append(turn)
+        turn_id = len(self) + 1  # Start from 1 instead of 0
+        self.history.append(Turn(turn_id, user_text, llm_text))
         return turn_id
 
-class Node:
-    def __init__(self, turn):
-        self.turn = turn
-        self.next = None
+    def add_stored_turn(self, user_text, llm_text, resident_turns):
+        """Add a turn whose id the store allocates (stores shared by several workers)"""
+        turn = self.store.reserve_turn(user_text, llm_text)
+        if turn.id == len(self) + 1:
+            self.history.append(turn)
+        else:
+            # Another worker added turns to this chat since it was loaded here
+            self.load_recent(max(resident_turns, len(self.history) + 1))
+        return turn.id
+
+    def trim(self, max_resident, keep_after=None):
+        """Drop the oldest resident turns beyond max_resident; turns newer than keep_after stay resident"""
+        excess = len(self.history) - max_resident
+        if excess <= 0:
+            return 0
+        if keep_after is not None:
+            excess = min(excess, max(keep_after - self.history[0].id + 1, 0))
+        del self.history[:excess]
+        self.offset += excess
+        return excess
+
+    def unsaved_turns(self):
+        """Resident turns the store does not have yet"""
+        stored = self.store.turn_count()
+        return self.history[max(stored - self.offset, 0):]
+
+    def last_turn(self):
+        return self.history[-1] if self.history else None
+
+    def _resident_index(self, turn_id):
+        """Index of a turn in self.history, or None if it is not resident"""
+        if not self.history:
+            return None
+        # Turn ids are consecutive, so the position follows from the first resident id
+        pos = turn_id - self.history[0].id
+        if 0 <= pos < len(self.history) and self.history[pos].id == turn_id:
+            return pos
+        return None
+
+    def get_turns(self, turn_ids):
+        """Look up turns by id, reading non-resident ones from the store"""
+        resident = {}
+        for tid in turn_ids:
+            pos = self._resident_index(tid)
+            if pos is not None:
+                resident[tid] = self.history[pos]
+        missing = [tid for tid in turn_ids if tid not in resident]
+        if missing and self.store is not None:
+            for turn in self.store.get_turns(missing):
+                resident[turn.id] = turn
+        return [resident[tid] for tid in turn_ids if tid in resident]
+
+    def all_turns(self):
+        """Every turn, oldest first"""
+        if self.offset == 0:
+            return list(self.history)
+        return self.store.get_turns(self.store.turn_ids(0, self.offset)) + self.history
+
+    def page(self, before=None, limit=50):
+        """Return (turns, next_cursor) for up to `limit` turns preceding turn id `before`.
+        
+        next_cursor is the id to pass as `before` for the next older page, or
+        None once the first turn has been returned.
+        """
+        end = len(self)
+        if before is not None:
+            resident_pos = self._resident_index(before)
+            if resident_pos is not None:
+                end = self.offset + resident_pos
+            elif self.store is not None and self.store.position(before) is not None:
+                end = min(self.store.position(before), self.offset)
+        start = max(0, end - limit)
+        
+        turns = []
+        if start < self.offset:
+            turns = self.store.get_turns(self.store.turn_ids(start, min(end, self.offset)))
+        turns += self.history[max(start - self.offset, 0):max(end - self.offset, 0)]
+        return turns, (turns[0].id if start > 0 and turns else None)
+
+# Rough average for English text; close enough to budget prompts without a tokenizer call
+CHARS_PER_TOKEN = 4
+# Overflow turns are truncated only if at least this many tokens of budget remain
+MIN_TRUNCATED_TURN_TOKENS = 32
+TURN_OVERHEAD_CHARS = len("User: \nAssistant: \n")
+
+def estimate_tokens(text):
+    """Fast local token estimate used for budgeting"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def render_turn(turn):
+    """Prompt fragment for one turn"""
+    fragment = f"User: {turn.user_text}\n"
+    if turn.llm_text is not None:
+        fragment += f"Assistant: {turn.llm_text}\n"
+    return fragment
+
+def _shorten(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    return text[:max(max_chars - 1, 0)].rstrip() + "…"
+
+def truncate_turn(turn, max_tokens):
+    """Copy of a turn cut down to roughly max_tokens, keeping the start of each message"""
+    budget = max(max_tokens * CHARS_PER_TOKEN - TURN_OVERHEAD_CHARS, 0)
+    user_text = turn.user_text
+    llm_text = turn.llm_text or ""
+    # Short messages keep their full text and leave the rest of the budget to the other one
+    user_chars = min(len(user_text), max(budget // 2, budget - len(llm_text)))
+    shortened_llm = _shorten(llm_text, budget - user_chars) if turn.llm_text is not None else None
+    return Turn(turn.id, _shorten(user_text, user_chars), shortened_llm, truncated=True)
+
+def _same_turn(a, b):
+    """True if two turns render to the same prompt fragment"""
+    if a is b:
+        return True
+    return (
+        a.user_text == b.user_text
+        and a.llm_text == b.llm_text
+    )
 
 class LLMContext:
+    """Turns selected for the prompt, kept per session and updated by diff.
+    
+    Each turn's prompt fragment is rendered once and reused while the turn
+    stays in the context, and the joined prompt is cached, so consecutive
+    requests only pay for the turns that were added or removed.
+    """
     def __init__(self):
-        self.head = None
-        self.tail = None
+        self.lock = threading.Lock()
+        self.clear()
 
     def clear(self):
-        self.head = None
-        self.tail = None
+        self.ids = []         # turn ids in prompt order
+        self.turn_list = []   # the Turn objects, in the same order
+        self.entries = {}     # turn id -> (turn, rendered fragment, estimated tokens)
+        self.tokens = 0       # estimated tokens of all fragments
+        self.prompt = ""      # fragments joined, or None when stale
 
     def add(self, turn):
-        node = Node(turn)
-        if not self.head:
-            self.head = node
-            self.tail = node
+        fragment = render_turn(turn)
+        tokens = estimate_tokens(fragment)
+        self.ids.append(turn.id)
+        self.turn_list.append(turn)
+        self.entries[turn.id] = (turn, fragment, tokens)
+        self.tokens += tokens
+        if self.prompt is not None:
+            self.prompt += fragment
+
+    def remove(self, turn_id):
+        entry = self.entries.pop(turn_id, None)
+        if entry is not None:
+            pos = self.ids.index(turn_id)
+            del self.ids[pos]
+            del self.turn_list[pos]
+            self.tokens -= entry[2]
+            self.prompt = None
+
+    def set_turns(self, turns):
+        """Make the context hold exactly these turns, in this order.
+        
+        Fragments of turns that were already present with the same text are
+        reused. Returns (added_ids, removed_ids).
+        """
+        new_ids = [turn.id for turn in turns]
+        keep = set(new_ids)
+        removed_ids = [tid for tid in self.ids if tid not in keep]
+        for tid in removed_ids:
+            del self.entries[tid]
+        added_ids = []
+        appended_only = not removed_ids and new_ids[:len(self.ids)] == self.ids
+        for turn in turns:
+            entry = self.entries.get(turn.id)
+            if entry is not None and _same_turn(entry[0], turn):
+                continue
+            if entry is not None:
+                # Same turn with different text, e.g. truncated differently
+                appended_only = False
+            else:
+                added_ids.append(turn.id)
+            fragment = render_turn(turn)
+            self.entries[turn.id] = (turn, fragment, estimate_tokens(fragment))
+        if appended_only and self.prompt is not None:
+            self.prompt += "".join(self.entries[tid][1] for tid in new_ids[len(self.ids):])
         else:
-            self.tail.next = node
-            self.tail = node
+            self.prompt = None
+        self.ids = new_ids
+        self.turn_list = [self.entries[tid][0] for tid in new_ids]
+        self.tokens = sum(self.entries[tid][2] for tid in new_ids)
+        return added_ids, removed_ids
+
+    def _appended_turns(self, turns):
+        """New tail turns if `turns` is the current context plus newer turns, else None"""
+        count = len(self.turn_list)
+        if len(turns) < count or not all(map(operator.is_, turns, self.turn_list)):
+            return None
+        tail = turns[count:]
+        if tail and count and tail[0].id <= self.ids[-1]:
+            return None
+        return tail
+
+    def pack(self, turns, scores=None, token_budget=None, pinned_ids=()):
+        """Fill the context greedily by similarity score until token_budget is used up.
+        
+        Pinned turns go first, ties are broken by recency, and the selected turns
+        end up in conversation order. A turn that does not fit is truncated into
+        the remaining budget if enough is left, otherwise dropped. The context is
+        updated by diff against the previous selection.
+        Returns (tokens_used, truncated_ids, dropped_ids).
+        """
+        # Common case: the same turns as last time plus the newest ones
+        tail = self._appended_turns(turns)
+        if tail is not None:
+            fragments = [render_turn(turn) for turn in tail]
+            total = self.tokens + sum(estimate_tokens(fragment) for fragment in fragments)
+            if token_budget is None or total <= token_budget:
+                for turn in tail:
+                    self.add(turn)
+                return total, [], []
+        
+        costs = {turn.id: self._tokens(turn) for turn in turns}
+        total = sum(costs.values())
+        if token_budget is None or total <= token_budget:
+            # Everything fits, so the order of selection does not matter
+            self.set_turns(sorted(turns, key=lambda t: t.id))
+            return total, [], []
+        
+        scores = scores or {}
+        order = sorted(turns, key=lambda t: (t.id in pinned_ids, scores.get(t.id, 0.0), t.id), reverse=True)
+        selected = []
+        truncated_ids = []
+        dropped_ids = []
+        used = 0
+        for turn in order:
+            cost = costs[turn.id]
+            remaining = token_budget - used
+            if cost <= remaining:
+                selected.append(turn)
+                used += cost
+            elif remaining >= MIN_TRUNCATED_TURN_TOKENS:
+                turn = truncate_turn(turn, remaining)
+                selected.append(turn)
+                used += estimate_tokens(render_turn(turn))
+                truncated_ids.append(turn.id)
+            else:
+                dropped_ids.append(turn.id)
+        selected.sort(key=lambda t: t.id)
+        self.set_turns(selected)
+        return used, sorted(truncated_ids), sorted(dropped_ids)
+
+    def _tokens(self, turn):
+        """Token estimate for a turn, from the cached fragment when the turn is already in the context"""
+        entry = self.entries.get(turn.id)
+        if entry is not None and _same_turn(entry[0], turn):
+            return entry[2]
+        return estimate_tokens(render_turn(turn))
+
+    def turns(self):
+        """Turns in the context, in order"""
+        return list(self.turn_list)
 
     def to_prompt(self):
-        prompt = ""
-        curr = self.head
-        while curr:
-            prompt += f"User: {curr.turn['user']['text']}\n"
-            if curr.turn.get('llm'):
-                prompt += f"Assistant: {curr.turn['llm']['text']}\n"
-            curr = curr.next
-        return prompt
\ No newline at end of file
+        with span("prompt_render"):
+            if self.prompt is None:
+                self.prompt = "".join(self.entries[tid][1] for tid in self.ids)
+            return self.prompt
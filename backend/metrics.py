@@ -0,0 +1,111 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Stage histograms behind /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Also report each request's stage timings (Server-Timing header, SSE done event)
+METRICS_REQUEST_TIMINGS = os.getenv("METRICS_REQUEST_TIMINGS", "false").lower() == "true"
+
+# Upper bounds in seconds, from cache hits and local work up to slow LLM replies
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Stage durations of the request being handled: stage -> seconds. Set per request, and
+# visible in worker threads started with asyncio.to_thread, which copy the context
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    """Prometheus-style histogram with one label, safe to observe from any thread"""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # label value -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for value, series in sorted(self.series.items()):
+                label = f'{self.label}="{value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+                lines.append(f"{self.name}_sum{{{label}}} {series[-2]}")
+                lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return "\n".join(lines)
+
+
+stage_seconds = Histogram("llm_context_stage_seconds", "Time spent in each stage of handling a turn", "stage")
+request_seconds = Histogram("llm_context_request_seconds", "End-to-end latency of completed message requests", "endpoint")
+
+
+def record(stage, seconds):
+    """Add a stage duration to its histogram and to the current request's timings"""
+    if METRICS_ENABLED:
+        stage_seconds.observe(stage, seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block as one occurrence of a stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def start_request():
+    """Begin collecting stage timings for the current request; returns the timings dict"""
+    timings = {}
+    request_timings.set(timings)
+    return timings
+
+
+def finish_request(endpoint, start):
+    """Record a request's total latency; returns its timings in milliseconds if they are reported"""
+    elapsed = time.perf_counter() - start
+    if METRICS_ENABLED:
+        request_seconds.observe(endpoint, elapsed)
+    if not METRICS_REQUEST_TIMINGS:
+        return None
+    timings = request_timings.get() or {}
+    result = {stage: round(seconds * 1000, 2) for stage, seconds in timings.items()}
+    result["total"] = round(elapsed * 1000, 2)
+    return result
+
+
+def server_timing(timings):
+    """Server-Timing header value for timings in milliseconds"""
+    return ", ".join(f"{stage};dur={ms}" for stage, ms in timings.items())
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    return stage_seconds.render() + "\n" + request_seconds.render() + "\n"
@@ -1,59 +1,198 @@
+import asyncio
+import contextvars
+import hashlib
 import os
+import threading
 from pinecone import Pinecone
 from dotenv import load_dotenv
+from vector_store import create_vector_store
+from cache_utils import LRUCache, DiskCache, content_key
+from client_utils import ServiceClient
+from metrics import span
+from memory import Turn
 
 load_dotenv()
 
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 INDEX_NAME = os.getenv("PINECONE_INDEX_NAME", "llm-context-index")
 EMBED_MODEL = os.getenv("PINECONE_EMBED_MODEL", "llama-text-embed-v2")
+# "pinecone" for the hosted index, "local" for the in-process NumPy store
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone").lower()
+# Pinecone inference accepts up to 96 inputs per embed call for llama-text-embed-v2
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "96"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "100"))
+# Deadline per embed/upsert/query call including retries, and calls in flight at once
+PINECONE_TIMEOUT_SECONDS = float(os.getenv("PINECONE_TIMEOUT_SECONDS", "10"))
+PINECONE_MAX_CONCURRENCY = int(os.getenv("PINECONE_MAX_CONCURRENCY", "32"))
 
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(INDEX_NAME)
+# Embedding cache: in-memory LRU plus an optional SQLite tier (disabled when EMBED_CACHE_PATH is empty)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))
+EMBED_CACHE_TTL_SECONDS = float(os.getenv("EMBED_CACHE_TTL_SECONDS", "3600"))
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "")
+EMBED_DISK_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_DISK_CACHE_MAX_ENTRIES", "100000"))
+# Only enable for symmetric embedding models, where query and passage vectors are identical
+EMBED_REUSE_QUERY_AS_PASSAGE = os.getenv("EMBED_REUSE_QUERY_AS_PASSAGE", "false").lower() == "true"
 
-# Global namespace variable - set by main.py
-current_namespace = "default"
+# Pinecone namespace length limit, also applied by ChatManager.sanitize_namespace
+NAMESPACE_MAX_LENGTH = 63
+SUMMARY_NAMESPACE_PREFIX = "summaries-"
+SUMMARY_NAMESPACE_HASH_CHARS = 12
+
+# Built on first use, so the local backend starts without PINECONE_API_KEY
+pc = None
+pc_lock = threading.Lock()
+
+def get_pinecone():
+    """The shared Pinecone client, created on the first call"""
+    global pc
+    with pc_lock:
+        if pc is None:
+            pc = Pinecone(api_key=PINECONE_API_KEY)
+        return pc
+
+pinecone_client = ServiceClient("pinecone", PINECONE_MAX_CONCURRENCY, PINECONE_TIMEOUT_SECONDS)
+store = create_vector_store(VECTOR_BACKEND, get_pc=get_pinecone, index_name=INDEX_NAME, client=pinecone_client)
+
+embedding_cache = LRUCache(EMBED_CACHE_SIZE, EMBED_CACHE_TTL_SECONDS)
+embedding_disk_cache = (
+    DiskCache(EMBED_CACHE_PATH, "embeddings", EMBED_CACHE_TTL_SECONDS, EMBED_DISK_CACHE_MAX_ENTRIES) if EMBED_CACHE_PATH else None
+)
+
+# Namespace used when a call does not pass one; a context variable, so each
+# request task or thread sees only the value it set itself
+current_namespace = contextvars.ContextVar("current_namespace", default="default")
 
 def set_namespace(namespace):
-    """Set the current namespace for all operations"""
-    global current_namespace
-    current_namespace = namespace
+    """Set the default namespace for operations in the current context"""
+    current_namespace.set(namespace)
 
-def embed_text(text, input_type):
+def resolve_namespace(namespace=None):
+    """The given namespace, or the current context's default"""
+    return namespace if namespace is not None else current_namespace.get()
+
+def embedding_cache_key(text, input_type):
+    """Cache key for an embedding; query and passage share keys when the model is symmetric"""
+    if EMBED_REUSE_QUERY_AS_PASSAGE:
+        input_type = "query"
+    return content_key(EMBED_MODEL, input_type, text)
+
+def embedding_cache_stats():
+    """Hit/miss counters for the embedding cache tiers"""
+    stats = {"memory": embedding_cache.stats()}
+    if embedding_disk_cache is not None:
+        stats["disk"] = embedding_disk_cache.stats()
+    return stats
+
+def embed_texts(texts, input_type):
+    """Embed several texts, sending up to EMBED_BATCH_SIZE inputs per inference call.
+    
+    Cached embeddings are reused; only cache misses reach the inference API.
+    """
     try:
-        response = pc.inference.embed(
-            model=EMBED_MODEL,
-            inputs=[text],
-            parameters={"input_type": input_type}
-        )
-        return response.data[0].values
+        keys = [embedding_cache_key(text, input_type) for text in texts]
+        vectors = [embedding_cache.get(key) for key in keys]
+        if embedding_disk_cache is not None:
+            for i, key in enumerate(keys):
+                if vectors[i] is None:
+                    vectors[i] = embedding_disk_cache.get(key)
+                    if vectors[i] is not None:
+                        embedding_cache.put(key, vectors[i])
+        
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        for start in range(0, len(missing), EMBED_BATCH_SIZE):
+            batch = missing[start:start + EMBED_BATCH_SIZE]
+            with span("embed"):
+                response = pinecone_client.call(
+                    get_pinecone().inference.embed,
+                    model=EMBED_MODEL,
+                    inputs=[texts[i] for i in batch],
+                    parameters={"input_type": input_type}
+                )
+            for i, item in zip(batch, response.data):
+                vectors[i] = item.values
+                embedding_cache.put(keys[i], item.values)
+                if embedding_disk_cache is not None:
+                    embedding_disk_cache.put(keys[i], list(item.values))
+        return vectors
     except Exception as e:
         print(f"Error embedding text: {e}")
         return None
 
-def upsert_message(msg_id, text, turn_id, role):
+def embed_text(text, input_type):
+    vectors = embed_texts([text], input_type)
+    if not vectors:
+        return None
+    return vectors[0]
+
+def upsert_message(msg_id, text, turn_id, role, namespace=None):
     try:
         vector = embed_text(text, input_type="passage")
         if vector is None:
             return False
         
-        index.upsert(
-            vectors=[{
-                "id": str(msg_id),
+        with span("vector_upsert"):
+            store.upsert(
+                vectors=[{
+                    "id": str(msg_id),
+                    "values": vector,
+                    "metadata": {
+                        "turn_id": turn_id, 
+                        "role": role
+                    }
+                }],
+                namespace=resolve_namespace(namespace)
+            )
+        return True
+    except Exception as e:
+        print(f"Error upserting message: {e}")
+        return False
+
+def upsert_turns(turns, namespace=None):
+    """Embed and upsert the user and llm messages of many turns in batched calls"""
+    namespace = resolve_namespace(namespace)
+    try:
+        records = []
+        for turn in turns:
+            for suffix, role, text in (("u", "user", turn.user_text), ("l", "llm", turn.llm_text)):
+                if text:
+                    records.append((f"{turn.id}_{suffix}", text, turn.id, role))
+        if not records:
+            return True
+
+        vectors = embed_texts([text for _, text, _, _ in records], input_type="passage")
+        if vectors is None:
+            return False
+
+        items = [
+            {
+                "id": msg_id,
                 "values": vector,
                 "metadata": {
-                    "turn_id": turn_id, 
+                    "turn_id": turn_id,
                     "role": role
                 }
-            }],
-            namespace=current_namespace
-        )
+            }
+            for (msg_id, _, turn_id, role), vector in zip(records, vectors)
+        ]
+        for start in range(0, len(items), UPSERT_BATCH_SIZE):
+            with span("vector_upsert"):
+                store.upsert(
+                    vectors=items[start:start + UPSERT_BATCH_SIZE],
+                    namespace=namespace
+                )
         return True
     except Exception as e:
-        print(f"Error upserting message: {e}")
+        print(f"Error upserting turns: {e}")
         return False
 
-def query_similar_turns(text, threshold=None, top_k=None):
+def upsert_turn(turn_id, user_text, llm_text, namespace=None):
+    """Embed both messages of a turn in one call and upsert them in one request"""
+    return upsert_turns([Turn(turn_id, user_text, llm_text)], namespace=namespace)
+
+class RetrievalUnavailable(Exception):
+    """Raised instead of returning no matches when embedding or the vector query fails"""
+
+def query_similar_turns(text, threshold=None, top_k=None, namespace=None, raise_errors=False):
     try:
         if threshold is None:
             threshold = float(os.getenv("SIMILARITY_THRESHOLD", "0.40"))
@@ -62,14 +201,19 @@ def query_similar_turns(text, threshold=None, top_k=None):
         
         query_vector = embed_text(text, input_type="query")
         if query_vector is None:
+            if raise_errors:
+                raise RetrievalUnavailable("query embedding failed")
             return [], {}
         
-        result = index.query(
-            vector=query_vector,
-            top_k=top_k,
-            include_metadata=True,
-            namespace=current_namespace
-        )
+        # Scores below the threshold are cut off by the store, so the response stays within top_k
+        with span("vector_query"):
+            result = store.query(
+                vector=query_vector,
+                top_k=top_k,
+                include_metadata=True,
+                namespace=resolve_namespace(namespace),
+                min_score=threshold
+            )
 
         if not result or not result.matches:
             return [], {}
@@ -86,14 +230,97 @@ def query_similar_turns(text, threshold=None, top_k=None):
                     similarity_scores[turn_id] = match.score
         
         return turn_ids, similarity_scores
+    except RetrievalUnavailable:
+        raise
     except Exception as e:
         print(f"Error querying similar turns: {e}")
+        if raise_errors:
+            raise RetrievalUnavailable(str(e)) from e
         return [], {}
 
+async def query_similar_turns_async(text, threshold=None, top_k=None, namespace=None, raise_errors=False):
+    """query_similar_turns offloaded to a worker thread so the event loop never blocks"""
+    return await asyncio.to_thread(query_similar_turns, text, threshold, top_k, resolve_namespace(namespace), raise_errors)
+
+def summary_namespace(namespace=None):
+    """Namespace holding a chat's summary vectors, kept apart so turn queries only see turns.
+
+    Chat namespaces never contain "-", so the prefix cannot collide with one; long
+    names are shortened and suffixed with a hash to stay within the length limit.
+    """
+    namespace = resolve_namespace(namespace)
+    name = SUMMARY_NAMESPACE_PREFIX + namespace
+    if len(name) <= NAMESPACE_MAX_LENGTH:
+        return name
+    digest = hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:SUMMARY_NAMESPACE_HASH_CHARS]
+    keep = NAMESPACE_MAX_LENGTH - len(SUMMARY_NAMESPACE_PREFIX) - len(digest) - 1
+    return f"{SUMMARY_NAMESPACE_PREFIX}{namespace[:keep]}-{digest}"
+
+def upsert_summaries(summaries, namespace=None):
+    """Embed and upsert summaries into the chat's summary namespace"""
+    if not summaries:
+        return True
+    try:
+        vectors = embed_texts([summary.text for summary in summaries], input_type="passage")
+        if vectors is None:
+            return False
+        items = [
+            {
+                "id": summary.id,
+                "values": vector,
+                "metadata": {
+                    "summary_id": summary.id,
+                    "level": summary.level,
+                    "first_turn": summary.first_turn,
+                    "last_turn": summary.last_turn
+                }
+            }
+            for summary, vector in zip(summaries, vectors)
+        ]
+        for start in range(0, len(items), UPSERT_BATCH_SIZE):
+            with span("vector_upsert"):
+                store.upsert(
+                    vectors=items[start:start + UPSERT_BATCH_SIZE],
+                    namespace=summary_namespace(namespace)
+                )
+        return True
+    except Exception as e:
+        print(f"Error upserting summaries: {e}")
+        return False
+
+def query_similar_summaries(text, threshold, top_k, namespace=None):
+    """Return {summary_id: score} for the chat's summaries scoring at least threshold"""
+    try:
+        query_vector = embed_text(text, input_type="query")
+        if query_vector is None:
+            return {}
+        with span("vector_query"):
+            result = store.query(
+                vector=query_vector,
+                top_k=top_k,
+                include_metadata=False,
+                namespace=summary_namespace(namespace),
+                min_score=threshold
+            )
+        if not result or not result.matches:
+            return {}
+        return {match.id: match.score for match in result.matches if match.score >= threshold}
+    except Exception as e:
+        print(f"Error querying similar summaries: {e}")
+        return {}
+
+async def query_similar_summaries_async(text, threshold, top_k, namespace=None):
+    """query_similar_summaries offloaded to a worker thread so the event loop never blocks"""
+    return await asyncio.to_thread(query_similar_summaries, text, threshold, top_k, resolve_namespace(namespace))
+
+async def upsert_turn_async(turn_id, user_text, llm_text, namespace=None):
+    """upsert_turn offloaded to a worker thread so the event loop never blocks"""
+    return await asyncio.to_thread(upsert_turn, turn_id, user_text, llm_text, resolve_namespace(namespace))
+
 def delete_namespace(namespace):
     """Delete all vectors in a namespace"""
     try:
-        index.delete(delete_all=True, namespace=namespace)
+        store.delete_namespace(namespace)
         return True
     except Exception as e:
         print(f"Error deleting namespace: {e}")
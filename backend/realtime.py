@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Frames waiting to be written to one WebSocket client; stream producers wait once it is full
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Requests (streamed replies included) one connection may have in flight; more are refused
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "8"))
+
+
+def encode_frame(frame):
+    """Compact JSON text frame"""
+    return json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
+
+
+class Connection:
+    """One WebSocket client with a bounded outbound queue drained by a single writer.
+
+    Replies go through send(), which waits while the queue is full, so a slow
+    client slows down the streams feeding it instead of buffering them.
+    Subscription pushes go through push(), which never waits: a push that does
+    not fit is dropped and the client is told to resync that chat once the
+    queue has drained.
+    """
+
+    def __init__(self, websocket, queue_size=WS_SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(queue_size)
+        self.subscriptions = set()
+        self.lagged = set()   # chats whose pushes were dropped
+        self.tasks = {}       # request id -> task answering it
+
+    async def send(self, frame):
+        await self.queue.put(frame)
+
+    def push(self, chat_name, frame):
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.lagged.add(chat_name)
+
+    async def run_writer(self):
+        """Write queued frames until the socket closes"""
+        while True:
+            frame = await self.queue.get()
+            await self.websocket.send_text(encode_frame(frame))
+            if self.lagged and self.queue.empty():
+                for chat_name in sorted(self.lagged):
+                    await self.websocket.send_text(encode_frame({"type": "resync", "chat_name": chat_name}))
+                self.lagged.clear()
+
+    def start(self, request_id, coro):
+        """Answer a request in its own task, so a long reply never holds up the connection's other requests"""
+        task = asyncio.create_task(coro)
+        self.tasks[request_id] = task
+
+        def finished(_):
+            if self.tasks.get(request_id) is task:
+                del self.tasks[request_id]
+
+        task.add_done_callback(finished)
+        return task
+
+    def cancel(self, request_id):
+        task = self.tasks.get(request_id)
+        if task is not None:
+            task.cancel()
+
+    def cancel_all(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+
+class ChatHub:
+    """Which connections watch which chats; used from the event loop only"""
+
+    def __init__(self):
+        self.connections = set()
+        self.subscribers = {}  # chat_name -> set of Connection
+
+    def connect(self, connection):
+        self.connections.add(connection)
+
+    def subscribe(self, connection, chat_name):
+        self.subscribers.setdefault(chat_name, set()).add(connection)
+        connection.subscriptions.add(chat_name)
+
+    def unsubscribe(self, connection, chat_name):
+        connection.subscriptions.discard(chat_name)
+        watchers = self.subscribers.get(chat_name)
+        if watchers is not None:
+            watchers.discard(connection)
+            if not watchers:
+                del self.subscribers[chat_name]
+
+    def drop(self, connection):
+        self.connections.discard(connection)
+        for chat_name in list(connection.subscriptions):
+            self.unsubscribe(connection, chat_name)
+
+    def has_subscribers(self, chat_name):
+        return bool(self.subscribers.get(chat_name))
+
+    def publish(self, chat_name, frame):
+        for connection in list(self.subscribers.get(chat_name, ())):
+            connection.push(chat_name, frame)
+
+    def stats(self):
+        return {
+            "connections": len(self.connections),
+            "watched_chats": len(self.subscribers),
+            "subscriptions": sum(len(watchers) for watchers in self.subscribers.values())
+        }
+
+
+hub = ChatHub()
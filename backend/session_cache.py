@@ -0,0 +1,155 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SESSION_CACHE_MAX_SESSIONS = int(os.getenv("SESSION_CACHE_MAX_SESSIONS", "100"))
+# Sessions idle for longer than this are evicted (0 keeps them until pushed out by newer ones)
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "1800"))
+
+
+def session_bytes(session):
+    """Approximate memory held by a session's resident turns, cached prompt and lexical index"""
+    total = 0
+    for turn in session["history"].history:
+        total += sys.getsizeof(turn) + sys.getsizeof(turn.user_text)
+        if turn.llm_text is not None:
+            total += sys.getsizeof(turn.llm_text)
+    context = session.get("context")
+    if context is not None and context.prompt:
+        total += sys.getsizeof(context.prompt)
+    lexical_index = session.get("lexical_index")
+    if lexical_index is not None:
+        total += lexical_index.memory_bytes()
+    return total
+
+
+class SessionCache:
+    """Active chat sessions bounded by count and idle time.
+
+    Evicted sessions are handed to on_evict so pending state can be written
+    out; the next access reloads them from storage. on_evict runs after the
+    cache lock is released and should not block, since get() is also called
+    on the event loop. Sessions for which is_busy(chat_name) is true are never
+    evicted.
+    """
+
+    def __init__(self, max_sessions=SESSION_CACHE_MAX_SESSIONS, ttl_seconds=SESSION_TTL_SECONDS,
+                 on_evict=None, is_busy=None):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict
+        self.is_busy = is_busy or (lambda chat_name: False)
+        self.sessions = OrderedDict()  # chat_name -> (last_access, session), least recent first
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.evicted = []  # (chat_name, session) removed under the lock, handed to on_evict after it
+
+    def __contains__(self, chat_name):
+        with self.lock:
+            return chat_name in self.sessions
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+    def get(self, chat_name):
+        """Return the session and mark it as recently used, or None"""
+        with self.lock:
+            self._expire()
+            entry = self.sessions.get(chat_name)
+            if entry is None:
+                self.misses += 1
+                session = None
+            else:
+                self.hits += 1
+                session = entry[1]
+                self.sessions[chat_name] = (time.monotonic(), session)
+                self.sessions.move_to_end(chat_name)
+                self._shrink(chat_name)
+        self._hand_off()
+        return session
+
+    def put(self, chat_name, session):
+        with self.lock:
+            self.loads += 1
+            self.sessions[chat_name] = (time.monotonic(), session)
+            self.sessions.move_to_end(chat_name)
+            self._expire()
+            self._shrink(chat_name)
+        self._hand_off()
+
+    def pop(self, chat_name):
+        """Drop a session without flushing it (e.g. the chat was deleted)"""
+        with self.lock:
+            entry = self.sessions.pop(chat_name, None)
+            return entry[1] if entry else None
+
+    def expire(self):
+        """Evict sessions that have been idle longer than the TTL"""
+        with self.lock:
+            self._expire()
+        self._hand_off()
+
+    def _expire(self):
+        if not self.ttl_seconds:
+            return
+        cutoff = time.monotonic() - self.ttl_seconds
+        with self.lock:
+            for name, (last_access, _) in list(self.sessions.items()):
+                if last_access > cutoff:
+                    break
+                if not self.is_busy(name):
+                    self._evict(name)
+                    self.expirations += 1
+
+    def _shrink(self, keep):
+        """Evict least recently used sessions until within max_sessions; busy ones are skipped"""
+        if len(self.sessions) <= self.max_sessions:
+            return
+        for name in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions:
+                break
+            if name != keep and not self.is_busy(name):
+                self._evict(name)
+                self.evictions += 1
+
+    def _evict(self, chat_name):
+        _, session = self.sessions.pop(chat_name)
+        self.evicted.append((chat_name, session))
+
+    def _hand_off(self):
+        """Pass sessions evicted so far to on_evict, outside the cache lock"""
+        with self.lock:
+            evicted, self.evicted = self.evicted, []
+        if self.on_evict is None:
+            return
+        for chat_name, session in evicted:
+            try:
+                self.on_evict(chat_name, session)
+            except Exception as e:
+                print(f"Error flushing evicted session: {e}")
+
+    def stats(self):
+        with self.lock:
+            removed = self.evictions + self.expirations
+            return {
+                "resident_sessions": len(self.sessions),
+                "max_sessions": self.max_sessions,
+                "resident_turns": sum(len(session["history"].history) for _, session in self.sessions.values()),
+                "resident_bytes": sum(session_bytes(session) for _, session in self.sessions.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "eviction_rate": removed / self.loads if self.loads else 0.0
+            }
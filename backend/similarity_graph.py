@@ -0,0 +1,358 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+
+from pinecone_utils import embed_texts
+
+load_dotenv()
+
+SIMILARITY_DIR = os.getenv("SIMILARITY_DIR", "chat_data/similarity")
+# Nearest turns kept per turn in the neighbor graph
+SIMILARITY_NEIGHBORS = max(int(os.getenv("SIMILARITY_NEIGHBORS", "8")), 1)
+# Chats whose graphs stay in memory; the others are reloaded from their vector files on demand
+SIMILARITY_MAX_CHATS = int(os.getenv("SIMILARITY_MAX_CHATS", "16"))
+# Largest turn-by-turn matrix served at once (newest turns first)
+SIMILARITY_MATRIX_MAX_TURNS = int(os.getenv("SIMILARITY_MATRIX_MAX_TURNS", "200"))
+# Neighbor score at which two turns join the same cluster, unless the request gives one
+SIMILARITY_CLUSTER_THRESHOLD = float(os.getenv("SIMILARITY_CLUSTER_THRESHOLD", "0.6"))
+# After turns missing from a graph fail to embed, reads use the graph as it is for this long
+SIMILARITY_BACKFILL_RETRY_SECONDS = float(os.getenv("SIMILARITY_BACKFILL_RETRY_SECONDS", "60"))
+
+# Rows per matrix product when the neighbor graph is rebuilt, bounding its temporary memory
+BUILD_BLOCK_ROWS = 1024
+# Each ids file entry is two int64s: turn id and vector dimension
+ID_ENTRY_FIELDS = 2
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class SimilarityGraph:
+    """Embeddings of one chat's turns with an incrementally maintained top-k neighbor graph.
+
+    Each turn keeps its unit user and assistant vectors. Turn-to-turn scores
+    use the normalized sum of the two; query scores take the better of the two,
+    as a vector query over both messages of a turn would.
+    """
+
+    def __init__(self, dimension, k=SIMILARITY_NEIGHBORS):
+        self.k = k
+        self.n = 0
+        self.ids = np.empty(16, dtype=np.int64)
+        self.rows = {}  # turn id -> row
+        self.user = np.empty((16, dimension), dtype=np.float32)
+        self.llm = np.empty((16, dimension), dtype=np.float32)
+        self.norms = np.empty(16, dtype=np.float32)  # |user + llm| per row
+        self.neighbor_rows = np.full((16, k), -1, dtype=np.int32)
+        self.neighbor_scores = np.full((16, k), -np.inf, dtype=np.float32)
+        self.stale = False  # a turn's vectors were replaced; neighbors are rebuilt on next read
+
+    @property
+    def dimension(self):
+        return self.user.shape[1]
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self):
+        capacity = len(self.ids) * 2
+        for name in ("ids", "user", "llm", "norms"):
+            old = getattr(self, name)
+            grown = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            grown[:self.n] = old[:self.n]
+            setattr(self, name, grown)
+        for name, fill in (("neighbor_rows", -1), ("neighbor_scores", -np.inf)):
+            old = getattr(self, name)
+            grown = np.full((capacity, self.k), fill, dtype=old.dtype)
+            grown[:self.n] = old[:self.n]
+            setattr(self, name, grown)
+
+    def turn_vectors(self, rows=None):
+        """Unit turn vectors for the given rows (all rows by default)"""
+        if rows is None:
+            rows = slice(0, self.n)
+        return (self.user[rows] + self.llm[rows]) / self.norms[rows, None]
+
+    def add(self, turn_id, user_vector, llm_vector):
+        """Add a turn and update its neighbors and every neighbor list it now belongs in"""
+        user_vector = unit(user_vector)
+        llm_vector = unit(llm_vector)
+        combined = user_vector + llm_vector
+        norm = max(float(np.linalg.norm(combined)), 1e-12)
+
+        row = self.rows.get(turn_id)
+        if row is not None:
+            self.user[row], self.llm[row], self.norms[row] = user_vector, llm_vector, norm
+            self.stale = True
+            return
+
+        row = self.n
+        if row == len(self.ids):
+            self._grow()
+        self.ids[row] = turn_id
+        self.rows[turn_id] = row
+        self.user[row], self.llm[row], self.norms[row] = user_vector, llm_vector, norm
+        self.neighbor_rows[row] = -1
+        self.neighbor_scores[row] = -np.inf
+        if row:
+            scores = self.turn_vectors(slice(0, row)) @ (combined / norm)
+            k = min(self.k, row)
+            top = np.argpartition(-scores, k - 1)[:k]
+            self.neighbor_rows[row, :k] = top
+            self.neighbor_scores[row, :k] = scores[top]
+            # Replace the weakest neighbor of every earlier turn the new one beats
+            weakest = np.argmin(self.neighbor_scores[:row], axis=1)
+            better = np.flatnonzero(scores > self.neighbor_scores[np.arange(row), weakest])
+            self.neighbor_rows[better, weakest[better]] = row
+            self.neighbor_scores[better, weakest[better]] = scores[better]
+        self.n += 1
+
+    def rebuild(self):
+        """Recompute every neighbor list with blocked matrix products"""
+        n = self.n
+        self.neighbor_rows[:n] = -1
+        self.neighbor_scores[:n] = -np.inf
+        if n > 1:
+            vectors = self.turn_vectors()
+            k = min(self.k, n - 1)
+            for start in range(0, n, BUILD_BLOCK_ROWS):
+                end = min(start + BUILD_BLOCK_ROWS, n)
+                scores = vectors[start:end] @ vectors.T
+                scores[np.arange(end - start), np.arange(start, end)] = -np.inf
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                self.neighbor_rows[start:end, :k] = top
+                self.neighbor_scores[start:end, :k] = np.take_along_axis(scores, top, axis=1)
+        self.stale = False
+
+    def _fresh(self):
+        if self.stale:
+            self.rebuild()
+
+    def neighbors(self, turn_id, k=None):
+        """Nearest turns to a turn as [(turn_id, score)], best first"""
+        self._fresh()
+        row = self.rows[turn_id]
+        valid = self.neighbor_rows[row] >= 0
+        rows, scores = self.neighbor_rows[row][valid], self.neighbor_scores[row][valid]
+        order = np.argsort(-scores)[:k]
+        return [(int(self.ids[r]), float(s)) for r, s in zip(rows[order], scores[order])]
+
+    def row(self, turn_id):
+        """Scores of every other turn against one turn"""
+        row = self.rows[turn_id]
+        scores = self.turn_vectors() @ self.turn_vectors(slice(row, row + 1))[0]
+        return {int(tid): float(score) for tid, score in zip(self.ids[:self.n], scores) if tid != turn_id}
+
+    def query_scores(self, vector):
+        """Scores of every turn against a query vector"""
+        if self.n == 0:
+            return {}
+        q = unit(vector)
+        scores = np.maximum(self.user[:self.n] @ q, self.llm[:self.n] @ q)
+        return {int(tid): float(score) for tid, score in zip(self.ids[:self.n], scores)}
+
+    def matrix(self, limit=SIMILARITY_MATRIX_MAX_TURNS):
+        """Turn ids and the turn-by-turn score matrix of the newest `limit` turns, in turn order"""
+        rows = np.argsort(self.ids[:self.n])[-max(limit, 1):]
+        vectors = self.turn_vectors(rows)
+        return [int(tid) for tid in self.ids[rows]], (vectors @ vectors.T).astype(np.float64).round(4).tolist()
+
+    def clusters(self, threshold=SIMILARITY_CLUSTER_THRESHOLD):
+        """Groups of turns connected by neighbor edges scoring at least threshold, largest first"""
+        self._fresh()
+        parent = list(range(self.n))
+
+        def find(row):
+            while parent[row] != row:
+                parent[row] = parent[parent[row]]
+                row = parent[row]
+            return row
+
+        sources, slots = np.nonzero(self.neighbor_scores[:self.n] >= threshold)
+        for source, target in zip(sources, self.neighbor_rows[sources, slots]):
+            parent[find(int(source))] = find(int(target))
+        groups = {}
+        for row in range(self.n):
+            groups.setdefault(find(row), []).append(int(self.ids[row]))
+        clusters = [sorted(group) for group in groups.values() if len(group) > 1]
+        return sorted(clusters, key=lambda group: (-len(group), group[0]))
+
+
+class SimilarityService:
+    """Per-chat similarity graphs fed by the indexing queue, so visualization never queries the vector store.
+
+    Turn vectors are appended to two files per namespace under `directory`
+    (ids and float32 vectors); a graph is built from them the first time its
+    chat is asked for and kept in an LRU of max_chats graphs.
+    """
+
+    def __init__(self, directory=SIMILARITY_DIR, max_chats=SIMILARITY_MAX_CHATS):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.max_chats = max_chats
+        self.graphs = OrderedDict()  # namespace -> SimilarityGraph
+        self.backfill_failures = {}  # namespace -> monotonic time its missing turns last failed to embed
+        self.lock = threading.RLock()
+
+    def _path(self, namespace, suffix):
+        safe = "".join(c if c.isalnum() or c in "-_" else f"%{ord(c):02x}" for c in namespace)
+        return os.path.join(self.directory, f"{safe or '%default'}.{suffix}")
+
+    @staticmethod
+    def _embed(turns):
+        """(turn, user vector, llm vector) for each turn, or None if embedding fails"""
+        texts = []
+        for turn in turns:
+            texts += [turn.user_text, turn.llm_text or turn.user_text]
+        # Same texts and input type as the indexing upsert, so these normally come from the embedding cache
+        vectors = embed_texts(texts, input_type="passage")
+        if vectors is None:
+            return None
+        return [(turn, vectors[2 * i], vectors[2 * i + 1]) for i, turn in enumerate(turns)]
+
+    def _append(self, namespace, embedded):
+        entries = np.array([(turn.id, len(user)) for turn, user, _ in embedded], dtype=np.int64)
+        vectors = np.array([np.concatenate([user, llm]) for _, user, llm in embedded], dtype=np.float32)
+        # Vectors first: an ids entry without its vector is dropped on load, never misread
+        with open(self._path(namespace, "vec"), "ab") as f:
+            f.write(vectors.tobytes())
+        with open(self._path(namespace, "ids"), "ab") as f:
+            f.write(entries.tobytes())
+
+    def _load(self, namespace):
+        try:
+            entries = np.fromfile(self._path(namespace, "ids"), dtype=np.int64).reshape(-1, ID_ENTRY_FIELDS)
+            vectors = np.fromfile(self._path(namespace, "vec"), dtype=np.float32)
+        except FileNotFoundError:
+            return None
+        if not len(entries):
+            return None
+        dimension = int(entries[0, 1])
+        count = min(len(entries), len(vectors) // (2 * dimension))
+        vectors = vectors[:count * 2 * dimension].reshape(count, 2 * dimension)
+        graph = SimilarityGraph(dimension)
+        # A turn written more than once (re-indexed) keeps its latest vectors
+        latest = {}
+        for i, turn_id in enumerate(entries[:count, 0]):
+            latest[int(turn_id)] = i
+        while len(graph.ids) < len(latest):
+            graph._grow()
+        for row, (turn_id, i) in enumerate(sorted(latest.items())):
+            user, llm = unit(vectors[i, :dimension]), unit(vectors[i, dimension:])
+            graph.ids[row] = turn_id
+            graph.rows[turn_id] = row
+            graph.user[row], graph.llm[row] = user, llm
+            graph.norms[row] = max(float(np.linalg.norm(user + llm)), 1e-12)
+        graph.n = len(latest)
+        graph.rebuild()
+        return graph
+
+    def _remember(self, namespace, graph):
+        self.graphs[namespace] = graph
+        self.graphs.move_to_end(namespace)
+        while len(self.graphs) > self.max_chats:
+            self.graphs.popitem(last=False)
+
+    def _merge(self, namespace, embedded):
+        """Append embedded turns the chat's graph does not have yet; called with the lock held"""
+        graph = self.graphs.get(namespace)
+        if graph is not None:
+            embedded = [item for item in embedded if item[0].id not in graph.rows]
+        if not embedded:
+            return
+        try:
+            self._append(namespace, embedded)
+        except Exception as e:
+            print(f"Error saving turn vectors: {e}")
+        if graph is None:
+            return
+        for turn, user, llm in embedded:
+            graph.add(turn.id, user, llm)
+
+    def add_turns(self, namespace, turns):
+        """Record newly indexed turns; returns False if they could not be embedded"""
+        embedded = self._embed(turns)
+        if embedded is None:
+            return False
+        with self.lock:
+            self._merge(namespace, embedded)
+        return True
+
+    def graph(self, namespace, history_manager=None):
+        """The chat's graph, loading it and embedding turns it is missing on first use; None if it has no turns.
+
+        Missing turns are embedded without holding the lock, so a slow or failing
+        embedding call never stalls indexing or other chats. After a failure the gap
+        is tried again only once SIMILARITY_BACKFILL_RETRY_SECONDS have passed.
+        """
+        with self.lock:
+            graph = self._resident(namespace)
+            missing = self._missing(namespace, graph, history_manager)
+        if missing:
+            embedded = self._embed(history_manager.get_turns(missing))
+            with self.lock:
+                # The graph may have been evicted or changed while the lock was released
+                graph = self._resident(namespace)
+                if embedded:
+                    self.backfill_failures.pop(namespace, None)
+                    if graph is None:
+                        graph = SimilarityGraph(len(embedded[0][1]))
+                        self._remember(namespace, graph)
+                    self._merge(namespace, embedded)
+                else:
+                    self.backfill_failures[namespace] = time.monotonic()
+        return graph
+
+    def _resident(self, namespace):
+        """The chat's graph from memory or its files, marked as recently used; called with the lock held"""
+        graph = self.graphs.get(namespace)
+        if graph is None:
+            graph = self._load(namespace)
+        if graph is not None:
+            self._remember(namespace, graph)
+        return graph
+
+    def _missing(self, namespace, graph, history_manager):
+        """Turn ids of the chat that the graph lacks, unless a recent backfill of them failed"""
+        if history_manager is None:
+            return []
+        failed_at = self.backfill_failures.get(namespace)
+        if failed_at is not None and time.monotonic() - failed_at < SIMILARITY_BACKFILL_RETRY_SECONDS:
+            return []
+        known = graph.rows if graph is not None else {}
+        return [tid for tid in history_manager.turn_ids() if tid not in known]
+
+    def read(self, namespace, history_manager, reader):
+        """reader(graph) for the chat's graph, run under the lock so indexing cannot change it meanwhile;
+        None if the chat has no turns"""
+        self.graph(namespace, history_manager)
+        with self.lock:
+            graph = self._resident(namespace)
+            return None if graph is None else reader(graph)
+
+    def forget(self, namespace):
+        """Drop a chat's graph and vector files"""
+        with self.lock:
+            self.graphs.pop(namespace, None)
+            self.backfill_failures.pop(namespace, None)
+            for suffix in ("ids", "vec"):
+                path = self._path(namespace, suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "resident_chats": len(self.graphs),
+                "resident_turns": sum(len(graph) for graph in self.graphs.values())
+            }
+
+
+similarity_service = SimilarityService()
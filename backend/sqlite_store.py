@@ -0,0 +1,368 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+
+from chat_manager import ChatManager
+from history_manager import HistoryManager
+from memory import Turn
+from metrics import span
+
+load_dotenv()
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "chat_data/chats.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    name TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    last_accessed TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    system_instructions TEXT
+);
+CREATE TABLE IF NOT EXISTS turns (
+    chat_name TEXT NOT NULL,
+    turn_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    user_text TEXT NOT NULL,
+    llm_text TEXT,
+    PRIMARY KEY (chat_name, turn_id)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS turns_by_position ON turns (chat_name, position);
+"""
+
+# Databases created before llm_text became nullable are copied into the current schema once
+MIGRATE_NULLABLE_LLM_TEXT = """
+ALTER TABLE turns RENAME TO turns_old;
+DROP INDEX IF EXISTS turns_by_position;
+""" + SCHEMA + """
+INSERT INTO turns SELECT chat_name, turn_id, position, user_text, llm_text FROM turns_old;
+DROP TABLE turns_old;
+"""
+
+# Statements are module constants so sqlite3's per-connection statement cache
+# compiles each of them once and reuses the prepared statement afterwards
+SELECT_CHATS = "SELECT name, namespace, created_at, last_accessed, message_count, system_instructions FROM chats"
+SELECT_CHAT = SELECT_CHATS + " WHERE name = ?"
+INSERT_CHAT = (
+    "INSERT OR IGNORE INTO chats (name, namespace, created_at, last_accessed, message_count, system_instructions) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+TOUCH_CHAT = "UPDATE chats SET last_accessed = ? WHERE name = ?"
+INCREMENT_MESSAGES = "UPDATE chats SET message_count = message_count + 1 WHERE name = ?"
+SET_INSTRUCTIONS = "UPDATE chats SET system_instructions = ? WHERE name = ?"
+DELETE_CHAT = "DELETE FROM chats WHERE name = ?"
+
+# Named parameters, bound from _turn_params(), since chat_name is used twice
+INSERT_TURN = (
+    "INSERT INTO turns (chat_name, turn_id, position, user_text, llm_text) "
+    "SELECT :chat_name, :turn_id, COALESCE(MAX(position), -1) + 1, :user_text, :llm_text FROM turns WHERE chat_name = :chat_name "
+    "ON CONFLICT (chat_name, turn_id) DO UPDATE SET user_text = excluded.user_text, llm_text = excluded.llm_text"
+)
+INSERT_TURN_IF_MISSING = (
+    "INSERT OR IGNORE INTO turns (chat_name, turn_id, position, user_text, llm_text) "
+    "SELECT :chat_name, :turn_id, COALESCE(MAX(position), -1) + 1, :user_text, :llm_text FROM turns WHERE chat_name = :chat_name"
+)
+# Allocates the next turn id inside the writing transaction, so workers sharing the database never reuse one
+SELECT_NEXT_TURN = (
+    "SELECT COALESCE(MAX(turn_id), 0) + 1, COALESCE(MAX(position), -1) + 1 FROM turns WHERE chat_name = ?"
+)
+INSERT_NEW_TURN = "INSERT INTO turns (chat_name, turn_id, position, user_text, llm_text) VALUES (?, ?, ?, ?, ?)"
+SELECT_TURNS = "SELECT turn_id, user_text, llm_text FROM turns WHERE chat_name = ? ORDER BY position"
+SELECT_TURN = "SELECT turn_id, user_text, llm_text FROM turns WHERE chat_name = ? AND turn_id = ?"
+SELECT_PAGE = (
+    "SELECT turn_id, user_text, llm_text, position FROM turns "
+    "WHERE chat_name = ? AND position < ? ORDER BY position DESC LIMIT ?"
+)
+SELECT_POSITION = "SELECT position FROM turns WHERE chat_name = ? AND turn_id = ?"
+SELECT_TURN_IDS = "SELECT turn_id FROM turns WHERE chat_name = ? ORDER BY position LIMIT ? OFFSET ?"
+SELECT_LAST_TURN = "SELECT turn_id, position FROM turns WHERE chat_name = ? ORDER BY position DESC LIMIT 1"
+COUNT_TURNS = "SELECT COUNT(*) FROM turns WHERE chat_name = ?"
+DELETE_TURNS = "DELETE FROM turns WHERE chat_name = ?"
+
+
+class SQLiteDatabase:
+    """One WAL-mode SQLite connection per thread, shared by the chat and history stores"""
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.local = threading.local()
+        with self.transaction() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row[1]: row[3] for row in conn.execute("PRAGMA table_info(turns)")}
+            if columns.get("llm_text"):
+                conn.executescript("BEGIN IMMEDIATE;" + MIGRATE_NULLABLE_LLM_TEXT + "COMMIT;")
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def transaction(self):
+        """Connection used as a context manager: commits on success, rolls back on error"""
+        return self.connection()
+
+
+_database = None
+_database_lock = threading.Lock()
+
+def get_database():
+    """Return the process-wide SQLiteDatabase"""
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = SQLiteDatabase()
+        return _database
+
+
+def _chat_row(row):
+    return {
+        "namespace": row[1],
+        "created_at": row[2],
+        "last_accessed": row[3],
+        "message_count": row[4],
+        "system_instructions": row[5]
+    }
+
+def _turn_row(row):
+    return Turn(row[0], row[1], row[2])
+
+def _turn_params(chat_name, turn):
+    """Named parameters of INSERT_TURN and INSERT_TURN_IF_MISSING for one turn"""
+    return {"chat_name": chat_name, "turn_id": turn.id, "user_text": turn.user_text, "llm_text": turn.llm_text}
+
+
+class SQLiteChatManager:
+    """ChatManager backed by the chats table; every call reads or writes the database directly"""
+
+    sanitize_namespace = staticmethod(ChatManager.sanitize_namespace)
+
+    def __init__(self, db=None):
+        self.db = db or get_database()
+
+    @property
+    def chats(self):
+        return self.list_chats()
+
+    def list_chats(self):
+        """Return list of chat names with metadata"""
+        rows = self.db.connection().execute(SELECT_CHATS).fetchall()
+        return {row[0]: _chat_row(row) for row in rows}
+
+    def get_chat(self, chat_name):
+        """Return one chat's metadata, or an empty dict"""
+        row = self.db.connection().execute(SELECT_CHAT, (chat_name,)).fetchone()
+        return _chat_row(row) if row else {}
+
+    def chat_exists(self, chat_name):
+        """Check if a chat exists"""
+        return bool(self.get_chat(chat_name))
+
+    def create_chat(self, chat_name, system_instructions=None):
+        """Create a new chat session"""
+        namespace = self.sanitize_namespace(chat_name)
+        now = datetime.now().isoformat()
+        with self.db.transaction() as conn:
+            conn.execute(INSERT_CHAT, (chat_name, namespace, now, now, 0, system_instructions))
+        return namespace
+
+    def set_system_instructions(self, chat_name, instructions):
+        """Set system instructions for a chat"""
+        with self.db.transaction() as conn:
+            conn.execute(SET_INSTRUCTIONS, (instructions, chat_name))
+
+    def get_system_instructions(self, chat_name):
+        """Get system instructions for a chat"""
+        return self.get_chat(chat_name).get("system_instructions")
+
+    def get_namespace(self, chat_name):
+        """Get namespace for a chat"""
+        chat = self.get_chat(chat_name)
+        if not chat:
+            return None
+        with self.db.transaction() as conn:
+            conn.execute(TOUCH_CHAT, (datetime.now().isoformat(), chat_name))
+        return chat["namespace"]
+
+    def update_message_count(self, chat_name):
+        """Increment message count for a chat"""
+        with span("chats_write"), self.db.transaction() as conn:
+            conn.execute(INCREMENT_MESSAGES, (chat_name,))
+
+    def delete_chat(self, chat_name):
+        """Delete a chat session"""
+        with self.db.transaction() as conn:
+            deleted = conn.execute(DELETE_CHAT, (chat_name,)).rowcount
+        return deleted > 0
+
+    def flush(self):
+        """Writes are committed immediately; nothing is buffered"""
+
+
+class SQLiteHistoryManager:
+    """HistoryManager backed by the turns table, indexed by turn id and by position"""
+
+    def __init__(self, chat_name, db=None):
+        self.chat_name = chat_name
+        self.db = db or get_database()
+
+    def _insert(self, statement, turns):
+        with self.db.transaction() as conn:
+            conn.executemany(statement, [_turn_params(self.chat_name, turn) for turn in turns])
+
+    def append_turns(self, turns):
+        """Insert turns, replacing the text of turns that already exist"""
+        self._insert(INSERT_TURN, turns)
+
+    def reserve_turn(self, user_text, llm_text):
+        """Store a new turn under the next free id and return it.
+
+        The id is chosen and written in one IMMEDIATE transaction, which holds the
+        database write lock, so concurrent workers get distinct ids.
+        """
+        conn = self.db.connection()
+        with span("history_write"):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                turn_id, position = conn.execute(SELECT_NEXT_TURN, (self.chat_name,)).fetchone()
+                conn.execute(INSERT_NEW_TURN, (self.chat_name, turn_id, position, user_text, llm_text))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return Turn(turn_id, user_text, llm_text)
+
+    def save_turns(self, turns):
+        """Insert the given turns unless the table already has them"""
+        try:
+            with span("history_write"):
+                self._insert(INSERT_TURN_IF_MISSING, turns)
+                # A stored turn with the same id but other text means two writers picked the same id
+                for turn in turns:
+                    stored = self.get_turn(turn.id)
+                    if stored is not None and stored != turn:
+                        print(f"Error saving history: turn {turn.id} of '{self.chat_name}' already holds a different turn")
+        except Exception as e:
+            print(f"Error saving history: {e}")
+
+    def save_history(self, history_list):
+        """Persist history, inserting only the turns the table does not have yet"""
+        try:
+            with span("history_write"):
+                conn = self.db.connection()
+                count = conn.execute(COUNT_TURNS, (self.chat_name,)).fetchone()[0]
+                last = conn.execute(SELECT_LAST_TURN, (self.chat_name,)).fetchone()
+                in_sync = len(history_list) >= count and (count == 0 or history_list[count - 1].id == last[0])
+                if in_sync:
+                    self._insert(INSERT_TURN_IF_MISSING, history_list[count:])
+                    return
+                # History was rewritten in memory; replace the stored turns
+                with self.db.transaction() as conn:
+                    conn.execute(DELETE_TURNS, (self.chat_name,))
+                    conn.executemany(INSERT_TURN, [_turn_params(self.chat_name, turn) for turn in history_list])
+        except Exception as e:
+            print(f"Error saving history: {e}")
+
+    async def save_history_async(self, history_list):
+        """Save a snapshot of history from a worker thread so the event loop never blocks"""
+        await asyncio.to_thread(self.save_history, list(history_list))
+
+    def load_history(self):
+        """Load conversation history"""
+        try:
+            rows = self.db.connection().execute(SELECT_TURNS, (self.chat_name,)).fetchall()
+            return [_turn_row(row) for row in rows]
+        except Exception as e:
+            print(f"Error loading history: {e}")
+            return []
+
+    def turn_count(self):
+        """Number of stored turns"""
+        return self.db.connection().execute(COUNT_TURNS, (self.chat_name,)).fetchone()[0]
+
+    def turn_ids(self, start=0, end=None):
+        """Turn ids in conversation order, optionally sliced by position"""
+        limit = -1 if end is None else max(end - start, 0)
+        rows = self.db.connection().execute(SELECT_TURN_IDS, (self.chat_name, limit, start)).fetchall()
+        return [row[0] for row in rows]
+
+    def position(self, turn_id):
+        """Position of a turn in conversation order, or None if unknown"""
+        row = self.db.connection().execute(SELECT_POSITION, (self.chat_name, turn_id)).fetchone()
+        return row[0] if row else None
+
+    def get_turns(self, turn_ids):
+        """Read specific turns by id; unknown ids are skipped"""
+        conn = self.db.connection()
+        turns = []
+        for turn_id in turn_ids:
+            row = conn.execute(SELECT_TURN, (self.chat_name, turn_id)).fetchone()
+            if row:
+                turns.append(_turn_row(row))
+        return turns
+
+    def get_turn(self, turn_id):
+        """Read a single turn by id, or None if it does not exist"""
+        turns = self.get_turns([turn_id])
+        return turns[0] if turns else None
+
+    def load_page(self, before=None, limit=50):
+        """Return (turns, next_cursor) for up to `limit` turns preceding turn id `before`"""
+        end = self.position(before) if before is not None else None
+        if end is None:
+            end = sys.maxsize
+        rows = self.db.connection().execute(SELECT_PAGE, (self.chat_name, end, limit)).fetchall()
+        rows.reverse()
+        turns = [_turn_row(row) for row in rows]
+        next_cursor = rows[0][0] if rows and rows[0][3] > 0 else None
+        return turns, next_cursor
+
+    def delete_history(self):
+        """Delete all turns of the chat"""
+        try:
+            with self.db.transaction() as conn:
+                deleted = conn.execute(DELETE_TURNS, (self.chat_name,)).rowcount
+            return deleted > 0
+        except Exception as e:
+            print(f"Error deleting history: {e}")
+            return False
+
+
+def import_json_data(db=None):
+    """Bulk-import chats.json and every chat's JSON/JSONL history into SQLite"""
+    db = db or get_database()
+    chats = ChatManager().list_chats()
+    imported_turns = 0
+    with db.transaction() as conn:
+        for chat_name, info in chats.items():
+            conn.execute(INSERT_CHAT, (
+                chat_name,
+                info.get("namespace") or ChatManager.sanitize_namespace(chat_name),
+                info.get("created_at") or datetime.now().isoformat(),
+                info.get("last_accessed") or datetime.now().isoformat(),
+                info.get("message_count", 0),
+                info.get("system_instructions")
+            ))
+            history_list = HistoryManager(chat_name).load_history()
+            conn.executemany(INSERT_TURN_IF_MISSING, [_turn_params(chat_name, turn) for turn in history_list])
+            imported_turns += len(history_list)
+    return len(chats), imported_turns
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["import"]:
+        print("Usage: python sqlite_store.py import")
+        sys.exit(1)
+    chat_count, turn_count = import_json_data()
+    print(f"Imported {chat_count} chats and {turn_count} turns into {SQLITE_PATH}")
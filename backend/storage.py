@@ -0,0 +1,41 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "json" keeps chats.json plus per-chat JSONL journals; "sqlite" stores both in one WAL database
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+# The SQLite database can be shared by several worker processes
+SHARED_STORAGE = STORAGE_BACKEND == "sqlite"
+
+def get_chat_manager():
+    """Return the chat manager for the configured backend"""
+    if STORAGE_BACKEND == "sqlite":
+        from sqlite_store import SQLiteChatManager
+        return SQLiteChatManager()
+    from chat_manager import get_chat_manager as get_json_chat_manager
+    return get_json_chat_manager()
+
+# One history manager per chat, so every writer shares its lock and journal offset index
+_history_managers = {}
+_history_managers_lock = threading.Lock()
+
+def get_history_manager(chat_name):
+    """Return the process-wide history manager for one chat on the configured backend"""
+    with _history_managers_lock:
+        manager = _history_managers.get(chat_name)
+        if manager is None:
+            if STORAGE_BACKEND == "sqlite":
+                from sqlite_store import SQLiteHistoryManager
+                manager = SQLiteHistoryManager(chat_name)
+            else:
+                from history_manager import HistoryManager
+                manager = HistoryManager(chat_name)
+            _history_managers[chat_name] = manager
+        return manager
+
+def forget_history_manager(chat_name):
+    """Drop a deleted chat's history manager"""
+    with _history_managers_lock:
+        _history_managers.pop(chat_name, None)
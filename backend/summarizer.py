@@ -0,0 +1,237 @@
+import os
+import threading
+from collections import deque
+from dotenv import load_dotenv
+
+from cache_utils import DiskCache, content_key
+from llm import LLM_MODEL, summarize
+from memory import render_turn
+from pinecone_utils import upsert_summaries, summary_namespace
+
+load_dotenv()
+
+# Summarization makes extra LLM and embedding calls, so it is opt-in
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "false").lower() == "true"
+# Turns folded into each first-level summary (0 disables summarization)
+SUMMARY_CHUNK_TURNS = int(os.getenv("SUMMARY_CHUNK_TURNS", "20"))
+# Consecutive summaries of one level folded into one summary of the next level
+SUMMARY_FANOUT = max(2, int(os.getenv("SUMMARY_FANOUT", "4")))
+# The newest turns of a chat are never summarized; they are retrieved verbatim
+SUMMARY_MIN_AGE_TURNS = int(os.getenv("SUMMARY_MIN_AGE_TURNS", "100"))
+# Summaries pulled into one prompt
+SUMMARY_TOP_K = int(os.getenv("SUMMARY_TOP_K", "2"))
+SUMMARY_CACHE_PATH = os.getenv("SUMMARY_CACHE_PATH", "chat_data/summaries.db")
+# Summary texts kept by content hash; the per-chat trees are removed with their chat instead
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "10000"))
+
+
+class Summary:
+    """Summary of the turns at positions [start, end) of a chat"""
+    __slots__ = ("level", "start", "end", "first_turn", "last_turn", "text")
+
+    def __init__(self, level, start, end, first_turn, last_turn, text):
+        self.level = level
+        self.start = start
+        self.end = end
+        self.first_turn = first_turn
+        self.last_turn = last_turn
+        self.text = text
+
+    @property
+    def id(self):
+        return f"s{self.level}_{self.start}"
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["level"], data["start"], data["end"], data["first_turn"], data["last_turn"], data["text"])
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "level": self.level,
+            "start": self.start,
+            "end": self.end,
+            "first_turn": self.first_turn,
+            "last_turn": self.last_turn,
+            "text": self.text
+        }
+
+    def covers(self, turn_id):
+        return self.first_turn <= turn_id <= self.last_turn
+
+    def overlaps(self, other):
+        return self.start < other.end and other.start < self.end
+
+
+def render_summary(summary):
+    return f"Summary of turns {summary.first_turn}-{summary.last_turn}: {summary.text}\n\n"
+
+
+def select_summaries(summaries, scores, top_k=SUMMARY_TOP_K):
+    """Best-scoring summaries, skipping any whose turns overlap a summary already chosen"""
+    by_id = {summary.id: summary for summary in summaries}
+    chosen = []
+    for summary_id, _ in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        summary = by_id.get(summary_id)
+        if summary is None or any(summary.overlaps(other) for other in chosen):
+            continue
+        chosen.append(summary)
+        if len(chosen) >= top_k:
+            break
+    chosen.sort(key=lambda summary: summary.start)
+    return chosen
+
+
+class Summarizer:
+    """Background worker that folds old turns into a hierarchy of summaries.
+
+    Every SUMMARY_CHUNK_TURNS consecutive turns older than the newest
+    SUMMARY_MIN_AGE_TURNS become one level-1 summary, and every SUMMARY_FANOUT
+    consecutive summaries of a level become one summary a level up. Summaries
+    are embedded into the chat's summary namespace and kept per chat in a disk
+    cache; summary text is also cached by content, so nothing is summarized twice.
+    """
+
+    def __init__(self, cache_path=SUMMARY_CACHE_PATH):
+        self.enabled = SUMMARY_ENABLED and SUMMARY_CHUNK_TURNS > 0
+        self.cond = threading.Condition()
+        self.pending = {}       # chat_name -> (namespace, history_manager)
+        self.ready = deque()
+        self.in_progress = set()
+        self.trees = {}         # chat_name -> summaries ordered by level, then position
+        self.thread = None
+        if self.enabled:
+            self.tree_cache = DiskCache(cache_path, "summary_trees")
+            self.text_cache = DiskCache(cache_path, "summary_texts", max_entries=SUMMARY_CACHE_MAX_ENTRIES)
+
+    def submit(self, chat_name, namespace, history_manager):
+        """Summarize any turns of the chat that have aged past SUMMARY_MIN_AGE_TURNS"""
+        if not self.enabled:
+            return
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="summarizer", daemon=True)
+                self.thread.start()
+            self.pending[chat_name] = (namespace, history_manager)
+            if chat_name not in self.ready and chat_name not in self.in_progress:
+                self.ready.append(chat_name)
+            self.cond.notify_all()
+
+    def summaries(self, chat_name, namespace):
+        """All summaries of a chat"""
+        if not self.enabled:
+            return []
+        with self.cond:
+            tree = self.trees.get(chat_name)
+        if tree is None:
+            stored = self.tree_cache.get(summary_namespace(namespace)) or []
+            tree = [Summary.from_dict(data) for data in stored]
+            with self.cond:
+                tree = self.trees.setdefault(chat_name, tree)
+        return tree
+
+    def flush(self, timeout=None):
+        """Wait until every submitted chat has been processed"""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.ready and not self.in_progress, timeout)
+
+    def forget(self, chat_name, namespace):
+        """Drop queued work and the summaries of a deleted chat"""
+        if not self.enabled:
+            return
+        with self.cond:
+            while chat_name in self.in_progress:
+                self.cond.wait()
+            self.pending.pop(chat_name, None)
+            if chat_name in self.ready:
+                self.ready.remove(chat_name)
+            self.trees.pop(chat_name, None)
+        self.tree_cache.delete(summary_namespace(namespace))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                chat_name = self.ready.popleft()
+                namespace, history_manager = self.pending.pop(chat_name)
+                self.in_progress.add(chat_name)
+
+            try:
+                self._process(chat_name, namespace, history_manager)
+            except Exception as e:
+                print(f"Error summarizing chat: {e}")
+
+            with self.cond:
+                self.in_progress.discard(chat_name)
+                if chat_name in self.pending and chat_name not in self.ready:
+                    self.ready.append(chat_name)
+                self.cond.notify_all()
+
+    def _process(self, chat_name, namespace, history_manager):
+        tree = list(self.summaries(chat_name, namespace))
+        new = self._summarize_turns(tree, history_manager)
+        level = 1
+        while True:
+            built = self._summarize_level(tree + new, level)
+            if not built and not any(summary.level > level for summary in tree + new):
+                break
+            new += built
+            level += 1
+        if not new:
+            return
+        # Only summaries that made it into the index are recorded; a failed batch
+        # is rebuilt from the text cache on the next pass
+        if not upsert_summaries(new, namespace=namespace):
+            return
+        tree = sorted(tree + new, key=lambda summary: (summary.level, summary.start))
+        with self.cond:
+            self.trees[chat_name] = tree
+        self.tree_cache.put(summary_namespace(namespace), [summary.to_dict() for summary in tree])
+
+    def _summarize_turns(self, tree, history_manager):
+        """Level-1 summaries for the full chunks of old turns not summarized yet"""
+        covered = [summary.end for summary in tree if summary.level == 1]
+        start = max(covered) if covered else 0
+        old_turns = history_manager.turn_count() - SUMMARY_MIN_AGE_TURNS
+        new = []
+        while start + SUMMARY_CHUNK_TURNS <= old_turns:
+            end = start + SUMMARY_CHUNK_TURNS
+            turns = history_manager.get_turns(history_manager.turn_ids(start, end))
+            if not turns:
+                break
+            text = self._summarize("".join(render_turn(turn) for turn in turns))
+            if text is None:
+                break
+            new.append(Summary(1, start, end, turns[0].id, turns[-1].id, text))
+            start = end
+        return new
+
+    def _summarize_level(self, summaries, level):
+        """Summaries one level above `level` for each full group of SUMMARY_FANOUT children"""
+        parents = [summary.end for summary in summaries if summary.level == level + 1]
+        start = max(parents) if parents else 0
+        children = sorted(
+            (summary for summary in summaries if summary.level == level and summary.start >= start),
+            key=lambda summary: summary.start
+        )
+        new = []
+        for i in range(0, len(children) - SUMMARY_FANOUT + 1, SUMMARY_FANOUT):
+            group = children[i:i + SUMMARY_FANOUT]
+            text = self._summarize("".join(render_summary(child) for child in group))
+            if text is None:
+                break
+            new.append(Summary(level + 1, group[0].start, group[-1].end, group[0].first_turn, group[-1].last_turn, text))
+        return new
+
+    def _summarize(self, text):
+        key = content_key(LLM_MODEL, text)
+        summary = self.text_cache.get(key)
+        if summary is None:
+            summary = summarize(text)
+            if summary is not None:
+                self.text_cache.put(key, summary)
+        return summary
+
+
+summarizer = Summarizer()
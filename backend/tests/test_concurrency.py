@@ -0,0 +1,93 @@
+"""Concurrent turns against the API with the fake services from benchmarks/fake_services.py.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import fake_services
+
+TURNS = 24
+CHATS = 8
+
+
+@pytest.fixture(scope="module")
+def api(tmp_path_factory):
+    """The app on fake services, with its data in a scratch directory"""
+    cwd = os.getcwd()
+    fake_services.install(llm_ttft_ms=5, llm_chunk_ms=1, llm_chunks=3, embed_ms=2, vector_ms=1,
+                          data_dir=str(tmp_path_factory.mktemp("data")))
+    import api
+    import pinecone_utils
+    yield api
+    # Written while still in the scratch directory, which their paths are relative to
+    api.flush_background_work()
+    pinecone_utils.store.flush()
+    os.chdir(cwd)
+
+
+async def send(client, chat_name, message, stream):
+    """Send one message; returns the new turn's id"""
+    body = {"chat_name": chat_name, "message": message}
+    if not stream:
+        response = await client.post("/message", json=body)
+        assert response.status_code == 200, response.text
+        return response.json()["turn_id"]
+    async with client.stream("POST", "/message/stream", json=body) as response:
+        assert response.status_code == 200
+        async for line in response.aiter_lines():
+            if line.startswith("data: "):
+                event = json.loads(line[6:])
+                assert event["type"] != "error", event
+                if event["type"] == "done":
+                    return event["turn_id"]
+    raise AssertionError("stream ended without a done event")
+
+
+async def converse(api, chat_names, turns):
+    """Fire every turn of every chat at once, alternating plain and streamed requests"""
+    import httpx
+
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+        for name in chat_names:
+            response = await client.post("/chats", json={"chat_name": name})
+            assert response.status_code == 200, response.text
+        jobs = [(name, f"{name} message {i}") for name in chat_names for i in range(turns)]
+        turn_ids = await asyncio.gather(*(
+            send(client, name, message, stream=i % 2 == 1) for i, (name, message) in enumerate(jobs)
+        ))
+    return list(zip(jobs, turn_ids))
+
+
+def test_concurrent_turns_get_unique_contiguous_ids(api):
+    replies = asyncio.run(converse(api, ["one-chat"], TURNS))
+
+    turn_ids = sorted(turn_id for _, turn_id in replies)
+    assert turn_ids == list(range(1, TURNS + 1))
+
+    # Every reply's turn is stored under its id with its own message
+    stored = {turn.id: turn for turn in api.get_history_manager("one-chat").load_history()}
+    assert sorted(stored) == turn_ids
+    for (_, message), turn_id in replies:
+        assert stored[turn_id].user_text == message
+        assert stored[turn_id].llm_text
+
+
+def test_parallel_chats_keep_vectors_in_their_own_namespace(api):
+    from load_test import check_namespaces
+
+    chat_names = [f"chat-{i}" for i in range(CHATS)]
+    replies = asyncio.run(converse(api, chat_names, TURNS // CHATS))
+
+    for name in chat_names:
+        turn_ids = sorted(turn_id for (chat_name, _), turn_id in replies if chat_name == name)
+        assert turn_ids == list(range(1, TURNS // CHATS + 1))
+    assert check_namespaces(api, chat_names, {name: TURNS // CHATS for name in chat_names}) == []
@@ -0,0 +1,310 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "vector_data")
+# Namespaces at or above this size are served through an IVF index instead of a full scan
+LOCAL_IVF_MIN_VECTORS = int(os.getenv("LOCAL_IVF_MIN_VECTORS", "20000"))
+LOCAL_IVF_NPROBE = int(os.getenv("LOCAL_IVF_NPROBE", "8"))
+# Dirty namespaces are written to disk at most this often (and always at exit)
+LOCAL_INDEX_FLUSH_SECONDS = float(os.getenv("LOCAL_INDEX_FLUSH_SECONDS", "5"))
+
+
+class Match:
+    """A single query hit, shaped like a Pinecone match"""
+    __slots__ = ("id", "score", "metadata")
+
+    def __init__(self, id, score, metadata=None):
+        self.id = id
+        self.score = score
+        self.metadata = metadata
+
+
+class QueryResult:
+    """Query response, shaped like a Pinecone query response"""
+    def __init__(self, matches):
+        self.matches = matches
+
+
+class VectorStore:
+    """Interface every vector backend implements"""
+
+    def upsert(self, vectors, namespace):
+        """Insert or overwrite vectors given as {"id", "values", "metadata"} dicts"""
+        raise NotImplementedError
+
+    def query(self, vector, top_k, namespace, include_metadata=True, min_score=None):
+        """Return a QueryResult with the top_k most similar vectors scoring at least min_score"""
+        raise NotImplementedError
+
+    def delete_namespace(self, namespace):
+        """Delete all vectors in a namespace"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Persist pending writes, if the backend buffers any"""
+
+
+class PineconeVectorStore(VectorStore):
+    """Vector store backed by a hosted Pinecone index"""
+
+    def __init__(self, index, client):
+        self.index = index
+        self.client = client  # Deadline, retries and circuit breaker shared with the embedding calls
+
+    def upsert(self, vectors, namespace):
+        self.client.call(self.index.upsert, vectors=vectors, namespace=namespace)
+
+    def query(self, vector, top_k, namespace, include_metadata=True, min_score=None):
+        response = self.client.call(
+            self.index.query,
+            vector=vector,
+            top_k=top_k,
+            include_metadata=include_metadata,
+            namespace=namespace
+        )
+        if min_score is None:
+            return response
+        # Pinecone has no score cutoff, so the bounded top_k is filtered here
+        return QueryResult([match for match in response.matches if match.score >= min_score])
+
+    def delete_namespace(self, namespace):
+        self.client.call(self.index.delete, delete_all=True, namespace=namespace)
+
+
+class IVFIndex:
+    """Inverted-file index: k-means centroids plus a centroid assignment per row"""
+
+    def __init__(self, vectors, nlist, iterations=10, seed=0):
+        rng = np.random.default_rng(seed)
+        n = len(vectors)
+        self.centroids = vectors[rng.choice(n, size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = self.assign(vectors)
+            for c in range(nlist):
+                members = vectors[assign == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    norm = np.linalg.norm(centroid)
+                    if norm > 0:
+                        self.centroids[c] = centroid / norm
+        self.assignments = self.assign(vectors)
+        self.trained_size = n
+
+    def assign(self, vectors):
+        """Nearest centroid for each row of vectors"""
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def candidates(self, query, count, nprobe):
+        """Row numbers in the nprobe clusters closest to query"""
+        probes = np.argsort(self.centroids @ query)[-nprobe:]
+        return np.flatnonzero(np.isin(self.assignments[:count], probes))
+
+
+class _Namespace:
+    """Row-major matrix of unit-normalized vectors for one namespace"""
+
+    def __init__(self):
+        self.ids = []
+        self.rows = {}
+        self.metadata = []
+        self.vectors = None
+        self.ivf = None
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def upsert(self, vec_id, values, metadata):
+        vector = np.asarray(values, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+
+        if self.vectors is None:
+            self.vectors = np.empty((16, len(vector)), dtype=np.float32)
+        elif len(vector) != self.vectors.shape[1]:
+            raise ValueError(
+                f"Vector dimension {len(vector)} does not match namespace dimension {self.vectors.shape[1]}"
+            )
+
+        row = self.rows.get(vec_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.vectors):
+                # Double capacity so appends stay amortized O(1)
+                grown = np.empty((row * 2, self.vectors.shape[1]), dtype=np.float32)
+                grown[:row] = self.vectors
+                self.vectors = grown
+            self.ids.append(vec_id)
+            self.metadata.append(metadata)
+            self.rows[vec_id] = row
+        else:
+            self.metadata[row] = metadata
+        self.vectors[row] = vector
+
+        if self.ivf is not None:
+            if len(self.ivf.assignments) < len(self.vectors):
+                grown = np.zeros(len(self.vectors), dtype=np.int32)
+                grown[:len(self.ivf.assignments)] = self.ivf.assignments
+                self.ivf.assignments = grown
+            self.ivf.assignments[row] = self.ivf.assign(vector[None, :])[0]
+        self.dirty = True
+
+    def maybe_build_ivf(self):
+        """Train (or retrain, once the namespace has doubled) the IVF index for large namespaces"""
+        n = len(self.ids)
+        if n < LOCAL_IVF_MIN_VECTORS:
+            self.ivf = None
+            return
+        if self.ivf is None or n >= 2 * self.ivf.trained_size:
+            nlist = max(1, int(np.sqrt(n)))
+            self.ivf = IVFIndex(self.vectors[:n], nlist)
+
+    def query(self, vector, top_k, min_score=None):
+        n = len(self.ids)
+        if n == 0 or top_k <= 0:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm > 0:
+            q = q / norm
+
+        self.maybe_build_ivf()
+        if self.ivf is not None:
+            rows = self.ivf.candidates(q, n, LOCAL_IVF_NPROBE)
+            scores = self.vectors[rows] @ q
+        else:
+            rows = None
+            scores = self.vectors[:n] @ q
+
+        if min_score is not None:
+            keep = np.flatnonzero(scores >= min_score)
+            rows = keep if rows is None else rows[keep]
+            scores = scores[keep]
+
+        k = min(top_k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        if rows is not None:
+            return [(int(rows[i]), float(scores[i])) for i in top]
+        return [(int(i), float(scores[i])) for i in top]
+
+
+class LocalVectorStore(VectorStore):
+    """In-process vector store: brute-force cosine top-k per namespace, persisted to disk"""
+
+    def __init__(self, directory=LOCAL_INDEX_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.namespaces = {}
+        self.lock = threading.RLock()
+        self.last_flush = time.monotonic()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _filename(namespace):
+        """Map a namespace to a filesystem-safe file name"""
+        safe = "".join(c if c.isalnum() or c in "-_" else f"%{ord(c):02x}" for c in namespace)
+        return f"{safe or '%default'}.npz"
+
+    def _path(self, namespace):
+        return os.path.join(self.directory, self._filename(namespace))
+
+    def _namespace(self, namespace, create=False):
+        ns = self.namespaces.get(namespace)
+        if ns is None:
+            ns = self._load(namespace)
+            if ns is None and create:
+                ns = _Namespace()
+            if ns is not None:
+                self.namespaces[namespace] = ns
+        return ns
+
+    def _load(self, namespace):
+        path = self._path(namespace)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                vectors = data["vectors"]
+                ids = [str(i) for i in data["ids"]]
+                metadata = json.loads(str(data["metadata"]))
+        except Exception as e:
+            print(f"Error loading vector namespace '{namespace}': {e}")
+            return None
+        ns = _Namespace()
+        ns.ids = ids
+        ns.rows = {vec_id: row for row, vec_id in enumerate(ids)}
+        ns.metadata = metadata
+        ns.vectors = np.array(vectors, dtype=np.float32) if len(ids) else None
+        return ns
+
+    def _save(self, namespace, ns):
+        path = self._path(namespace)
+        tmp_path = path + ".tmp"
+        n = len(ns)
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                vectors=ns.vectors[:n] if ns.vectors is not None else np.empty((0, 0), dtype=np.float32),
+                ids=np.array(ns.ids, dtype=str),
+                metadata=np.array(json.dumps(ns.metadata))
+            )
+        os.replace(tmp_path, path)
+        ns.dirty = False
+
+    def upsert(self, vectors, namespace):
+        with self.lock:
+            ns = self._namespace(namespace, create=True)
+            for vec in vectors:
+                ns.upsert(str(vec["id"]), vec["values"], vec.get("metadata") or {})
+            if time.monotonic() - self.last_flush >= LOCAL_INDEX_FLUSH_SECONDS:
+                self.flush()
+
+    def query(self, vector, top_k, namespace, include_metadata=True, min_score=None):
+        with self.lock:
+            ns = self._namespace(namespace)
+            if ns is None:
+                return QueryResult([])
+            hits = ns.query(vector, top_k, min_score)
+            return QueryResult([
+                Match(ns.ids[row], score, ns.metadata[row] if include_metadata else None)
+                for row, score in hits
+            ])
+
+    def delete_namespace(self, namespace):
+        with self.lock:
+            self.namespaces.pop(namespace, None)
+            path = self._path(namespace)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def flush(self):
+        with self.lock:
+            for namespace, ns in self.namespaces.items():
+                if ns.dirty:
+                    try:
+                        self._save(namespace, ns)
+                    except Exception as e:
+                        print(f"Error saving vector namespace '{namespace}': {e}")
+            self.last_flush = time.monotonic()
+
+
+def create_vector_store(backend, get_pc=None, index_name=None, client=None):
+    """Build the vector store selected by VECTOR_BACKEND; get_pc is only called for the pinecone backend"""
+    if backend == "local":
+        return LocalVectorStore()
+    if backend == "pinecone":
+        # Pool sized to the client's concurrency limit so no call waits for a connection
+        return PineconeVectorStore(get_pc().Index(index_name, connection_pool_maxsize=client.max_concurrency), client)
+    raise ValueError(f"Unknown vector backend: {backend}")
@@ -1,12 +1,13 @@
 'use client';
 
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useCallback } from 'react';
 import { useParams, useRouter } from 'next/navigation';
 import ContextPanel from '@/components/ContextPanel';
 import HistoryPanel from '@/components/HistoryPanel';
 import ChatInput from '@/components/ChatInput';
 import VisualizationModal from '@/components/VisualizationModal';
 import { Chat, Message, ContextTurn } from '@/types';
+import { getChatSocket } from '@/lib/chatSocket';
 
 export default function ChatPage() {
   const params = useParams();
@@ -20,11 +21,17 @@ export default function ChatPage() {
   const [chatInfo, setChatInfo] = useState<Chat | null>(null);
   const [useFullContext, setUseFullContext] = useState(false);
   const [showVisualization, setShowVisualization] = useState(false);
+  const [historyCursor, setHistoryCursor] = useState<number | null>(null);
 
   useEffect(() => {
     initializeChat();
   }, [chatName]);
 
+  // Open the shared socket early so the first message can already use it
+  useEffect(() => {
+    getChatSocket();
+  }, []);
+
   const initializeChat = async () => {
     setIsLoading(true);
     try {
@@ -40,7 +47,9 @@ export default function ChatPage() {
       const data = await response.json();
       setChatInfo(data);
       
-      await loadChatHistory(chatName);
+      // The open-chat response carries only the most recent turns
+      setMessages(formatHistory(data.history));
+      setHistoryCursor(data.history_cursor ?? null);
       setContextTurns([]);
     } catch (error) {
       console.error('Error initializing chat:', error);
@@ -49,24 +58,43 @@ export default function ChatPage() {
     }
   };
 
-  const loadChatHistory = async (chatName: string) => {
+  const formatHistory = (history: any[]): Message[] =>
+    history.map((turn: any) => ({
+      id: turn.id,
+      user: turn.user.text,
+      assistant: turn.llm.text,
+      timestamp: new Date().toISOString(),
+    }));
+
+  const loadOlderHistory = async () => {
+    if (historyCursor === null) return;
     try {
-      const response = await fetch(`/api/chat/${chatName}/history`);
+      const response = await fetch(`/api/chat/${chatName}/history?before=${historyCursor}&limit=50`);
       const data = await response.json();
       
-      const formattedMessages: Message[] = data.history.map((turn: any) => ({
-        id: turn.id,
-        user: turn.user.text,
-        assistant: turn.llm.text,
-        timestamp: new Date().toISOString(),
-      }));
-      
-      setMessages(formattedMessages);
+      setMessages(prev => [...formatHistory(data.history), ...prev]);
+      setHistoryCursor(data.next_cursor ?? null);
     } catch (error) {
       console.error('Error loading chat history:', error);
     }
   };
 
+  // Lets the backend start retrieval for the draft, so sending it skips the vector round trip
+  // Stable across renders so ChatInput's debounce only restarts when the draft changes
+  const handleDraftChange = useCallback((draft: string) => {
+    if (useFullContext) return;
+    const socket = getChatSocket();
+    if (socket.isOpen) {
+      socket.request('prefetch', { chat_name: chatName, draft }).catch(() => {});
+      return;
+    }
+    fetch('/api/prefetch', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ chat_name: chatName, draft }),
+    }).catch(() => {});
+  }, [useFullContext, chatName]);
+
   const handleSendMessage = async (message: string) => {
     setIsLoading(true);
     
@@ -79,24 +107,92 @@ export default function ChatPage() {
     };
     setMessages(prev => [...prev, tempMessage]);
     
+    // Lets the backend answer a resent request with the original reply instead of a new turn
+    const idempotencyKey = crypto.randomUUID();
+    
+    let assistantResponse = '';
+    let turnId = tempId;
+    
+    const handleEvent = (data: any) => {
+      if (data.type === 'metadata') {
+        const formattedContext: ContextTurn[] = data.context_turns.map((turn: any) => ({
+          id: turn.id,
+          user: turn.user,
+          assistant: turn.assistant,
+          similarity: data.similarity_scores[turn.id] || 0.0,  // Use actual score from Pinecone
+        }));
+        
+        formattedContext.push({
+          id: tempId,
+          user: message,
+          assistant: '',
+          similarity: 1.0,  // Current turn is 100% relevant
+        });
+        
+        setContextTurns(formattedContext);
+      } else if (data.type === 'chunk') {
+        assistantResponse += data.text;
+        setMessages(prev => prev.map(msg => 
+          msg.id === tempId 
+            ? { ...msg, assistant: assistantResponse }
+            : msg
+        ));
+        
+        setContextTurns(prev => prev.map(turn =>
+          turn.id === tempId
+            ? { ...turn, assistant: assistantResponse }
+            : turn
+        ));
+      } else if (data.type === 'done') {
+        turnId = data.turn_id;
+        setMessages(prev => prev.map(msg => 
+          msg.id === tempId 
+            ? { ...msg, id: turnId, assistant: assistantResponse }
+            : msg
+        ));
+        
+        setContextTurns(prev => prev.map(turn =>
+          turn.id === tempId
+            ? { ...turn, id: turnId }
+            : turn
+        ));
+        
+        if (chatInfo) {
+          setChatInfo({
+            ...chatInfo,
+            message_count: chatInfo.message_count + 1,
+          });
+        }
+      } else if (data.type === 'error') {
+        throw new Error(data.detail);
+      }
+    };
+    
+    const body = {
+      chat_name: chatName,
+      message: message,
+      use_full_context: useFullContext,
+      idempotency_key: idempotencyKey,
+    };
+    
     try {
+      const socket = getChatSocket();
+      if (socket.isOpen) {
+        // Shared connection: no per-message request setup or SSE parsing
+        await socket.stream(body, handleEvent);
+        return;
+      }
+      
       const response = await fetch('/api/message/stream', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          chat_name: chatName,
-          message: message,
-          use_full_context: useFullContext,
-        }),
+        body: JSON.stringify(body),
       });
       
       if (!response.body) throw new Error('No response body');
       
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
-      let assistantResponse = '';
-      let turnId = tempId;
-      let contextData: any = null;
       
       while (true) {
         const { done, value } = await reader.read();
@@ -107,59 +203,7 @@ export default function ChatPage() {
         
         for (const line of lines) {
           if (line.startsWith('data: ')) {
-            const data = JSON.parse(line.slice(6));
-            
-            if (data.type === 'metadata') {
-              contextData = data;
-              const formattedContext: ContextTurn[] = data.context_turns.map((turn: any) => ({
-                id: turn.id,
-                user: turn.user,
-                assistant: turn.assistant,
-                similarity: data.similarity_scores[turn.id] || 0.0,  // Use actual score from Pinecone
-              }));
-              
-              formattedContext.push({
-                id: tempId,
-                user: message,
-                assistant: '',
-                similarity: 1.0,  // Current turn is 100% relevant
-              });
-              
-              setContextTurns(formattedContext);
-            } else if (data.type === 'chunk') {
-              assistantResponse += data.text;
-              setMessages(prev => prev.map(msg => 
-                msg.id === tempId 
-                  ? { ...msg, assistant: assistantResponse }
-                  : msg
-              ));
-              
-              setContextTurns(prev => prev.map(turn =>
-                turn.id === tempId
-                  ? { ...turn, assistant: assistantResponse }
-                  : turn
-              ));
-            } else if (data.type === 'done') {
-              turnId = data.turn_id;
-              setMessages(prev => prev.map(msg => 
-                msg.id === tempId 
-                  ? { ...msg, id: turnId, assistant: assistantResponse }
-                  : msg
-              ));
-              
-              setContextTurns(prev => prev.map(turn =>
-                turn.id === tempId
-                  ? { ...turn, id: turnId }
-                  : turn
-              ));
-              
-              if (chatInfo) {
-                setChatInfo({
-                  ...chatInfo,
-                  message_count: chatInfo.message_count + 1,
-                });
-              }
-            }
+            handleEvent(JSON.parse(line.slice(6)));
           }
         }
       }
@@ -259,6 +303,7 @@ export default function ChatPage() {
             </div>
             <ChatInput 
               onSendMessage={handleSendMessage} 
+              onDraftChange={handleDraftChange}
               disabled={isLoading}
             />
           </div>
@@ -274,7 +319,11 @@ export default function ChatPage() {
               Complete chronological history
             </p>
           </div>
-          <HistoryPanel messages={messages} />
+          <HistoryPanel
+            messages={messages}
+            hasOlder={historyCursor !== null}
+            onLoadOlder={loadOlderHistory}
+          />
         </div>
       </div>
 
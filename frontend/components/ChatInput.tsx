@@ -1,15 +1,26 @@
 'use client';
 
-import { useState, KeyboardEvent } from 'react';
+import { useState, useEffect, KeyboardEvent } from 'react';
+
+// Pause in typing after which the draft is handed to onDraftChange
+const DRAFT_DEBOUNCE_MS = 400;
 
 interface ChatInputProps {
   onSendMessage: (message: string) => void;
+  onDraftChange?: (draft: string) => void;
   disabled?: boolean;
 }
 
-export default function ChatInput({ onSendMessage, disabled }: ChatInputProps) {
+export default function ChatInput({ onSendMessage, onDraftChange, disabled }: ChatInputProps) {
   const [message, setMessage] = useState('');
 
+  useEffect(() => {
+    const draft = message.trim();
+    if (!onDraftChange || !draft) return;
+    const timer = setTimeout(() => onDraftChange(draft), DRAFT_DEBOUNCE_MS);
+    return () => clearTimeout(timer);
+  }, [message, onDraftChange]);
+
   const handleSend = () => {
     if (message.trim() && !disabled) {
       onSendMessage(message.trim());
@@ -5,16 +5,20 @@ import { Message } from '@/types';
 
 interface HistoryPanelProps {
   messages: Message[];
+  hasOlder?: boolean;
+  onLoadOlder?: () => void;
 }
 
-export default function HistoryPanel({ messages }: HistoryPanelProps) {
+export default function HistoryPanel({ messages, hasOlder, onLoadOlder }: HistoryPanelProps) {
   const scrollRef = useRef<HTMLDivElement>(null);
+  const lastMessage = messages[messages.length - 1];
 
+  // Follow new and streaming messages, but stay put when older pages are prepended
   useEffect(() => {
     if (scrollRef.current) {
       scrollRef.current.scrollTop = scrollRef.current.scrollHeight;
     }
-  }, [messages]);
+  }, [lastMessage?.id, lastMessage?.assistant]);
 
   const formatTime = (timestamp: string) => {
     return new Date(timestamp).toLocaleTimeString('en-US', {
@@ -39,6 +43,17 @@ export default function HistoryPanel({ messages }: HistoryPanelProps) {
         </div>
       )}
 
+      {hasOlder && onLoadOlder && (
+        <div className="flex justify-center">
+          <button
+            onClick={onLoadOlder}
+            className="px-3 py-1.5 text-xs text-zinc-400 font-mono bg-zinc-900/50 border border-zinc-800/50 rounded-lg hover:bg-zinc-800/50 transition-colors"
+          >
+            Load earlier messages
+          </button>
+        </div>
+      )}
+
       {messages.map((message) => (
         <div key={message.id} className="space-y-4 animate-fade-in">
           {/* User Message - Right aligned */}
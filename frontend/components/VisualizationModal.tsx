@@ -1,6 +1,7 @@
 'use client';
 
 import { useState, useEffect } from 'react';
+import { getChatSocket } from '@/lib/chatSocket';
 
 interface Turn {
   id: number;
@@ -12,6 +13,11 @@ interface SimilarityData {
   [turnId: number]: number; // turnId -> similarity score with respect to latest message
 }
 
+interface Neighbor {
+  turn_id: number;
+  score: number;
+}
+
 interface Stats {
   totalTurns: number;
   avgSimilarity: number;
@@ -25,6 +31,18 @@ interface VisualizationModalProps {
   chatName: string;
 }
 
+// Nearest turns shown for the selected turn
+const NEIGHBOR_COUNT = 5;
+
+// Convert to format: { turnId: similarity }
+const toSimilarityData = (similarityScores: { [turnId: string]: number }): SimilarityData => {
+  const scores: SimilarityData = {};
+  Object.entries(similarityScores).forEach(([turnId, similarity]) => {
+    scores[parseInt(turnId)] = similarity;
+  });
+  return scores;
+};
+
 export default function VisualizationModal({ isOpen, onClose, chatName }: VisualizationModalProps) {
   const [turns, setTurns] = useState<Turn[]>([]);
   const [isLoading, setIsLoading] = useState(true);
@@ -34,6 +52,7 @@ export default function VisualizationModal({ isOpen, onClose, chatName }: Visual
   const [activeView, setActiveView] = useState<'linked-list' | 'heatmap'>('linked-list');
   const [stats, setStats] = useState<Stats>({ totalTurns: 0, avgSimilarity: 0, highSimilarityPairs: 0, totalWords: 0 });
   const [showStats, setShowStats] = useState(true);
+  const [neighbors, setNeighbors] = useState<Neighbor[]>([]);
 
   useEffect(() => {
     if (isOpen) {
@@ -41,6 +60,41 @@ export default function VisualizationModal({ isOpen, onClose, chatName }: Visual
     }
   }, [isOpen, chatName]);
 
+  // While open, new turns and their similarity scores are pushed instead of refetched
+  useEffect(() => {
+    if (!isOpen) return;
+    return getChatSocket().subscribe(chatName, (frame) => {
+      if (frame.type === 'turn') {
+        const turn: Turn = { id: frame.turn.id, user: frame.turn.user.text, assistant: frame.turn.llm.text };
+        setTurns(prev => prev.some(t => t.id === turn.id) ? prev : [...prev, turn]);
+      } else if (frame.type === 'similarities') {
+        setSimilarityData(toSimilarityData(frame.similarity_scores));
+      } else if (frame.type === 'resync') {
+        loadChatHistory();
+      }
+    });
+  }, [isOpen, chatName]);
+
+  // Nearest turns of the selected turn, served from the backend's similarity graph
+  useEffect(() => {
+    setNeighbors([]);
+    if (!isOpen || selectedTurn === null) return;
+    let cancelled = false;
+    const loadNeighbors = async () => {
+      try {
+        const socket = getChatSocket();
+        const data = socket.isOpen
+          ? await socket.request('turn_similarity', { chat_name: chatName, turn_id: selectedTurn, k: NEIGHBOR_COUNT })
+          : await (await fetch(`/api/chat/${chatName}/similarity/${selectedTurn}?k=${NEIGHBOR_COUNT}`)).json();
+        if (!cancelled) setNeighbors(data.neighbors || []);
+      } catch (error) {
+        console.error('Error fetching neighbors:', error);
+      }
+    };
+    loadNeighbors();
+    return () => { cancelled = true; };
+  }, [isOpen, chatName, selectedTurn, turns.length]);
+
   useEffect(() => {
     if (turns.length > 0 && Object.keys(similarityData).length > 0) {
       calculateStats();
@@ -50,8 +104,10 @@ export default function VisualizationModal({ isOpen, onClose, chatName }: Visual
   const loadChatHistory = async () => {
     setIsLoading(true);
     try {
-      const response = await fetch(`/api/chat/${chatName}/history`);
-      const data = await response.json();
+      const socket = getChatSocket();
+      const data = socket.isOpen
+        ? await socket.request('history', { chat_name: chatName })
+        : await (await fetch(`/api/chat/${chatName}/history`)).json();
       
       const formattedTurns: Turn[] = data.history.map((turn: any) => ({
         id: turn.id,
@@ -70,16 +126,12 @@ export default function VisualizationModal({ isOpen, onClose, chatName }: Visual
 
   const calculateSimilarities = async (turns: Turn[]) => {
     try {
-      const response = await fetch(`/api/chat/${chatName}/last_similarities`);
-      const data = await response.json();
-      
-      // Convert to format: { turnId: similarity }
-      const scores: SimilarityData = {};
-      Object.entries(data.similarity_scores).forEach(([turnId, similarity]) => {
-        scores[parseInt(turnId as string)] = similarity as number;
-      });
+      const socket = getChatSocket();
+      const data = socket.isOpen
+        ? await socket.request('similarities', { chat_name: chatName })
+        : await (await fetch(`/api/chat/${chatName}/last_similarities`)).json();
       
-      setSimilarityData(scores);
+      setSimilarityData(toSimilarityData(data.similarity_scores));
     } catch (error) {
       console.error('Error fetching similarities:', error);
       setSimilarityData({});
@@ -244,6 +296,7 @@ export default function VisualizationModal({ isOpen, onClose, chatName }: Visual
               turns={turns}
               selectedTurn={selectedTurn}
               hoveredTurn={hoveredTurn}
+              neighbors={neighbors}
               onSelectTurn={setSelectedTurn}
               onHoverTurn={setHoveredTurn}
               getSimilarity={getSimilarity}
@@ -261,6 +314,7 @@ function LinkedListView({
   turns,
   selectedTurn,
   hoveredTurn,
+  neighbors,
   onSelectTurn,
   onHoverTurn,
   getSimilarity,
@@ -376,6 +430,26 @@ function LinkedListView({
                       <div className="text-zinc-500 font-mono text-xs mb-1.5">ASSISTANT:</div>
                       <div className="text-zinc-300 leading-relaxed">{turn.assistant}</div>
                     </div>
+                    {isSelected && neighbors.length > 0 && (
+                      <div className="pt-2 border-t border-zinc-800">
+                        <div className="text-zinc-500 font-mono text-xs mb-1.5">NEAREST TURNS:</div>
+                        <div className="flex flex-wrap gap-2">
+                          {neighbors.map((neighbor: Neighbor) => (
+                            <button
+                              key={neighbor.turn_id}
+                              className="text-xs font-mono font-bold px-2 py-0.5 rounded"
+                              style={{
+                                color: getSimilarityColor(neighbor.score),
+                                backgroundColor: `${getSimilarityColor(neighbor.score)}20`
+                              }}
+                              onClick={() => onSelectTurn(neighbor.turn_id)}
+                            >
+                              #{neighbor.turn_id} · {(neighbor.score * 100).toFixed(0)}%
+                            </button>
+                          ))}
+                        </div>
+                      </div>
+                    )}
                   </div>
                 </div>
               )}
@@ -413,7 +487,7 @@ function LinkedListView({
       {/* Instructions */}
       <div className="mt-4 text-center">
         <p className="text-xs text-zinc-600 font-mono">
-          Hover over boxes for full content · Arrow badges show relationship to latest turn
+          Hover over boxes for full content · Click a box for its nearest turns · Arrow badges show relationship to latest turn
         </p>
       </div>
     </div>
@@ -0,0 +1,140 @@
+// One WebSocket per browser tab, shared by every chat: replies, requests and
+// pushes are multiplexed over it by request id and chat name.
+
+// By default the socket goes through the page's own origin and the /api rewrite, like every
+// HTTP call, using wss:// on https pages so it is not blocked as mixed content
+const SOCKET_URL =
+  process.env.NEXT_PUBLIC_WS_URL ||
+  (typeof window !== 'undefined'
+    ? `${window.location.protocol === 'https:' ? 'wss' : 'ws'}://${window.location.host}/api/ws`
+    : '');
+const RECONNECT_MAX_MS = 10000;
+// Close code the server uses when it refuses the page's origin; retrying cannot succeed
+const POLICY_VIOLATION = 1008;
+
+type Frame = { [key: string]: any };
+type Pending = {
+  onFrame: (frame: Frame) => void;
+  reject: (error: Error) => void;
+};
+
+class ChatSocket {
+  private socket: WebSocket | null = null;
+  private nextId = 1;
+  private pending = new Map<number, Pending>();
+  private watchers = new Map<string, Set<(frame: Frame) => void>>();
+  private reconnectDelay = 500;
+  private refused = false;
+
+  get isOpen() {
+    return this.socket?.readyState === WebSocket.OPEN;
+  }
+
+  connect() {
+    if (!SOCKET_URL || this.refused || (this.socket && this.socket.readyState <= WebSocket.OPEN)) return;
+    const socket = new WebSocket(SOCKET_URL);
+    this.socket = socket;
+
+    socket.onopen = () => {
+      this.reconnectDelay = 500;
+      // Subscriptions live on the server per connection
+      for (const chatName of this.watchers.keys()) {
+        this.write({ op: 'subscribe', chat_name: chatName });
+      }
+    };
+    socket.onmessage = (event) => this.dispatch(JSON.parse(event.data));
+    socket.onclose = (event) => {
+      this.socket = null;
+      for (const request of this.pending.values()) {
+        request.reject(new Error('Connection closed'));
+      }
+      this.pending.clear();
+      if (event.code === POLICY_VIOLATION) {
+        // Stay on the HTTP endpoints for the rest of this page
+        this.refused = true;
+        return;
+      }
+      setTimeout(() => this.connect(), this.reconnectDelay);
+      this.reconnectDelay = Math.min(this.reconnectDelay * 2, RECONNECT_MAX_MS);
+    };
+  }
+
+  private write(frame: Frame) {
+    this.socket?.send(JSON.stringify(frame));
+  }
+
+  private dispatch(frame: Frame) {
+    if (frame.id != null) {
+      this.pending.get(frame.id)?.onFrame(frame);
+      return;
+    }
+    if (frame.chat_name) {
+      this.watchers.get(frame.chat_name)?.forEach(listener => listener(frame));
+    }
+  }
+
+  /** Send a message; onEvent gets the same metadata/chunk/done events as /message/stream */
+  stream(body: Frame, onEvent: (event: Frame) => void): Promise<void> {
+    const id = this.nextId++;
+    return new Promise((resolve, reject) => {
+      this.pending.set(id, {
+        onFrame: (frame) => {
+          if (frame.type === 'error') {
+            this.pending.delete(id);
+            reject(new Error(frame.detail));
+            return;
+          }
+          onEvent(frame);
+          if (frame.type === 'done') {
+            this.pending.delete(id);
+            resolve();
+          }
+        },
+        reject,
+      });
+      this.write({ op: 'send', id, ...body });
+    });
+  }
+
+  /** One-shot request (history, similarities, turn_similarity, prefetch) answered by a single result frame */
+  request(op: string, body: Frame): Promise<any> {
+    const id = this.nextId++;
+    return new Promise((resolve, reject) => {
+      this.pending.set(id, {
+        onFrame: (frame) => {
+          this.pending.delete(id);
+          if (frame.type === 'error') reject(new Error(frame.detail));
+          else resolve(frame.data);
+        },
+        reject,
+      });
+      this.write({ op, id, ...body });
+    });
+  }
+
+  /** Receive turn, similarities and resync pushes for a chat until the returned function is called */
+  subscribe(chatName: string, listener: (frame: Frame) => void): () => void {
+    let listeners = this.watchers.get(chatName);
+    if (!listeners) {
+      listeners = new Set();
+      this.watchers.set(chatName, listeners);
+      if (this.isOpen) this.write({ op: 'subscribe', chat_name: chatName });
+    }
+    listeners.add(listener);
+    return () => {
+      listeners!.delete(listener);
+      if (listeners!.size === 0) {
+        this.watchers.delete(chatName);
+        if (this.isOpen) this.write({ op: 'unsubscribe', chat_name: chatName });
+      }
+    };
+  }
+}
+
+let chatSocket: ChatSocket | null = null;
+
+export function getChatSocket(): ChatSocket {
+  if (!chatSocket) chatSocket = new ChatSocket();
+  chatSocket.connect();
+  return chatSocket;
+}
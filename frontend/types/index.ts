@@ -3,6 +3,8 @@ export interface Chat {
   namespace: string;
   message_count: number;
   history: any[];
+  history_cursor?: number | null;
+  total_turns?: number;
   system_instructions?: string;
 }
 